@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Compares the previous per-file transforms with the schema-driven engine on
+# synthetic stop_times.txt and shapes.txt files. Each case runs in its own
+# process so peak RSS is measured independently.
+#
+#   python benchmarks/transform_benchmark.py --stop-times-rows 2000000 --shapes-rows 500000
+
+import argparse
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from pipelines.schema import apply_schema, read_dtypes
+
+def write_stop_times(path: Path, rows: int) -> None:
+    rng = np.random.default_rng(42)
+    trip = np.arange(rows) // 30
+    seconds = 5 * 3600 + (trip % 1000) * 60 + (np.arange(rows) % 30) * 90
+    times = pd.Series(
+        [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in seconds]
+    )
+    stop_ids = pd.Series(rng.integers(0, 2500, rows)).map(lambda i: f"STOP{i}")
+    # A few padded and blank ids, as seen in real feeds
+    stop_ids[::1000] = ' ' + stop_ids[::1000] + ' '
+    stop_ids[::5003] = ''
+    pd.DataFrame({
+        'trip_id': pd.Series(trip).map(lambda i: f"{i % 300}_{i}_U"),
+        'arrival_time': times,
+        'departure_time': times,
+        'stop_id': stop_ids,
+        'stop_sequence': np.arange(rows) % 30 + 1,
+    }).to_csv(path, index=False)
+
+def write_shapes(path: Path, rows: int) -> None:
+    rng = np.random.default_rng(7)
+    shape = np.arange(rows) // 1000
+    pd.DataFrame({
+        'shape_id': pd.Series(shape).map(lambda i: f"SHP_{i}"),
+        'shape_pt_lat': 41.15 + rng.normal(0, 0.03, rows),
+        'shape_pt_lon': -8.61 + rng.normal(0, 0.03, rows),
+        'shape_pt_sequence': np.arange(rows) % 1000,
+    }).to_csv(path, index=False)
+
+def legacy_stop_times(path: Path) -> pd.DataFrame:
+    df = pd.read_csv(path, dtype={'arrival_time': str, 'departure_time': str})
+    df = df.copy()
+    for col in df.select_dtypes(include=['object']).columns:
+        df[col] = df[col].astype(str).str.strip()
+    df['stop_sequence'] = pd.to_numeric(df['stop_sequence'], errors='coerce').fillna(-1).astype(int)
+    valid = (
+        df['stop_id'].notna() & (df['stop_id'] != '') &
+        df['trip_id'].notna() & (df['trip_id'] != '') &
+        (df['stop_sequence'] >= 0)
+    )
+    return df[valid]
+
+def legacy_shapes(path: Path) -> pd.DataFrame:
+    df = pd.read_csv(path)
+    df = df.copy()
+    for col in df.select_dtypes(include=['object']).columns:
+        df[col] = df[col].astype(str).str.strip()
+    df = df[df['shape_id'].notna()]
+    df = df[df['shape_id'] != '']
+    df.dropna(subset=['shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'], inplace=True)
+    df['shape_pt_lat'] = pd.to_numeric(df['shape_pt_lat'], errors='coerce')
+    df['shape_pt_lon'] = pd.to_numeric(df['shape_pt_lon'], errors='coerce')
+    df['shape_pt_sequence'] = pd.to_numeric(df['shape_pt_sequence'], errors='coerce').astype(int)
+    return df
+
+def schema_transform(path: Path, table_name: str) -> pd.DataFrame:
+    df = pd.read_csv(path, dtype=read_dtypes(table_name))
+    return apply_schema(df, table_name)
+
+CASES = {
+    ('stop_times', 'legacy'): lambda path: legacy_stop_times(path),
+    ('stop_times', 'schema'): lambda path: schema_transform(path, 'stop_times'),
+    ('shapes', 'legacy'): lambda path: legacy_shapes(path),
+    ('shapes', 'schema'): lambda path: schema_transform(path, 'shapes'),
+}
+
+def peak_rss_mb() -> float:
+    # ru_maxrss survives exec on Linux, so prefer the high-water mark of this process
+    try:
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_case(table_name: str, variant: str, path: str, results) -> None:
+    started = time.perf_counter()
+    df = CASES[(table_name, variant)](Path(path))
+    elapsed = time.perf_counter() - started
+    results.put({
+        'rows': len(df),
+        'seconds': elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+        'frame_mb': df.memory_usage(deep=True).sum() / 1024 ** 2,
+    })
+
+def measure(table_name: str, variant: str, path: Path) -> dict:
+    ctx = get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=run_case, args=(table_name, variant, str(path), results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GTFS transforms on synthetic files")
+    parser.add_argument('--stop-times-rows', type=int, default=2_000_000)
+    parser.add_argument('--shapes-rows', type=int, default=500_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {'stop_times': Path(tmp) / 'stop_times.txt', 'shapes': Path(tmp) / 'shapes.txt'}
+        write_stop_times(files['stop_times'], args.stop_times_rows)
+        write_shapes(files['shapes'], args.shapes_rows)
+
+        print(f"{'file':<12}{'variant':<9}{'rows':>11}{'seconds':>10}{'peak RSS MB':>13}{'frame MB':>10}")
+        for table_name, path in files.items():
+            for variant in ('legacy', 'schema'):
+                r = measure(table_name, variant, path)
+                print(f"{table_name:<12}{variant:<9}{r['rows']:>11,}{r['seconds']:>10.2f}"
+                      f"{r['peak_rss_mb']:>13.0f}{r['frame_mb']:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,211 @@
 #!/usr/bin/env python3
 
+import asyncio
+import base64
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from datetime import date, datetime
+from typing import NamedTuple
+from zoneinfo import ZoneInfo
+
+import orjson
 import uvicorn
-from fastapi import FastAPI, HTTPException, APIRouter
+from fastapi import FastAPI, HTTPException, APIRouter, Query, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine
 from pathlib import Path
 
-from config import DATABASE_URL
+from config import (
+    ASYNC_DATABASE_URL, DATASET_VERSION_POLL_SECONDS, API_DB_POOL_SIZE, API_DB_MAX_OVERFLOW,
+    API_DB_POOL_TIMEOUT, API_DB_CONNECT_TIMEOUT, API_STATEMENT_TIMEOUT_MS, TILE_CACHE_MAX_BYTES,
+    TILE_STOPS_MIN_ZOOM, API_PAGE_DEFAULT_LIMIT, API_PAGE_MAX_LIMIT, API_STREAM_BATCH_ROWS, FEED_TIMEZONE,
+    INDEX_LOAD_TIMEOUT_MS, FLEET_STALE_SECONDS, POSITION_STORE
+)
+from departures import load_departure_index
+from fleet_poller import FleetPoller
+from journey_planner import load_journey_planner
+from map_matching import load_shape_index
+from position_store import PositionStore
+from snapshots import (
+    SNAPSHOT_QUERIES, SNAPSHOT_ENCODINGS, snapshot_key, snapshot_path,
+    paragem_row, linha_row, quilometragem_row, frequencia_row
+)
+
+# Bounded pool on an async driver so a slow query never blocks the event loop
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=API_DB_POOL_SIZE,
+    max_overflow=API_DB_MAX_OVERFLOW,
+    pool_timeout=API_DB_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    connect_args={'timeout': API_DB_CONNECT_TIMEOUT}
+)
+
+class ResponseCache:
+    # Serialized API responses for the current dataset version. The data only
+    # changes once per feed load, so entries live until the version moves on.
+
+    def __init__(self):
+        self.version = None
+        self.entries = {}
+        self.locks = {}
+
+    def set_version(self, version):
+        if version != self.version:
+            self.version = version
+            self.entries.clear()
+
+    def get(self, endpoint: str):
+        return self.entries.get((endpoint, self.version))
+
+    def lock(self, endpoint: str) -> asyncio.Lock:
+        # One query per endpoint on a miss; concurrent requests wait for it
+        return self.locks.setdefault(endpoint, asyncio.Lock())
+
+    def put(self, endpoint: str, version, body: bytes) -> tuple:
+        # Stored under the version seen before the query ran, so a response
+        # built across a reload is never served as the new version
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        if version == self.version:
+            self.entries[(endpoint, version)] = (body, etag)
+        return body, etag
+
+response_cache = ResponseCache()
+
+class TileCache:
+    # Rendered vector tiles for the current dataset version, least recently
+    # used first out once the byte budget is reached
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.version = None
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def set_version(self, version):
+        if version != self.version:
+            self.version = version
+            self.entries.clear()
+            self.size = 0
+
+    def get(self, tile: tuple):
+        entry = self.entries.get((self.version, *tile))
+        if entry is not None:
+            self.entries.move_to_end((self.version, *tile))
+        return entry
+
+    def put(self, tile: tuple, version, body: bytes) -> tuple:
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        if version == self.version and len(body) <= self.max_bytes:
+            self.entries[(version, *tile)] = (body, etag)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return body, etag
+
+tile_cache = TileCache(TILE_CACHE_MAX_BYTES)
+
+async def fetch_rows(sql: str, params: dict = None, timeout_ms: int = API_STATEMENT_TIMEOUT_MS) -> list:
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+            result = await conn.execute(text(sql), params or {})
+            return result.fetchall()
+    except SQLAlchemyError as e:
+        print(f"Database query error: {e}")
+        raise
+
+async def read_dataset_version():
+    rows = await fetch_rows("SELECT data_atualizacao FROM analytics.kpi_summary LIMIT 1")
+    return rows[0][0].isoformat() if rows and rows[0][0] else None
+
+class DatasetIndex:
+    # An in-memory index for the dataset version it was built from; the
+    # previous index keeps answering while a new load is being indexed
+
+    def __init__(self, name: str, load):
+        self.name = name
+        self.load = load
+        self.version = None
+        self.index = None
+
+    async def refresh(self, version):
+        if version is None or version == self.version:
+            return
+        try:
+            index = await self.load(version)
+        except Exception as e:
+            print(f"{self.name} load failed: {e}")
+            return
+        self.index, self.version = index, version
+        print(f"{self.name} loaded for dataset {version}")
+
+departure_board = DatasetIndex(
+    "Departure index", lambda version: load_departure_index(engine, INDEX_LOAD_TIMEOUT_MS)
+)
+journey_planner = DatasetIndex(
+    "Journey planner", lambda version: load_journey_planner(engine, version, INDEX_LOAD_TIMEOUT_MS)
+)
+
+shape_index = DatasetIndex(
+    "Shape index", lambda version: load_shape_index(engine, version, INDEX_LOAD_TIMEOUT_MS)
+)
+
+def match_vehicles(vehicles: list) -> None:
+    # Snaps each bus onto its route's shape once the index for the current feed is loaded
+    index = shape_index.index
+    if index is not None:
+        index.snap_vehicles(vehicles)
+
+position_store = PositionStore(engine) if POSITION_STORE else None
+fleet_poller = FleetPoller(match=match_vehicles, on_snapshot=position_store.add if position_store else None)
+
+async def poll_dataset_version():
+    # The only recurring query: once the ETL finishes a load the version
+    # changes and every cached response is dropped
+    while True:
+        try:
+            version = await read_dataset_version()
+            response_cache.set_version(version)
+            tile_cache.set_version(version)
+            await departure_board.refresh(version)
+            await journey_planner.refresh(version)
+            await shape_index.refresh(version)
+        except Exception as e:
+            print(f"Dataset version check failed: {e}")
+        await asyncio.sleep(DATASET_VERSION_POLL_SECONDS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    poller = asyncio.create_task(poll_dataset_version())
+    fleet_poller.open()
+    tasks = [poller, asyncio.create_task(fleet_poller.run())]
+    if position_store:
+        tasks.append(asyncio.create_task(position_store.run()))
+    yield
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    if position_store:
+        # Whatever was polled since the last flush is written before the pool closes
+        with suppress(Exception):
+            await position_store.flush()
+    await engine.dispose()
 
 app = FastAPI(
     title="STCP Dashboard API",
     description="API for the STCP Dashboard",
     version="1.0.0",
     docs_url="/api/docs",
-    openapi_url="/api/openapi.json"
+    openapi_url="/api/openapi.json",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -29,118 +218,551 @@ app.add_middleware(
 
 api_router = APIRouter(prefix="/api")
 
-engine = create_engine(DATABASE_URL)
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+async def cached_json_response(request: Request, endpoint: str, build) -> Response:
+    cached = response_cache.get(endpoint)
+    if cached is None:
+        async with response_cache.lock(endpoint):
+            cached = response_cache.get(endpoint)
+            if cached is None:
+                version = response_cache.version
+                payload = await build()
+                cached = response_cache.put(endpoint, version, orjson.dumps(payload))
+
+    body, etag = cached
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
+
+def accepted_encodings(request: Request) -> set:
+    encodings = set()
+    for item in request.headers.get('accept-encoding', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if coding and params.replace(' ', '') not in ('q=0', 'q=0.0'):
+            encodings.add(coding.lower())
+    return encodings
+
+def snapshot_response(request: Request, endpoint: str):
+    # Files written by the ETL for the current dataset version, sent as-is
+    version = response_cache.version
+    if not version:
+        return None
+    path = snapshot_path(version, endpoint)
+    if not path.exists():
+        return None
+
+    encodings = accepted_encodings(request)
+    content_encoding = None
+    for suffix, encoding in SNAPSHOT_ENCODINGS:
+        variant = path.with_name(path.name + suffix)
+        if encoding in encodings and variant.exists():
+            path, content_encoding = variant, encoding
+            break
+
+    headers = {
+        'ETag': f'"{snapshot_key(version)}-{endpoint}-{content_encoding or "identity"}"',
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding'
+    }
+    if etag_matches(request, headers['ETag']):
+        return Response(status_code=304, headers=headers)
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    return FileResponse(path, media_type='application/json', headers=headers)
+
+async def snapshot_or_cached_response(request: Request, endpoint: str, build) -> Response:
+    response = snapshot_response(request, endpoint)
+    if response is None:
+        response = await cached_json_response(request, endpoint, build)
+    return response
+
+class ListQuery(NamedTuple):
+    # A list endpoint that can be paged by its unique sort key, filtered by
+    # equality on whitelisted columns (query parameter -> column) and streamed
+    source: str
+    columns: tuple
+    keys: tuple
+    filters: dict
+    to_dict: object
+
+def hub_row(row) -> dict:
+    return {
+        "stop_id": row[0], "stop_name": row[1], "stop_lat": float(row[2]) if row[2] else None,
+        "stop_lon": float(row[3]) if row[3] else None, "total_linhas": row[4],
+        "total_viagens": row[5], "linhas": row[6]
+    }
+
+LIST_QUERIES = {
+    'paragens': ListQuery(
+        'analytics.paragens_mapa', ('stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'area_geografica'),
+        ('stop_id',), {'area': 'area_geografica'}, paragem_row
+    ),
+    'linhas': ListQuery(
+        'analytics.linhas_dashboard',
+        ('route_id', 'route_short_name', 'route_long_name', 'route_desc', 'route_color', 'route_text_color', 'tipo_transporte'),
+        ('route_id',), {'tipo': 'tipo_transporte'}, linha_row
+    ),
+    'hubs-transferencia': ListQuery(
+        'analytics.hubs_transferencia', ('stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'total_linhas', 'total_viagens', 'linhas'),
+        ('stop_id',), {}, hub_row
+    ),
+    'quilometragem-linhas': ListQuery(
+        'analytics.quilometragem_linhas', ('route_id', 'route_short_name', 'route_long_name', 'total_shapes', 'km_medio', 'km_total'),
+        ('route_id',), {'route_id': 'route_id'}, quilometragem_row
+    ),
+    'frequencia-servico': ListQuery(
+        'analytics.frequencia_servico', ('route_id', 'route_short_name', 'route_long_name', 'hora', 'total_viagens', 'total_passagens'),
+        ('route_id', 'hora'), {'route_id': 'route_id', 'hora': 'hora'}, frequencia_row
+    ),
+}
+
+def encode_cursor(values) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(list(values))).rstrip(b'=').decode()
 
-def get_db_connection():
+def decode_cursor(cursor: str, keys: tuple) -> list:
     try:
-        return engine.connect()
+        values = orjson.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, orjson.JSONDecodeError):
+        values = None
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def list_sql(query: ListQuery, filters: dict, after: list, limit: int) -> tuple:
+    conditions, params = [], {}
+    for name, value in filters.items():
+        conditions.append(f"{query.filters[name]} = :filter_{name}")
+        params[f"filter_{name}"] = value
+    if after is not None:
+        # Row comparison continues right after the last key of the previous page
+        placeholders = ', '.join(f":after_{i}" for i in range(len(query.keys)))
+        conditions.append(f"({', '.join(query.keys)}) > ({placeholders})")
+        params.update({f"after_{i}": value for i, value in enumerate(after)})
+    sql = f"SELECT {', '.join(query.columns)} FROM {query.source}"
+    if conditions:
+        sql += f" WHERE {' AND '.join(conditions)}"
+    sql += f" ORDER BY {', '.join(query.keys)}"
+    if limit is not None:
+        sql += " LIMIT :limit"
+        params['limit'] = limit
+    return sql, params
+
+async def paged_list_response(endpoint: str, filters: dict, after: list, limit: int) -> Response:
+    query = LIST_QUERIES[endpoint]
+    # One extra row tells whether there is a next page without a count query
+    sql, params = list_sql(query, filters, after, limit + 1)
+    try:
+        rows = await fetch_rows(sql, params)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching {endpoint} page: {e}")
+
+    headers = {'Cache-Control': 'no-cache'}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        key_positions = [query.columns.index(key) for key in query.keys]
+        headers['X-Next-Cursor'] = encode_cursor(rows[-1][i] for i in key_positions)
+    payload = orjson.dumps([query.to_dict(row) for row in rows])
+    return Response(content=payload, media_type='application/json', headers=headers)
+
+async def stream_ndjson(endpoint: str, sql: str, params: dict):
+    to_dict = LIST_QUERIES[endpoint].to_dict
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text(f"SET LOCAL statement_timeout = {int(API_STATEMENT_TIMEOUT_MS)}"))
+            # Server-side cursor: rows are fetched in batches as the client reads them
+            result = await conn.stream(text(sql), params)
+            async for batch in result.partitions(API_STREAM_BATCH_ROWS):
+                yield b''.join(orjson.dumps(to_dict(row)) + b'\n' for row in batch)
     except SQLAlchemyError as e:
-        print(f"Database connection error: {e}")
-        raise HTTPException(status_code=500, detail="Database connection failed")
+        # Headers are already sent, so the stream just ends early
+        print(f"Database stream error for {endpoint}: {e}")
 
+def streamed_list_response(endpoint: str, filters: dict, after: list, limit: int) -> StreamingResponse:
+    sql, params = list_sql(LIST_QUERIES[endpoint], filters, after, limit)
+    return StreamingResponse(
+        stream_ndjson(endpoint, sql, params), media_type='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
-@api_router.get("/kpi", summary="Get Key Performance Indicators")
-async def get_kpi_data():
-    try:
-        with get_db_connection() as conn:
-            result = conn.execute(text("SELECT total_paragens, total_linhas, total_horarios, operadora, data_atualizacao FROM analytics.kpi_summary LIMIT 1"))
-            row = result.fetchone()
-            if row:
-                return {
-                    "total_paragens": row[0], "total_linhas": row[1], "total_horarios": row[2],
-                    "operadora": row[3], "data_atualizacao": row[4].isoformat() if row[4] else None, "cobertura": "100%"
-                }
-            return {"total_paragens": 0, "total_linhas": 0, "total_horarios": 0, "operadora": "N/A", "cobertura": "0%"}
+def wants_ndjson(request: Request, output_format: str) -> bool:
+    if output_format:
+        return output_format == 'ndjson'
+    return 'application/x-ndjson' in request.headers.get('accept', '')
+
+async def list_response(request: Request, endpoint: str, build, filters: dict, after: str, limit: int,
+                        output_format: str, snapshot: bool = True) -> Response:
+    # Without paging, filters or streaming this is the full (snapshot or cached) list
+    query = LIST_QUERIES[endpoint]
+    filters = {name: value for name, value in filters.items() if value is not None}
+    after_keys = decode_cursor(after, query.keys) if after is not None else None
+
+    if wants_ndjson(request, output_format):
+        return streamed_list_response(endpoint, filters, after_keys, limit)
+    if filters or after_keys is not None or limit is not None:
+        return await paged_list_response(endpoint, filters, after_keys, limit or API_PAGE_DEFAULT_LIMIT)
+    if snapshot:
+        return await snapshot_or_cached_response(request, endpoint, build)
+    return await cached_json_response(request, endpoint, build)
+
+async def query_snapshot_rows(endpoint: str) -> list:
+    sql, to_dict = SNAPSHOT_QUERIES[endpoint]
+    rows = await fetch_rows(sql)
+    return [to_dict(row) for row in rows]
+
+async def query_kpi():
+    try:
+        rows = await fetch_rows("SELECT total_paragens, total_linhas, total_horarios, operadora, data_atualizacao FROM analytics.kpi_summary LIMIT 1")
+        row = rows[0] if rows else None
+        if row:
+            return {
+                "total_paragens": row[0], "total_linhas": row[1], "total_horarios": row[2],
+                "operadora": row[3], "data_atualizacao": row[4].isoformat() if row[4] else None, "cobertura": "100%"
+            }
+        return {"total_paragens": 0, "total_linhas": 0, "total_horarios": 0, "operadora": "N/A", "cobertura": "0%"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching KPI data: {e}")
 
-@api_router.get("/paragens", summary="Get all stops for map display")
-async def get_paragens():
-    try:
-        with get_db_connection() as conn:
-            result = conn.execute(text("SELECT stop_id, stop_name, stop_lat, stop_lon, area_geografica FROM analytics.paragens_mapa WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL ORDER BY stop_name"))
-            return [
-                {
-                    "stop_id": row[0], "stop_name": row[1], "stop_lat": float(row[2]),
-                    "stop_lon": float(row[3]), "area_geografica": row[4]
-                } for row in result
-            ]
+@api_router.get("/kpi", summary="Get Key Performance Indicators")
+async def get_kpi_data(request: Request):
+    return await cached_json_response(request, "kpi", query_kpi)
+
+async def query_paragens():
+    try:
+        return await query_snapshot_rows("paragens")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching stops data: {e}")
 
-@api_router.get("/linhas", summary="Get all routes")
-async def get_linhas():
-    try:
-        with get_db_connection() as conn:
-            result = conn.execute(text("SELECT route_id, route_short_name, route_long_name, route_desc, route_color, route_text_color, tipo_transporte FROM analytics.linhas_dashboard ORDER BY route_short_name"))
-            return [
-                {
-                    "route_id": row[0], "route_short_name": row[1], "route_long_name": row[2],
-                    "route_desc": row[3], "route_color": row[4], "route_text_color": row[5],
-                    "tipo_transporte": row[6]
-                } for row in result
-            ]
+@api_router.get("/paragens", summary="Get all stops for map display")
+async def get_paragens(
+    request: Request,
+    area: str = None,
+    after: str = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+    limit: int = Query(None, ge=1, le=API_PAGE_MAX_LIMIT),
+    output_format: str = Query(None, alias="format", pattern="^(json|ndjson)$")
+):
+    return await list_response(request, "paragens", query_paragens, {"area": area}, after, limit, output_format)
+
+# Search point as geography so distances and radii are in metres; inlined in
+# each query so the planner can use the GiST index for the <-> ordering
+SEARCH_POINT = "ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography"
+
+def stop_location_to_dict(row) -> dict:
+    return {
+        "stop_id": row[0], "stop_code": row[1], "stop_name": row[2],
+        "stop_lat": float(row[3]) if row[3] is not None else None,
+        "stop_lon": float(row[4]) if row[4] is not None else None
+    }
+
+async def query_paragens_nearby(lat: float, lon: float, radius: float, limit: int):
+    try:
+        rows = await fetch_rows(
+            f"""
+            SELECT stop_id, stop_code, stop_name, stop_lat, stop_lon, ST_Distance(geom::geography, {SEARCH_POINT}) AS distance_m
+            FROM raw.stops
+            WHERE ST_DWithin(geom::geography, {SEARCH_POINT}, :radius)
+            ORDER BY geom::geography <-> {SEARCH_POINT}
+            LIMIT :limit
+            """,
+            {"lat": lat, "lon": lon, "radius": radius, "limit": limit}
+        )
+        return [{**stop_location_to_dict(row), "distance_m": round(float(row[5]), 1)} for row in rows]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching nearby stops: {e}")
+
+@api_router.get("/paragens/nearby", summary="Get the stops closest to a point")
+async def get_paragens_nearby(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius: float = Query(500, gt=0, le=5000, description="Search radius in metres"),
+    limit: int = Query(20, ge=1, le=100)
+):
+    payload = await query_paragens_nearby(lat, lon, radius, limit)
+    return Response(content=orjson.dumps(payload), media_type='application/json')
+
+async def query_paragens_bbox(min_lat: float, min_lon: float, max_lat: float, max_lon: float, limit: int):
+    try:
+        # && uses the geometry index; stops nearest the box centre come first when truncated
+        rows = await fetch_rows(
+            """
+            SELECT stop_id, stop_code, stop_name, stop_lat, stop_lon
+            FROM raw.stops
+            WHERE geom && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)
+            ORDER BY geom <-> ST_SetSRID(ST_MakePoint(:center_lon, :center_lat), 4326)
+            LIMIT :limit
+            """,
+            {
+                "min_lat": min_lat, "min_lon": min_lon, "max_lat": max_lat, "max_lon": max_lon,
+                "center_lat": (min_lat + max_lat) / 2, "center_lon": (min_lon + max_lon) / 2, "limit": limit
+            }
+        )
+        return [stop_location_to_dict(row) for row in rows]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching stops in area: {e}")
+
+@api_router.get("/paragens/bbox", summary="Get the stops inside a bounding box")
+async def get_paragens_bbox(
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    limit: int = Query(500, ge=1, le=5000)
+):
+    if min_lat >= max_lat or min_lon >= max_lon:
+        raise HTTPException(status_code=400, detail="Bounding box minimums must be below its maximums")
+    payload = await query_paragens_bbox(min_lat, min_lon, max_lat, max_lon, limit)
+    return Response(content=orjson.dumps(payload), media_type='application/json')
+
+async def query_distribuicao_geografica():
+    try:
+        rows = await fetch_rows("SELECT zona, total_paragens FROM analytics.distribuicao_geografica ORDER BY total_paragens DESC")
+        return [{"zona": row[0], "total_paragens": row[1]} for row in rows]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching stop distribution data: {e}")
+
+@api_router.get("/distribuicao-geografica", summary="Get stop counts per area")
+async def get_distribuicao_geografica(request: Request):
+    return await cached_json_response(request, "distribuicao-geografica", query_distribuicao_geografica)
+
+@api_router.get("/fleet-status", summary="Get the live fleet status")
+async def get_fleet_status(request: Request):
+    # Served from the poller's latest snapshot; only a cold start waits for the broker
+    snapshot = fleet_poller.snapshot
+    if snapshot is None:
+        # While the poller is backing off, requests do not add load on the broker
+        if fleet_poller.last_error:
+            raise HTTPException(status_code=503, detail=f"Fleet status is not available yet: {fleet_poller.last_error}")
+        try:
+            snapshot = await fleet_poller.refresh()
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Fleet status is not available yet: {e}")
+
+    age = snapshot.age()
+    headers = {
+        'ETag': snapshot.etag,
+        'Cache-Control': 'no-cache',
+        'Age': str(int(age)),
+        'X-Fleet-Stale': 'true' if age > FLEET_STALE_SECONDS else 'false',
+    }
+    if etag_matches(request, snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type='application/json', headers=headers)
+
+def feed_local_time(at):
+    feed_zone = ZoneInfo(FEED_TIMEZONE)
+    if at is None:
+        return datetime.now(feed_zone).replace(tzinfo=None)
+    if at.tzinfo is not None:
+        return at.astimezone(feed_zone).replace(tzinfo=None)
+    return at
+
+@api_router.get("/paragens/{stop_id}/partidas", summary="Get the next departures from a stop")
+async def get_partidas(
+    stop_id: str,
+    at: datetime = Query(None, description="Local time to look from (ISO 8601); defaults to now"),
+    limit: int = Query(10, ge=1, le=100)
+):
+    index = departure_board.index
+    if index is None:
+        raise HTTPException(status_code=503, detail="Departure index is still loading")
+
+    at = feed_local_time(at)
+    departures = index.next_departures(stop_id, at, limit)
+    if departures is None:
+        raise HTTPException(status_code=404, detail=f"Unknown stop {stop_id}")
+    payload = {"stop_id": stop_id, "at": at.isoformat(timespec='seconds'), "partidas": departures}
+    return Response(content=orjson.dumps(payload), media_type='application/json')
+
+@api_router.get("/viagem", summary="Plan a journey between two stops")
+async def get_viagem(
+    origin: str = Query(..., alias="from", description="Origin stop_id"),
+    destination: str = Query(..., alias="to", description="Destination stop_id"),
+    at: datetime = Query(None, description="Local departure time (ISO 8601); defaults to now")
+):
+    timetable = journey_planner.index
+    if timetable is None:
+        raise HTTPException(status_code=503, detail="Journey planner is still loading")
+    for stop_id in (origin, destination):
+        if stop_id not in timetable.stop_positions:
+            raise HTTPException(status_code=404, detail=f"Unknown stop {stop_id}")
+
+    at = feed_local_time(at)
+    journey = await asyncio.to_thread(timetable.plan, origin, destination, at)
+    if journey is None:
+        raise HTTPException(status_code=404, detail=f"No journey from {origin} to {destination} on {at.date()}")
+    payload = {"from": origin, "to": destination, "at": at.isoformat(timespec='seconds'), "viagem": journey}
+    return Response(content=orjson.dumps(payload), media_type='application/json')
+
+async def query_servicos(service_date: date):
+    try:
+        rows = await fetch_rows(
+            """
+            SELECT sd.service_id, COUNT(t.trip_id) AS total_viagens, COUNT(DISTINCT t.route_id) AS total_linhas
+            FROM raw.service_dates sd
+            LEFT JOIN raw.trips t ON sd.service_id = t.service_id
+            WHERE sd.date = :service_date
+            GROUP BY sd.service_id
+            ORDER BY sd.service_id
+            """,
+            {"service_date": service_date}
+        )
+        servicos = [{"service_id": row[0], "total_viagens": row[1], "total_linhas": row[2]} for row in rows]
+        return {
+            "data": service_date.isoformat(),
+            "total_viagens": sum(servico["total_viagens"] for servico in servicos),
+            "servicos": servicos
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching services for {service_date}: {e}")
+
+@api_router.get("/servicos", summary="Get the services running on a date")
+async def get_servicos(data: date = Query(None, description="Service date (YYYY-MM-DD); defaults to today")):
+    service_date = data or datetime.now(ZoneInfo(FEED_TIMEZONE)).date()
+    payload = await query_servicos(service_date)
+    return Response(content=orjson.dumps(payload), media_type='application/json')
+
+async def query_linhas():
+    try:
+        return await query_snapshot_rows("linhas")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching routes data: {e}")
 
-@api_router.get("/top-stops", summary="Get top 10 busiest stops")
-async def get_top_stops():
-    try:
-        with get_db_connection() as conn:
-            result = conn.execute(text("SELECT stop_id, stop_name, stop_lat, stop_lon, total_horarios FROM analytics.top_paragens_horarios ORDER BY total_horarios DESC LIMIT 10"))
-            return [
-                {
-                    "stop_id": row[0], "stop_name": row[1], "stop_lat": float(row[2]) if row[2] else None,
-                    "stop_lon": float(row[3]) if row[3] else None, "total_horarios": row[4]
-                } for row in result
-            ]
+@api_router.get("/linhas", summary="Get all routes")
+async def get_linhas(
+    request: Request,
+    tipo: str = None,
+    after: str = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+    limit: int = Query(None, ge=1, le=API_PAGE_MAX_LIMIT),
+    output_format: str = Query(None, alias="format", pattern="^(json|ndjson)$")
+):
+    return await list_response(request, "linhas", query_linhas, {"tipo": tipo}, after, limit, output_format)
+
+async def query_top_stops():
+    try:
+        rows = await fetch_rows("SELECT stop_id, stop_name, stop_lat, stop_lon, total_horarios FROM analytics.top_paragens_horarios ORDER BY total_horarios DESC LIMIT 10")
+        return [
+            {
+                "stop_id": row[0], "stop_name": row[1], "stop_lat": float(row[2]) if row[2] else None,
+                "stop_lon": float(row[3]) if row[3] else None, "total_horarios": row[4]
+            } for row in rows
+        ]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching top stops data: {e}")
 
-@api_router.get("/hubs-transferencia", summary="Get main transfer hubs")
-async def get_hubs_transferencia():
-    try:
-        with get_db_connection() as conn:
-            result = conn.execute(text("SELECT stop_id, stop_name, stop_lat, stop_lon, total_linhas, total_viagens, linhas FROM analytics.hubs_transferencia ORDER BY total_linhas DESC"))
-            return [
-                {
-                    "stop_id": row[0], "stop_name": row[1], "stop_lat": float(row[2]) if row[2] else None,
-                    "stop_lon": float(row[3]) if row[3] else None, "total_linhas": row[4],
-                    "total_viagens": row[5], "linhas": row[6]
-                } for row in result
-            ]
+@api_router.get("/top-stops", summary="Get top 10 busiest stops")
+async def get_top_stops(request: Request):
+    return await cached_json_response(request, "top-stops", query_top_stops)
+
+async def query_hubs_transferencia():
+    try:
+        rows = await fetch_rows("SELECT stop_id, stop_name, stop_lat, stop_lon, total_linhas, total_viagens, linhas FROM analytics.hubs_transferencia ORDER BY total_linhas DESC")
+        return [hub_row(row) for row in rows]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching transfer hubs data: {e}")
 
-@api_router.get("/quilometragem-linhas", summary="Get route distances")
-async def get_quilometragem_linhas():
-    try:
-        with get_db_connection() as conn:
-            result = conn.execute(text("SELECT route_id, route_short_name, route_long_name, total_shapes, km_medio, km_total FROM analytics.quilometragem_linhas ORDER BY km_total DESC"))
-            return [
-                {
-                    "route_id": row[0], "route_short_name": row[1], "route_long_name": row[2],
-                    "total_shapes": row[3], "km_medio": float(row[4]) if row[4] else 0,
-                    "km_total": float(row[5]) if row[5] else 0
-                } for row in result
-            ]
+@api_router.get("/hubs-transferencia", summary="Get main transfer hubs")
+async def get_hubs_transferencia(
+    request: Request,
+    after: str = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+    limit: int = Query(None, ge=1, le=API_PAGE_MAX_LIMIT),
+    output_format: str = Query(None, alias="format", pattern="^(json|ndjson)$")
+):
+    return await list_response(
+        request, "hubs-transferencia", query_hubs_transferencia, {}, after, limit, output_format, snapshot=False
+    )
+
+async def query_quilometragem_linhas():
+    try:
+        return await query_snapshot_rows("quilometragem-linhas")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching route distance data: {e}")
 
-@api_router.get("/frequencia-servico", summary="Get service frequency")
-async def get_frequencia_servico():
-    try:
-        with get_db_connection() as conn:
-            result = conn.execute(text("SELECT route_id, route_short_name, route_long_name, hora, total_viagens, total_passagens FROM analytics.frequencia_servico ORDER BY route_short_name, hora"))
-            return [
-                {
-                    "route_id": row[0], "route_short_name": row[1], "route_long_name": row[2],
-                    "hora": row[3], "total_viagens": row[4], "total_passagens": row[5]
-                } for row in result
-            ]
+@api_router.get("/quilometragem-linhas", summary="Get route distances")
+async def get_quilometragem_linhas(
+    request: Request,
+    route_id: str = None,
+    after: str = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+    limit: int = Query(None, ge=1, le=API_PAGE_MAX_LIMIT),
+    output_format: str = Query(None, alias="format", pattern="^(json|ndjson)$")
+):
+    return await list_response(
+        request, "quilometragem-linhas", query_quilometragem_linhas, {"route_id": route_id}, after, limit, output_format
+    )
+
+async def query_frequencia_servico():
+    try:
+        return await query_snapshot_rows("frequencia-servico")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching service frequency data: {e}")
 
+@api_router.get("/frequencia-servico", summary="Get service frequency")
+async def get_frequencia_servico(
+    request: Request,
+    route_id: str = None,
+    hora: int = Query(None, ge=0, le=23),
+    after: str = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+    limit: int = Query(None, ge=1, le=API_PAGE_MAX_LIMIT),
+    output_format: str = Query(None, alias="format", pattern="^(json|ndjson)$")
+):
+    return await list_response(
+        request, "frequencia-servico", query_frequencia_servico, {"route_id": route_id, "hora": hora},
+        after, limit, output_format
+    )
+
+# Web Mercator extent of a tile, and the size of one of its 4096 grid cells at zoom 0
+TILE_EXTENT = 4096
+WORLD_SIZE_M = 40075016.686
+
+def tile_simplify_tolerance(z: int) -> float:
+    # Half a tile pixel: detail below that is invisible at this zoom
+    return WORLD_SIZE_M / (2 ** z) / TILE_EXTENT / 2
+
+async def query_tile(z: int, x: int, y: int) -> bytes:
+    try:
+        rows = await fetch_rows(
+            f"""
+            WITH shapes AS (
+                SELECT shape_id, route_short_name, route_color,
+                       ST_AsMVTGeom(ST_Simplify(geom, :tolerance), ST_TileEnvelope(:z, :x, :y), {TILE_EXTENT}, 64, true) AS geom
+                FROM analytics.shape_lines
+                WHERE geom && ST_TileEnvelope(:z, :x, :y)
+            ), stops AS (
+                SELECT stop_id, stop_name, area_geografica,
+                       ST_AsMVTGeom(ST_Transform(geom, 3857), ST_TileEnvelope(:z, :x, :y), {TILE_EXTENT}, 64, true) AS geom
+                FROM analytics.paragens_mapa
+                WHERE :with_stops AND geom && ST_Transform(ST_TileEnvelope(:z, :x, :y), 4326)
+            )
+            SELECT COALESCE((SELECT ST_AsMVT(shapes, 'shapes', {TILE_EXTENT}, 'geom') FROM shapes WHERE geom IS NOT NULL), ''::bytea)
+                || COALESCE((SELECT ST_AsMVT(stops, 'stops', {TILE_EXTENT}, 'geom') FROM stops WHERE geom IS NOT NULL), ''::bytea)
+            """,
+            {"z": z, "x": x, "y": y, "tolerance": tile_simplify_tolerance(z), "with_stops": z >= TILE_STOPS_MIN_ZOOM}
+        )
+        return bytes(rows[0][0]) if rows and rows[0][0] else b''
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rendering tile {z}/{x}/{y}: {e}")
+
+@api_router.get("/tiles/{z}/{x}/{y}.mvt", summary="Get a vector tile of stops and route shapes")
+async def get_tile(request: Request, z: int, x: int, y: int):
+    if not 0 <= z <= 22 or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise HTTPException(status_code=404, detail="Tile out of range")
+
+    cached = tile_cache.get((z, x, y))
+    if cached is None:
+        version = tile_cache.version
+        cached = tile_cache.put((z, x, y), version, await query_tile(z, x, y))
+
+    body, etag = cached
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/vnd.mapbox-vector-tile', headers=headers)
+
 app.include_router(api_router)
 
 dashboard_dir = Path(__file__).parent / "dashboard"
@@ -1,45 +1,68 @@
 #!/usr/bin/env python3
 
+import argparse
+import json
 import os
+import random
+import signal
 import sys
-import subprocess
-import requests
-from bs4 import BeautifulSoup
+import threading
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 import re
 
+from config import (
+    DATA_BASE_PATH, UPDATE_CHECK_INTERVAL_SECONDS, UPDATE_CHECK_JITTER_SECONDS,
+    UPDATE_STATUS_HOST, UPDATE_STATUS_PORT, UPDATE_STATUS_FILE_NAME
+)
+from download_gtfs import scrape_latest_gtfs_resource
+
 def log_message(message):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {message}")
+    print(f"[{timestamp}] {message}", flush=True)
 
-def get_current_date_from_site():
-    try:
-        log_message("Checking available data")
-        main_page_url = "https://opendata.porto.digital/dataset/horarios-paragens-e-rotas-em-formato-gtfs-stcp"
-        
-        response = requests.get(main_page_url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'lxml')
-        
-        resource_link_tag = soup.find('a', title=lambda t: t and 'Mais Recente' in t)
-        if not resource_link_tag:
-            raise Exception("Dataset link not found")
-        
-        title = resource_link_tag.get('title', '')
-        log_message(f"Dataset: {title}")
-        
-        date_match = re.search(r'GTFS STCP (\d{2}-\d{2}-\d{4})', title)
-        if not date_match:
-            raise Exception(f"Invalid date format: {title}")
-        
-        site_date = date_match.group(1)
-        log_message(f"Available date: {site_date}")
-        return site_date
-        
-    except Exception as e:
-        log_message(f"Error checking dataset: {e}")
-        sys.exit(1)
+def now_iso():
+    return datetime.now().isoformat(timespec='seconds')
+
+class UpdateStatus:
+    # Last check and last load, written to a JSON file and served by the daemon
+
+    def __init__(self, file_path, mode):
+        self.file_path = Path(file_path)
+        self.lock = threading.Lock()
+        self.state = {'mode': mode, 'started_at': now_iso(), 'last_check': None, 'last_load': None, 'next_check_at': None}
+
+    def update(self, **fields):
+        with self.lock:
+            self.state.update(fields)
+            body = json.dumps(self.state, indent=2)
+        try:
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.file_path.with_name(f"{self.file_path.name}.tmp")
+            tmp_path.write_text(body)
+            os.replace(tmp_path, self.file_path)
+        except OSError as e:
+            log_message(f"Error writing status file: {e}")
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps(self.state).encode()
+
+def get_current_release_from_site():
+    log_message("Checking available data")
+    resource = scrape_latest_gtfs_resource()
+
+    title = resource['title']
+    log_message(f"Dataset: {title}")
+
+    date_match = re.search(r'GTFS STCP (\d{2}-\d{2}-\d{4})', title)
+    if not date_match:
+        raise Exception(f"Invalid date format: {title}")
+
+    site_date = date_match.group(1)
+    log_message(f"Available date: {site_date}")
+    return site_date, resource['url']
 
 def get_last_processed_date(file_path):
     try:
@@ -66,7 +89,7 @@ def save_date(date_str, file_path):
 def compare_dates(site_date, last_date):
     if last_date is None:
         return True
-    
+
     try:
         site_dt = datetime.strptime(site_date, "%d-%m-%Y")
         last_dt = datetime.strptime(last_date, "%d-%m-%Y")
@@ -75,49 +98,115 @@ def compare_dates(site_date, last_date):
         log_message(f"Error comparing dates: {e}")
         return True
 
-def run_pipeline():
+def run_pipeline(gtfs_url):
     try:
         log_message("Executing ETL pipeline")
-        result = subprocess.run([sys.executable, 'main_pipeline.py'], 
-                              capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            log_message("Pipeline completed successfully")
-            return True
-        else:
-            log_message(f"Pipeline failed: {result.stderr}")
-            return False
-            
+        # Imported on first use so an up-to-date check stays cheap; a daemon keeps
+        # pandas, Prefect, the pipelines and the DB engine loaded between runs
+        from main_pipeline import master_etl_flow
+        # The download URL was already scraped here, so the pipeline skips the portal
+        master_etl_flow(gtfs_url=gtfs_url)
+        log_message("Pipeline completed successfully")
+        return True
     except Exception as e:
-        log_message(f"Execution error: {e}")
+        log_message(f"Pipeline failed: {e}")
         return False
 
+def check_and_update(last_update_file, status):
+    # Returns False only when a new release was found and failed to load
+    try:
+        site_date, gtfs_url = get_current_release_from_site()
+    except Exception as e:
+        log_message(f"Error checking dataset: {e}")
+        status.update(last_check={'at': now_iso(), 'result': 'error', 'error': str(e)})
+        return False
+
+    last_date = get_last_processed_date(last_update_file)
+    if not compare_dates(site_date, last_date):
+        log_message("System up to date")
+        status.update(last_check={'at': now_iso(), 'result': 'up_to_date', 'site_date': site_date})
+        return True
+
+    if last_date is None:
+        log_message("Running initial setup")
+    else:
+        log_message(f"New version detected: {site_date}")
+    status.update(
+        last_check={'at': now_iso(), 'result': 'new_version', 'site_date': site_date},
+        last_load={'started_at': now_iso(), 'site_date': site_date, 'url': gtfs_url, 'result': 'running'}
+    )
+
+    if run_pipeline(gtfs_url):
+        save_date(site_date, last_update_file)
+        log_message("Process completed")
+        result = 'success'
+    else:
+        log_message("Process interrupted due to failures")
+        result = 'failed'
+    status.update(last_load={**status.state['last_load'], 'finished_at': now_iso(), 'result': result})
+    return result == 'success'
+
+def start_status_server(status, host, port):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/status'):
+                self.send_error(404)
+                return
+            body = status.to_json()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    threading.Thread(target=server.serve_forever, name='status-server', daemon=True).start()
+    log_message(f"Status endpoint listening on {host}:{port}")
+    return server
+
+def run_daemon(last_update_file, status, interval, jitter):
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    server = start_status_server(status, UPDATE_STATUS_HOST, UPDATE_STATUS_PORT) if UPDATE_STATUS_PORT else None
+    log_message(f"Update daemon started, checking every {interval:.0f}s (+ up to {jitter:.0f}s jitter)")
+    try:
+        while not stop.is_set():
+            check_and_update(last_update_file, status)
+            # Jitter keeps several deployments from hitting the portal at the same moment
+            delay = interval + random.uniform(0, jitter)
+            status.update(next_check_at=datetime.fromtimestamp(datetime.now().timestamp() + delay).isoformat(timespec='seconds'))
+            log_message(f"Next check in {delay:.0f}s")
+            stop.wait(delay)
+    finally:
+        if server:
+            server.shutdown()
+        log_message("Update daemon stopped")
+
 def main():
+    parser = argparse.ArgumentParser(description="Load the STCP GTFS feed when a new release is published")
+    parser.add_argument('--daemon', action='store_true', help="Keep running and check on a schedule")
+    parser.add_argument('--interval', type=float, default=UPDATE_CHECK_INTERVAL_SECONDS, help="Seconds between checks in daemon mode")
+    parser.add_argument('--jitter', type=float, default=UPDATE_CHECK_JITTER_SECONDS, help="Random extra delay added to each interval")
+    args = parser.parse_args()
+
     script_dir = Path(__file__).parent
     os.chdir(script_dir)
-    
+
     last_update_file = script_dir / "last_update.txt"
-    
+    status = UpdateStatus(script_dir / DATA_BASE_PATH / UPDATE_STATUS_FILE_NAME, 'daemon' if args.daemon else 'once')
+
+    if args.daemon:
+        run_daemon(last_update_file, status, args.interval, args.jitter)
+        return
+
     log_message("Starting update check")
-    
-    site_date = get_current_date_from_site()
-    last_date = get_last_processed_date(last_update_file)
-    
-    if compare_dates(site_date, last_date):
-        if last_date is None:
-            log_message("Running initial setup")
-        else:
-            log_message(f"New version detected: {site_date}")
-        
-        if run_pipeline():
-            save_date(site_date, last_update_file)
-            log_message("Process completed")
-        else:
-            log_message("Process interrupted due to failures")
-            sys.exit(1)
-    else:
-        log_message("System up to date")
-        sys.exit(0)
+    if not check_and_update(last_update_file, status):
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
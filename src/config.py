@@ -17,5 +17,102 @@ if not DB_PASSWORD:
     sys.exit(1)
 
 DATABASE_URL = f"postgresql://{DB_USER}:{quote_plus(DB_PASSWORD)}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{quote_plus(DB_PASSWORD)}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 DATA_BASE_PATH = os.getenv('DATA_BASE_PATH', 'data')
 ZIP_FILE_NAME = os.getenv('ZIP_FILE_NAME', 'gtfs_data.zip')
+
+# Number of rows serialised into each in-memory CSV buffer sent with COPY
+COPY_BUFFER_ROWS = int(os.getenv('COPY_BUFFER_ROWS', '100000'))
+
+# stop_times.txt is extracted, transformed and loaded chunk by chunk when streaming is on
+STOP_TIMES_STREAMING = os.getenv('STOP_TIMES_STREAMING', 'true').lower() in ('1', 'true', 'yes')
+STOP_TIMES_CHUNK_SIZE = int(os.getenv('STOP_TIMES_CHUNK_SIZE', '250000'))
+
+# 'shadow' loads into staging schemas that are swapped in atomically at the end of the run,
+# 'full' replaces each raw table in place, 'diff' applies only the rows that changed in place
+LOAD_MODE = os.getenv('LOAD_MODE', 'shadow').lower()
+
+# How often the API checks whether a new feed load has replaced the cached responses
+DATASET_VERSION_POLL_SECONDS = float(os.getenv('DATASET_VERSION_POLL_SECONDS', '15'))
+
+# API connection pool (async driver) and per-query limits
+API_DB_POOL_SIZE = int(os.getenv('API_DB_POOL_SIZE', '5'))
+API_DB_MAX_OVERFLOW = int(os.getenv('API_DB_MAX_OVERFLOW', '5'))
+API_DB_POOL_TIMEOUT = float(os.getenv('API_DB_POOL_TIMEOUT', '10'))
+API_DB_CONNECT_TIMEOUT = float(os.getenv('API_DB_CONNECT_TIMEOUT', '5'))
+API_STATEMENT_TIMEOUT_MS = int(os.getenv('API_STATEMENT_TIMEOUT_MS', '5000'))
+
+# List endpoints: keyset page sizes and how many rows an NDJSON stream fetches per round trip
+API_PAGE_DEFAULT_LIMIT = int(os.getenv('API_PAGE_DEFAULT_LIMIT', '500'))
+API_PAGE_MAX_LIMIT = int(os.getenv('API_PAGE_MAX_LIMIT', '5000'))
+API_STREAM_BATCH_ROWS = int(os.getenv('API_STREAM_BATCH_ROWS', '1000'))
+
+# Departure boards: the feed's local time zone
+FEED_TIMEZONE = os.getenv('FEED_TIMEZONE', 'Europe/Lisbon')
+
+# In-memory indexes (departure board, journey planner, shape index): how long
+# building one from the database may take when the ETL has no snapshot for it
+INDEX_LOAD_TIMEOUT_MS = int(os.getenv('INDEX_LOAD_TIMEOUT_MS', '120000'))
+
+# Journey planner: most vehicle changes searched, walking between nearby stops and the time kept for a change
+JOURNEY_MAX_TRANSFERS = int(os.getenv('JOURNEY_MAX_TRANSFERS', '4'))
+JOURNEY_WALK_RADIUS_M = float(os.getenv('JOURNEY_WALK_RADIUS_M', '400'))
+JOURNEY_WALK_SPEED_MPS = float(os.getenv('JOURNEY_WALK_SPEED_MPS', '1.2'))
+JOURNEY_TRANSFER_SLACK_SECS = int(os.getenv('JOURNEY_TRANSFER_SLACK_SECS', '60'))
+
+# Live fleet: one background poller per API process pages through the FIWARE broker and
+# every request is served from its latest snapshot
+FIWARE_BROKER_URL = os.getenv('FIWARE_BROKER_URL', 'https://broker.fiware.urbanplatform.portodigital.pt')
+FLEET_POLL_SECONDS = float(os.getenv('FLEET_POLL_SECONDS', '10'))
+FLEET_REQUEST_TIMEOUT = float(os.getenv('FLEET_REQUEST_TIMEOUT', '10'))
+FLEET_PAGE_LIMIT = int(os.getenv('FLEET_PAGE_LIMIT', '1000'))
+FLEET_BACKOFF_MAX_SECONDS = float(os.getenv('FLEET_BACKOFF_MAX_SECONDS', '300'))
+FLEET_STALE_SECONDS = float(os.getenv('FLEET_STALE_SECONDS', '60'))
+
+# Polled positions are buffered and written with COPY into daily partitions kept for the retention period
+POSITION_STORE = os.getenv('POSITION_STORE', 'true').lower() in ('1', 'true', 'yes')
+POSITION_FLUSH_SECONDS = float(os.getenv('POSITION_FLUSH_SECONDS', '60'))
+POSITION_BUFFER_MAX_ROWS = int(os.getenv('POSITION_BUFFER_MAX_ROWS', '500000'))
+POSITION_RETENTION_DAYS = int(os.getenv('POSITION_RETENTION_DAYS', '30'))
+
+# Map matching: grid cell size of the per-shape segment index and the farthest a vehicle is snapped
+MAP_MATCH_GRID_CELL_M = float(os.getenv('MAP_MATCH_GRID_CELL_M', '150'))
+MAP_MATCH_MAX_DISTANCE_M = float(os.getenv('MAP_MATCH_MAX_DISTANCE_M', '100'))
+
+# Vector tiles are rendered on first request and kept in memory for the current dataset version
+TILE_CACHE_MAX_BYTES = int(os.getenv('TILE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+TILE_STOPS_MIN_ZOOM = int(os.getenv('TILE_STOPS_MIN_ZOOM', '12'))
+
+# Pre-rendered API payloads written at the end of each load (shared with the API and nginx)
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), DATA_BASE_PATH, 'snapshots'))
+SNAPSHOT_KEEP_VERSIONS = int(os.getenv('SNAPSHOT_KEEP_VERSIONS', '3'))
+
+# The nine GTFS pipelines run in separate processes; loads share a bounded set of DB connections
+ETL_PARALLEL = os.getenv('ETL_PARALLEL', 'true').lower() in ('1', 'true', 'yes')
+ETL_MAX_WORKERS = int(os.getenv('ETL_MAX_WORKERS', str(min(9, os.cpu_count() or 1))))
+ETL_DB_CONNECTIONS = int(os.getenv('ETL_DB_CONNECTIONS', '4'))
+
+# GTFS members are read straight from the ZIP; stored (uncompressed) members can be memory-mapped
+GTFS_ZIP_MMAP = os.getenv('GTFS_ZIP_MMAP', 'true').lower() in ('1', 'true', 'yes')
+
+# GTFS download: portal page, request timeouts (seconds), write buffer and the state kept between runs
+GTFS_PORTAL_URL = os.getenv('GTFS_PORTAL_URL', 'https://opendata.porto.digital')
+GTFS_DATASET_PATH = os.getenv('GTFS_DATASET_PATH', '/dataset/horarios-paragens-e-rotas-em-formato-gtfs-stcp')
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv('DOWNLOAD_CONNECT_TIMEOUT', '10'))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv('DOWNLOAD_READ_TIMEOUT', '60'))
+DOWNLOAD_CHUNK_BYTES = int(os.getenv('DOWNLOAD_CHUNK_BYTES', str(1024 * 1024)))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '3'))
+FEED_STATE_FILE_NAME = os.getenv('FEED_STATE_FILE_NAME', 'feed_state.json')
+
+# Resident update daemon (check_and_update.py --daemon): schedule, random jitter and status endpoint (0 disables it)
+UPDATE_CHECK_INTERVAL_SECONDS = float(os.getenv('UPDATE_CHECK_INTERVAL_SECONDS', '21600'))
+UPDATE_CHECK_JITTER_SECONDS = float(os.getenv('UPDATE_CHECK_JITTER_SECONDS', '600'))
+# Loopback only by default: the status endpoint has no authentication
+UPDATE_STATUS_HOST = os.getenv('UPDATE_STATUS_HOST', '127.0.0.1')
+UPDATE_STATUS_PORT = int(os.getenv('UPDATE_STATUS_PORT', '8001'))
+UPDATE_STATUS_FILE_NAME = os.getenv('UPDATE_STATUS_FILE_NAME', 'update_status.json')
+
+# Typed extract results cached as Parquet per feed version (SHA-256 of the archive), bounded in total size
+PARQUET_CACHE = os.getenv('PARQUET_CACHE', 'true').lower() in ('1', 'true', 'yes')
+PARQUET_CACHE_DIR = os.getenv('PARQUET_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), DATA_BASE_PATH, 'parquet_cache'))
+PARQUET_CACHE_MAX_BYTES = int(os.getenv('PARQUET_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
@@ -6,7 +6,8 @@ class STCPDashboard {
         this.refreshInterval = 300000;
         this.accentColor = '#2563eb';
         this.fontFamily = "'Inter', -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif";
-        this.markerClusterGroup = null;
+        this.stopsLayer = null;
+        this.dataVersion = null;
         this.theme = localStorage.getItem('theme') || 'light';
         this.init();
     }
@@ -107,6 +108,8 @@ class STCPDashboard {
                     position: 'topright'
                 }).addTo(this.map);
 
+                this.initStopsLayer();
+
                 setTimeout(() => {
                     this.map.invalidateSize();
                 }, 500);
@@ -148,7 +151,7 @@ class STCPDashboard {
         try {
             this.updateStatus('loading');
             const endpoints = [
-                'kpi', 'paragens', 'linhas', 'top-stops',
+                'kpi', 'distribuicao-geografica', 'linhas', 'top-stops',
                 'hubs-transferencia', 'quilometragem-linhas', 'frequencia-servico'
             ];
             const requests = endpoints.map(ep => fetch(`${this.apiBase}/${ep}`).then(res => {
@@ -156,18 +159,18 @@ class STCPDashboard {
                 return res.json();
             }));
 
-            const [kpi, paragens, linhas, topStops, hubs, distance, frequency] = await Promise.all(requests);
+            const [kpi, zones, linhas, topStops, hubs, distance, frequency] = await Promise.all(requests);
 
             this.updateKPIs(kpi);
-            this.updateMap(paragens);
+            this.updateMap(kpi.data_atualizacao);
             this.updateRoutes(linhas);
             this.updateTopStops(topStops);
             this.updateHubs(hubs);
-            this.updateZoneChart(paragens);
+            this.updateZoneChart(zones);
             this.updateDistanceChart(distance);
             this.updateFrequencyChart(frequency);
 
-            document.getElementById('map-stops-count').textContent = paragens.length.toLocaleString();
+            document.getElementById('map-stops-count').textContent = kpi.total_paragens?.toLocaleString() || '--';
             document.getElementById('routes-count').textContent = linhas.length.toLocaleString();
 
             if (this.map) {
@@ -206,19 +209,8 @@ class STCPDashboard {
         });
     }
 
-    updateMap(paragens) {
-        if (this.markerClusterGroup) {
-            this.map.removeLayer(this.markerClusterGroup);
-        }
-
-        this.markerClusterGroup = L.markerClusterGroup({
-            chunkedLoading: true,
-            spiderfyOnMaxZoom: true,
-            showCoverageOnHover: false,
-            zoomToBoundsOnClick: true,
-            maxClusterRadius: 50
-        });
-
+    initStopsLayer() {
+        // Stops and route shapes come as vector tiles, so only the visible area is downloaded and drawn
         const radius = window.innerWidth >= 2560 ? 8 : 6;
 
         const zoneColors = {
@@ -230,19 +222,37 @@ class STCPDashboard {
             'default': '#64748b'
         };
 
-        paragens.forEach(paragem => {
-            if (paragem.stop_lat && paragem.stop_lon) {
-                const zone = paragem.area_geografica || 'default';
-                const color = zoneColors[zone] || zoneColors['default'];
-
-                const marker = L.circleMarker([paragem.stop_lat, paragem.stop_lon], {
+        this.stopsLayer = L.vectorGrid.protobuf(`${this.apiBase}/tiles/{z}/{x}/{y}.mvt`, {
+            rendererFactory: L.canvas.tile,
+            interactive: true,
+            maxNativeZoom: 18,
+            vectorTileLayerStyles: {
+                shapes: properties => ({
+                    color: properties.route_color ? `#${properties.route_color}` : this.accentColor,
+                    weight: 2,
+                    opacity: 0.6
+                }),
+                stops: properties => ({
                     radius: radius,
-                    fillColor: color,
+                    fill: true,
+                    fillColor: zoneColors[properties.area_geografica] || zoneColors['default'],
                     color: '#ffffff',
                     weight: 1.5,
                     opacity: 1,
                     fillOpacity: 0.8
-                }).bindPopup(`
+                })
+            }
+        });
+
+        this.stopsLayer.on('click', event => {
+            const paragem = event.layer.properties;
+            if (!paragem.stop_id) {
+                return;
+            }
+            const color = zoneColors[paragem.area_geografica] || zoneColors['default'];
+            L.popup()
+                .setLatLng(event.latlng)
+                .setContent(`
                     <div style="font-family: ${this.fontFamily};">
                         <h4 style="margin: 0 0 8px 0; color: ${color}; font-family: ${this.fontFamily}; font-weight: 600; font-size: 0.875rem;">${paragem.stop_name}</h4>
                         <p style="margin: 0; font-size: 0.75rem; color: #475569;">
@@ -250,13 +260,19 @@ class STCPDashboard {
                             <strong>ZONE:</strong> ${paragem.area_geografica || 'N/A'}
                         </p>
                     </div>
-                `);
-
-                this.markerClusterGroup.addLayer(marker);
-            }
+                `)
+                .openOn(this.map);
         });
 
-        this.map.addLayer(this.markerClusterGroup);
+        this.stopsLayer.addTo(this.map);
+    }
+
+    updateMap(version) {
+        // Tiles only change with a new feed load
+        if (this.stopsLayer && this.dataVersion !== null && version !== this.dataVersion) {
+            this.stopsLayer.redraw();
+        }
+        this.dataVersion = version;
     }
 
     updateRoutes(linhas) {
@@ -395,17 +411,11 @@ class STCPDashboard {
         this.charts[chartId] = new Chart(ctx, { type, data, options: mergedOptions });
     }
 
-    updateZoneChart(paragens) {
-        const zones = paragens.reduce((acc, paragem) => {
-            const zone = paragem.area_geografica || 'Other';
-            acc[zone] = (acc[zone] || 0) + 1;
-            return acc;
-        }, {});
-
+    updateZoneChart(zones) {
         this.createOrUpdateChart('zone-chart', 'doughnut', {
-            labels: Object.keys(zones),
+            labels: zones.map(zone => zone.zona || 'Other'),
             datasets: [{
-                data: Object.values(zones),
+                data: zones.map(zone => zone.total_paragens),
                 backgroundColor: this.getChartColors(),
                 borderWidth: 2,
                 borderColor: '#ffffff'
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import asyncio
+import io
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+DAY_SECONDS = 24 * 3600
+
+def gtfs_time(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+class ServiceCalendar:
+    # Which services run on a given date, from the per-service day bitmaps the
+    # ETL expands out of calendar.txt and calendar_dates.txt
+
+    def __init__(self, service_ids: list, start_date: date, active_days: np.ndarray):
+        self.codes = {service_id: code for code, service_id in enumerate(service_ids)}
+        self.start_date = start_date
+        # One extra False row at the end, so trips without a known service (-1) never match
+        self.active_days = np.vstack([active_days, np.zeros((1, active_days.shape[1]), dtype=bool)])
+
+    @classmethod
+    def from_bitmaps(cls, bitmaps: list) -> 'ServiceCalendar':
+        # (service_id, start_date, active_days as '0'/'1' text) rows of raw.service_bitmaps;
+        # all bitmaps share the feed's first day as bit 0
+        start_date = bitmaps[0][1] if bitmaps else None
+        bits = np.zeros((len(bitmaps), len(bitmaps[0][2]) if bitmaps else 0), dtype=bool)
+        for row, (_, _, active_days) in enumerate(bitmaps):
+            bits[row] = np.frombuffer(active_days.encode(), dtype=np.uint8) == ord('1')
+        return cls([row[0] for row in bitmaps], start_date, bits)
+
+    def active(self, service_date: date) -> np.ndarray:
+        day = (service_date - self.start_date).days if self.start_date else -1
+        if not 0 <= day < self.active_days.shape[1]:
+            return np.zeros(len(self.codes) + 1, dtype=bool)
+        return self.active_days[:, day]
+
+class DepartureIndex:
+    # Every stop's departures as one slice of arrays sorted by (stop, departure
+    # time): starts[i]:ends[i] holds the stop at position i (CSR layout)
+
+    def __init__(self, stop_ids: np.ndarray, starts: np.ndarray, ends: np.ndarray, departures: np.ndarray,
+                 trips: np.ndarray, trip_info: pd.DataFrame, trip_service: np.ndarray, calendar: ServiceCalendar):
+        self.stop_positions = {stop_id: position for position, stop_id in enumerate(stop_ids)}
+        self.starts = starts
+        self.ends = ends
+        self.departures = departures
+        self.trips = trips
+        self.trip_info = trip_info
+        self.trip_service = trip_service
+        self.calendar = calendar
+
+    @classmethod
+    def build(cls, stop_keys: pd.DataFrame, trip_info: pd.DataFrame, stop_times: pd.DataFrame,
+              calendar: ServiceCalendar) -> 'DepartureIndex':
+        stop_key = stop_times['stop_key'].to_numpy(dtype='int32')
+        departure = stop_times['departure_secs'].to_numpy(dtype='int32')
+        order = np.lexsort((departure, stop_key))
+        stop_key, departure = stop_key[order], departure[order]
+        trips = stop_times['trip_key'].to_numpy(dtype='int32')[order]
+
+        # Stops without departures get an empty slice
+        keys = stop_keys['stop_key'].to_numpy(dtype='int32')
+        starts = np.searchsorted(stop_key, keys, side='left')
+        ends = np.searchsorted(stop_key, keys, side='right')
+
+        # Trip attributes are looked up by trip_key, so they sit in key-indexed arrays
+        size = int(trip_info['trip_key'].max()) + 1 if len(trip_info) else 1
+        trip_info = trip_info.set_index('trip_key').reindex(np.arange(size))
+        trip_service = trip_info['service_id'].map(calendar.codes).fillna(-1).to_numpy(dtype='int32')
+
+        return cls(stop_keys['stop_id'].to_numpy(), starts, ends, departure, trips, trip_info, trip_service, calendar)
+
+    def next_departures(self, stop_id: str, at: datetime, limit: int):
+        position = self.stop_positions.get(stop_id)
+        if position is None:
+            return None
+        lo, hi = self.starts[position], self.ends[position]
+        today = at.date()
+        now_secs = at.hour * 3600 + at.minute * 60 + at.second
+
+        candidates = []
+        # Trips of yesterday's service day still running after midnight are at t + 24h
+        for service_date, offset in ((today, 0), (today - timedelta(days=1), DAY_SECONDS)):
+            start = lo + int(np.searchsorted(self.departures[lo:hi], now_secs + offset, side='left'))
+            if start >= hi:
+                continue
+            active = self.calendar.active(service_date)
+            running = np.flatnonzero(active[self.trip_service[self.trips[start:hi]]])[:limit] + start
+            candidates.extend((int(self.departures[i]) - offset, int(i), service_date) for i in running)
+
+        candidates.sort()
+        departures = []
+        for seconds, i, service_date in candidates[:limit]:
+            trip = self.trip_info.iloc[int(self.trips[i])]
+            departure_secs = int(self.departures[i])
+            departures.append({
+                "trip_id": trip['trip_id'],
+                "route_id": trip['route_id'],
+                "route_short_name": trip['route_short_name'],
+                "trip_headsign": trip['trip_headsign'],
+                "service_date": service_date.isoformat(),
+                "departure_time": gtfs_time(departure_secs),
+                "departure_at": (datetime.combine(service_date, datetime.min.time()) + timedelta(seconds=departure_secs)).isoformat(),
+                "minutes": (seconds - now_secs) // 60,
+            })
+        return departures
+
+async def copy_query_frame(conn, sql: str, columns: list) -> pd.DataFrame:
+    # COPY keeps millions of stop_times rows out of per-row Python objects
+    raw_connection = await conn.get_raw_connection()
+    buffer = io.BytesIO()
+    await raw_connection.driver_connection.copy_from_query(sql, output=buffer, format='csv')
+    buffer.seek(0)
+    return pd.read_csv(buffer, names=columns, dtype='int32')
+
+async def load_departure_index(engine, timeout_ms: int) -> DepartureIndex:
+    async with engine.connect() as conn:
+        await conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+        stop_keys = pd.DataFrame(
+            (await conn.execute(text("SELECT stop_key, stop_id FROM raw.stop_keys"))).fetchall(),
+            columns=['stop_key', 'stop_id']
+        )
+        trip_info = pd.DataFrame(
+            (await conn.execute(text(
+                """
+                SELECT tk.trip_key, t.trip_id, t.route_id, r.route_short_name, t.service_id, t.trip_headsign
+                FROM raw.trip_keys tk
+                JOIN raw.trips t ON tk.trip_id = t.trip_id
+                LEFT JOIN raw.routes r ON t.route_id = r.route_id
+                """
+            ))).fetchall(),
+            columns=['trip_key', 'trip_id', 'route_id', 'route_short_name', 'service_id', 'trip_headsign']
+        )
+        bitmaps = (await conn.execute(text(
+            "SELECT service_id, start_date, active_days::text FROM raw.service_bitmaps ORDER BY service_id"
+        ))).fetchall()
+        stop_times = await copy_query_frame(
+            conn,
+            "SELECT stop_key, departure_secs, trip_key FROM raw.stop_times WHERE departure_secs IS NOT NULL",
+            ['stop_key', 'departure_secs', 'trip_key']
+        )
+
+    calendar = ServiceCalendar.from_bitmaps(bitmaps)
+    # Array work happens off the event loop so requests keep being served during a reload
+    return await asyncio.to_thread(DepartureIndex.build, stop_keys, trip_info, stop_times, calendar)
@@ -1,60 +1,201 @@
 #!/usr/bin/env python3
 
+import json
+import os
+import zipfile
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from urllib.parse import urljoin
+
 import requests
 from bs4 import BeautifulSoup
 from prefect import task, flow
 from prefect.logging import get_run_logger
 
-@task(name="Find Latest GTFS URL")
-def find_latest_gtfs_url() -> str:
-    logger = get_run_logger()
-    main_page_url = "https://opendata.porto.digital/dataset/horarios-paragens-e-rotas-em-formato-gtfs-stcp"
-    base_url = "https://opendata.porto.digital"
+from config import (
+    GTFS_PORTAL_URL, GTFS_DATASET_PATH, DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT,
+    DOWNLOAD_CHUNK_BYTES, DOWNLOAD_RETRIES, FEED_STATE_FILE_NAME
+)
+from gtfs_archive import file_sha256
+
+REQUEST_TIMEOUT = (DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+# Failures worth resuming from instead of starting the download over
+RESUMABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+@lru_cache(maxsize=1)
+def get_http_session() -> requests.Session:
+    # Kept for the life of the process so a resident updater reuses its connections
+    return requests.Session()
+
+def feed_state_path(zip_path: str) -> Path:
+    return Path(zip_path).parent / FEED_STATE_FILE_NAME
+
+def load_feed_state(zip_path: str) -> dict:
+    path = feed_state_path(zip_path)
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+def save_feed_state(zip_path: str, state: dict) -> None:
+    path = feed_state_path(zip_path)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps(state, indent=2))
+    os.replace(tmp_path, path)
 
-    logger.info(f"Accessing main page: {main_page_url}")
-    main_page_response = requests.get(main_page_url)
-    main_page_response.raise_for_status()
-    main_soup = BeautifulSoup(main_page_response.text, 'lxml')
+def fetch_page(session: requests.Session, url: str) -> BeautifulSoup:
+    response = session.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return BeautifulSoup(response.text, 'lxml')
+
+def scrape_latest_gtfs_resource(session: requests.Session = None) -> dict:
+    # Both portal pages are fetched once per run; callers reuse the result
+    session = session or get_http_session()
+    main_page_url = urljoin(GTFS_PORTAL_URL, GTFS_DATASET_PATH)
+    main_soup = fetch_page(session, main_page_url)
 
     resource_page_link_tag = main_soup.find('a', title=lambda t: t and 'Mais Recente' in t)
     if not resource_page_link_tag or not resource_page_link_tag.has_attr('href'):
         raise Exception("Could not find the link for the 'Mais Recente' resource.")
-    
-    resource_page_url = base_url + resource_page_link_tag['href']
-    logger.info(f"Found resource page: {resource_page_url}")
-
-    logger.info("Accessing resource page to find final download link...")
-    resource_page_response = requests.get(resource_page_url)
-    resource_page_response.raise_for_status()
-    resource_soup = BeautifulSoup(resource_page_response.text, 'lxml')
+    resource_page_url = urljoin(GTFS_PORTAL_URL, resource_page_link_tag['href'])
 
+    resource_soup = fetch_page(session, resource_page_url)
     final_download_link = resource_soup.find('a', class_='resource-url-analytics', href=lambda h: h and '/download/' in h)
     if not final_download_link or not final_download_link.has_attr('href'):
         raise Exception("Could not find the final download link on the resource page.")
 
-    file_url = final_download_link['href']
-    logger.info(f"Found final download URL: {file_url}")
-    return file_url
+    return {
+        'title': resource_page_link_tag.get('title', ''),
+        'resource_page_url': resource_page_url,
+        'url': urljoin(resource_page_url, final_download_link['href']),
+    }
+
+@task(name="Find Latest GTFS URL")
+def find_latest_gtfs_url() -> str:
+    logger = get_run_logger()
+    logger.info(f"Accessing portal: {urljoin(GTFS_PORTAL_URL, GTFS_DATASET_PATH)}")
+    resource = scrape_latest_gtfs_resource()
+    logger.info(f"Found resource page: {resource['resource_page_url']}")
+    logger.info(f"Found final download URL: {resource['url']}")
+    return resource['url']
+
+def conditional_headers(state: dict, url: str, save_path: str) -> dict:
+    headers = {}
+    if state.get('url') == url and state.get('sha256') and Path(save_path).exists():
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+    return headers
+
+def resume_headers(state: dict, url: str, part_path: Path) -> dict:
+    # A partial file is only continued if it belongs to the same URL and the
+    # server can confirm (If-Range) the file has not changed in between
+    partial = state.get('partial') or {}
+    validator = partial.get('etag') or partial.get('last_modified')
+    if not part_path.exists() or partial.get('url') != url or not validator:
+        return {}
+    offset = part_path.stat().st_size
+    if offset == 0:
+        return {}
+    return {'Range': f"bytes={offset}-", 'If-Range': validator}
+
+def fetch_archive(session: requests.Session, url: str, save_path: str, part_path: Path, state: dict) -> bool:
+    logger = get_run_logger()
+    headers = conditional_headers(state, url, save_path)
+    headers.update(resume_headers(state, url, part_path))
+
+    with session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as r:
+        if r.status_code == 304:
+            logger.info("Server reports the GTFS archive is not modified, keeping the local copy.")
+            return False
+        if r.status_code == 416:
+            logger.warning("Partial download no longer matches the server file, starting over.")
+            part_path.unlink(missing_ok=True)
+            state.pop('partial', None)
+            return fetch_archive(session, url, save_path, part_path, state)
+        r.raise_for_status()
+
+        if r.status_code == 206:
+            offset = part_path.stat().st_size
+            if not r.headers.get('Content-Range', '').startswith(f"bytes {offset}-"):
+                raise requests.ConnectionError(f"Unexpected Content-Range: {r.headers.get('Content-Range')}")
+            logger.info(f"Resuming download at byte {offset}")
+            mode = 'ab'
+        else:
+            mode = 'wb'
+            state['partial'] = {
+                'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')
+            }
+            save_feed_state(save_path, state)
+
+        with open(part_path, mode, buffering=DOWNLOAD_CHUNK_BYTES) as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                f.write(chunk)
+        state['etag'] = state['partial'].get('etag')
+        state['last_modified'] = state['partial'].get('last_modified')
+    return True
 
 @task(name="Download GTFS File")
 def download_gtfs_file(url: str, save_path: str) -> str:
     logger = get_run_logger()
     logger.info(f"Downloading from {url} to {save_path}...")
-    
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(save_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-    
-    logger.info("Download complete.")
+    state = load_feed_state(save_path)
+    part_path = Path(f"{save_path}.part")
+
+    session = get_http_session()
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            downloaded = fetch_archive(session, url, save_path, part_path, state)
+            break
+        except RESUMABLE_ERRORS as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logger.warning(f"Download interrupted ({e}), retrying ({attempt}/{DOWNLOAD_RETRIES})")
+
+    if not downloaded:
+        return save_path
+
+    if not zipfile.is_zipfile(part_path):
+        part_path.unlink(missing_ok=True)
+        state.pop('partial', None)
+        save_feed_state(save_path, state)
+        raise ValueError(f"Downloaded file from {url} is not a valid ZIP archive")
+
+    sha256 = file_sha256(part_path)
+    os.replace(part_path, save_path)
+    state.pop('partial', None)
+    state.update({
+        'url': url, 'sha256': sha256, 'size': Path(save_path).stat().st_size,
+        'downloaded_at': datetime.now().isoformat(timespec='seconds')
+    })
+    save_feed_state(save_path, state)
+    logger.info(f"Download complete ({state['size']} bytes, sha256 {sha256}).")
     return save_path
 
+@task(name="Check Feed Already Processed")
+def feed_already_processed(zip_path: str) -> bool:
+    logger = get_run_logger()
+    state = load_feed_state(zip_path)
+    sha256 = state.get('sha256')
+    if sha256 and sha256 == state.get('processed_sha256'):
+        logger.info(f"GTFS archive {sha256} was already loaded on {state.get('processed_at')}")
+        return True
+    return False
+
+@task(name="Mark Feed Processed")
+def mark_feed_processed(zip_path: str) -> None:
+    state = load_feed_state(zip_path)
+    state['processed_sha256'] = state.get('sha256') or file_sha256(zip_path)
+    state['processed_at'] = datetime.now().isoformat(timespec='seconds')
+    save_feed_state(zip_path, state)
+
 @flow(name="Download GTFS Data")
-def download_flow(save_path: str) -> str:
-    url = find_latest_gtfs_url()
+def download_flow(save_path: str, url: str = None) -> str:
+    url = url or find_latest_gtfs_url()
     final_save_path = download_gtfs_file(url, save_path)
     return final_save_path
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import asyncio
+import hashlib
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+import orjson
+
+from config import (
+    FIWARE_BROKER_URL, FLEET_POLL_SECONDS, FLEET_REQUEST_TIMEOUT, FLEET_PAGE_LIMIT, FLEET_BACKOFF_MAX_SECONDS
+)
+
+ENTITIES_PATH = '/v2/entities'
+ENTITIES_QUERY = 'vehicleType==bus'
+
+def attribute_value(entity: dict, name: str):
+    attribute = entity.get(name)
+    return attribute.get('value') if isinstance(attribute, dict) else None
+
+def parse_annotations(values) -> dict:
+    # "stcp:route:302" -> {"route": "302"}
+    annotations = {}
+    for value in values or []:
+        _, _, rest = str(value).partition(':')
+        key, _, field = rest.partition(':')
+        if key:
+            annotations[key] = field
+    return annotations
+
+def vehicle_row(entity: dict):
+    location = attribute_value(entity, 'location') or {}
+    coordinates = location.get('coordinates') or []
+    if len(coordinates) < 2:
+        return None
+    annotations = parse_annotations(attribute_value(entity, 'annotations'))
+    return {
+        "id": entity.get('id'),
+        "route_id": annotations.get('route'),
+        "sentido": annotations.get('sentido'),
+        "viagem": annotations.get('nr_viagem'),
+        "lat": coordinates[1],
+        "lon": coordinates[0],
+        "bearing": attribute_value(entity, 'bearing'),
+        "speed": attribute_value(entity, 'speed'),
+        "observed_at": attribute_value(entity, 'observationDateTime'),
+    }
+
+def fleet_summary(vehicles: list) -> dict:
+    speeds = [vehicle['speed'] for vehicle in vehicles if isinstance(vehicle['speed'], (int, float))]
+    routes = Counter(vehicle['route_id'] for vehicle in vehicles if vehicle['route_id'])
+    return {
+        "total_autocarros": len(vehicles),
+        "em_movimento": sum(speed > 0 for speed in speeds),
+        "velocidade_media": round(sum(speeds) / len(speeds), 1) if speeds else None,
+        "total_linhas": len(routes),
+        "autocarros_por_linha": [{"route_id": route_id, "total": total} for route_id, total in routes.most_common()],
+    }
+
+class FleetSnapshot:
+    # One poll of the broker, serialized once and shared by every client
+
+    def __init__(self, vehicles: list, fetched_at: float):
+        self.fetched_at = fetched_at
+        self.body = orjson.dumps({
+            "atualizado_em": datetime.fromtimestamp(fetched_at, timezone.utc).isoformat(timespec='seconds'),
+            "resumo": fleet_summary(vehicles),
+            "autocarros": vehicles,
+        })
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+class FleetPoller:
+    # The only client of the broker in the API process: a background loop
+    # refreshes the snapshot, and requests arriving before the first one
+    # share whichever fetch is already in flight
+
+    def __init__(self, match=None, on_snapshot=None):
+        # match(vehicles) annotates the rows in place before they are published;
+        # on_snapshot(vehicles, received_at) sees every poll, e.g. to store positions
+        self.match = match
+        self.on_snapshot = on_snapshot
+        self.client = None
+        self.snapshot = None
+        self.last_error = None
+        self.inflight = None
+
+    async def fetch_entities(self) -> list:
+        # Orion caps a page at 1000 entities; the total count header says when to stop
+        entities, offset = [], 0
+        while True:
+            response = await self.client.get(ENTITIES_PATH, params={
+                'q': ENTITIES_QUERY, 'limit': FLEET_PAGE_LIMIT, 'offset': offset, 'options': 'count'
+            })
+            response.raise_for_status()
+            page = response.json()
+            if not isinstance(page, list):
+                # Orion reports some errors as a 200 with an error object
+                raise ValueError(f"Expected a list of entities, got {type(page).__name__}: {str(page)[:200]}")
+            entities.extend(page)
+            offset += len(page)
+            total = int(response.headers.get('Fiware-Total-Count', offset))
+            if not page or offset >= total:
+                return entities
+
+    async def fetch_snapshot(self) -> FleetSnapshot:
+        entities = await self.fetch_entities()
+        vehicles = [row for row in map(vehicle_row, entities) if row is not None]
+        if self.match is not None:
+            try:
+                await asyncio.to_thread(self.match, vehicles)
+            except Exception as e:
+                # Snapping is an extra; the positions are published without it
+                print(f"Map matching failed, publishing unsnapped positions: {type(e).__name__}: {e}")
+        self.snapshot = FleetSnapshot(vehicles, time.time())
+        self.last_error = None
+        if self.on_snapshot is not None:
+            self.on_snapshot(vehicles, datetime.fromtimestamp(self.snapshot.fetched_at, timezone.utc))
+        return self.snapshot
+
+    async def refresh(self) -> FleetSnapshot:
+        if self.inflight is None:
+            self.inflight = asyncio.create_task(self.fetch_snapshot())
+            self.inflight.add_done_callback(self.clear_inflight)
+        # A cancelled request must not cancel the fetch other requests are waiting on
+        return await asyncio.shield(self.inflight)
+
+    def clear_inflight(self, task: asyncio.Task) -> None:
+        self.inflight = None
+        if not task.cancelled() and task.exception() is not None:
+            self.last_error = str(task.exception()) or type(task.exception()).__name__
+
+    def open(self) -> None:
+        # Pooled, so each poll reuses the kept-alive TLS connection to the broker
+        self.client = httpx.AsyncClient(
+            base_url=FIWARE_BROKER_URL,
+            timeout=FLEET_REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=2, max_keepalive_connections=2),
+            headers={'Accept': 'application/json'},
+        )
+
+    async def run(self) -> None:
+        failures = 0
+        try:
+            while True:
+                try:
+                    await self.refresh()
+                    failures = 0
+                    delay = FLEET_POLL_SECONDS
+                except Exception as e:
+                    # Backs off exponentially (with jitter) while polls fail; whatever
+                    # the error, the poller itself must keep running
+                    failures += 1
+                    delay = min(FLEET_POLL_SECONDS * 2 ** failures, FLEET_BACKOFF_MAX_SECONDS)
+                    delay *= random.uniform(0.5, 1.0)
+                    print(f"Fleet poll failed ({failures} in a row, retrying in {delay:.0f}s): {type(e).__name__}: {e}")
+                await asyncio.sleep(delay)
+        finally:
+            await self.client.aclose()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import hashlib
+import io
+import mmap
+import os
+import struct
+import zipfile
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+from config import GTFS_ZIP_MMAP
+
+GTFS_FILES = [
+    'agency.txt', 'calendar.txt', 'calendar_dates.txt', 'routes.txt', 'shapes.txt',
+    'stop_times.txt', 'stops.txt', 'transfers.txt', 'trips.txt'
+]
+
+# signature, versions, flags, method, time, date, crc, sizes, name length, extra length
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+def file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@lru_cache(maxsize=8)
+def _feed_version(path: str, size: int, mtime_ns: int) -> str:
+    return file_sha256(path)
+
+def feed_version(zip_path: str) -> str:
+    # SHA-256 of the archive, hashed once per process for a given file
+    stat = os.stat(zip_path)
+    return _feed_version(str(Path(zip_path).resolve()), stat.st_size, stat.st_mtime_ns)
+
+class MappedMember(io.RawIOBase):
+    # Read-only view over a stored (uncompressed) member of a memory-mapped ZIP
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), len(self.view) - self.position)
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+def member_data_offset(archive_map: mmap.mmap, info: zipfile.ZipInfo) -> int:
+    header = LOCAL_HEADER.unpack_from(archive_map, info.header_offset)
+    if header[0] != b'PK\x03\x04':
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    name_length, extra_length = header[-2], header[-1]
+    return info.header_offset + LOCAL_HEADER.size + name_length + extra_length
+
+def get_member_info(archive: zipfile.ZipFile, member: str) -> zipfile.ZipInfo:
+    try:
+        return archive.getinfo(member)
+    except KeyError:
+        raise FileNotFoundError(f"{member} not found in {archive.filename}") from None
+
+@contextmanager
+def open_gtfs_member(zip_path: str, member: str, use_mmap: bool = GTFS_ZIP_MMAP):
+    # Streams one member out of the feed archive; only that member is decompressed
+    with zipfile.ZipFile(zip_path) as archive:
+        info = get_member_info(archive, member)
+        if use_mmap and info.compress_type == zipfile.ZIP_STORED:
+            with open(zip_path, 'rb') as archive_file, \
+                    mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ) as archive_map:
+                start = member_data_offset(archive_map, info)
+                raw = MappedMember(memoryview(archive_map)[start:start + info.file_size])
+                try:
+                    with io.BufferedReader(raw, buffer_size=1024 * 1024) as stream:
+                        yield stream
+                finally:
+                    raw.close()
+        else:
+            with archive.open(info) as stream:
+                yield stream
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+
+import asyncio
+import io
+import os
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from config import (
+    SNAPSHOT_DIR, JOURNEY_MAX_TRANSFERS, JOURNEY_WALK_RADIUS_M, JOURNEY_WALK_SPEED_MPS, JOURNEY_TRANSFER_SLACK_SECS
+)
+from departures import DAY_SECONDS, gtfs_time
+from snapshots import snapshot_key
+
+EARTH_RADIUS_M = 6371008.8
+# Minimum time charged for a transfers.txt connection between two stops
+TRANSFER_MIN_SECS = 60
+SNAPSHOT_FILE_NAME = 'journey_planner.npz'
+
+# Everything the timetable is built from; pulled with COPY into pandas
+TIMETABLE_QUERIES = {
+    'stops': (
+        "SELECT sk.stop_key, s.stop_id, s.stop_name, s.stop_lat::float8, s.stop_lon::float8 "
+        "FROM raw.stops s JOIN raw.stop_keys sk ON s.stop_id = sk.stop_id",
+        {'stop_key': 'int32', 'stop_id': str, 'stop_name': str, 'stop_lat': 'float64', 'stop_lon': 'float64'}
+    ),
+    'trips': (
+        "SELECT tk.trip_key, t.trip_id, r.route_short_name, t.service_id, t.trip_headsign "
+        "FROM raw.trip_keys tk JOIN raw.trips t ON tk.trip_id = t.trip_id LEFT JOIN raw.routes r ON t.route_id = r.route_id",
+        {'trip_key': 'int32', 'trip_id': str, 'route_short_name': str, 'service_id': str, 'trip_headsign': str}
+    ),
+    'stop_times': (
+        "SELECT trip_key, stop_sequence, stop_key, COALESCE(arrival_secs, departure_secs), COALESCE(departure_secs, arrival_secs) "
+        "FROM raw.stop_times WHERE COALESCE(arrival_secs, departure_secs) IS NOT NULL",
+        {'trip_key': 'int32', 'stop_sequence': 'int32', 'stop_key': 'int32', 'arrival_secs': 'int32', 'departure_secs': 'int32'}
+    ),
+    'transfers': (
+        # transfer_type 3 means the transfer is not possible
+        "SELECT from_stop_id, to_stop_id FROM raw.transfers WHERE transfer_type <> 3",
+        {'from_stop_id': str, 'to_stop_id': str}
+    ),
+    'service_bitmaps': (
+        "SELECT service_id, start_date, active_days::text FROM raw.service_bitmaps ORDER BY service_id",
+        {'service_id': str, 'start_date': str, 'active_days': str}
+    ),
+}
+
+def read_copy_csv(buffer: io.BytesIO, dtypes: dict) -> pd.DataFrame:
+    buffer.seek(0)
+    return pd.read_csv(buffer, names=list(dtypes), dtype=dtypes, keep_default_na=False, na_values={
+        column: [''] for column, dtype in dtypes.items() if dtype != str
+    })
+
+def read_query_frames(conn, queries: dict = TIMETABLE_QUERIES) -> dict:
+    # ETL side: psycopg2 COPY through the SQLAlchemy connection
+    cursor = conn.connection.cursor()
+    frames = {}
+    for name, (sql, dtypes) in queries.items():
+        buffer = io.BytesIO()
+        cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv)", buffer)
+        frames[name] = read_copy_csv(buffer, dtypes)
+    cursor.close()
+    return frames
+
+async def read_query_frames_async(conn, queries: dict = TIMETABLE_QUERIES) -> dict:
+    # API side: asyncpg COPY through the pooled connection
+    raw_connection = await conn.get_raw_connection()
+    frames = {}
+    for name, (sql, dtypes) in queries.items():
+        buffer = io.BytesIO()
+        await raw_connection.driver_connection.copy_from_query(sql, output=buffer, format='csv')
+        frames[name] = read_copy_csv(buffer, dtypes)
+    return frames
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+def walking_pairs(lat: np.ndarray, lon: np.ndarray, radius_m: float, block: int = 512):
+    # Stops within walking distance of each other, compared block by block so
+    # the distance matrix never holds more than block x n values
+    sources, targets, distances = [], [], []
+    for start in range(0, len(lat), block):
+        d = haversine_m(lat[start:start + block, None], lon[start:start + block, None], lat[None, :], lon[None, :])
+        rows, cols = np.nonzero(d <= radius_m)
+        keep = rows + start != cols
+        sources.append(rows[keep] + start)
+        targets.append(cols[keep])
+        distances.append(d[rows[keep], cols[keep]])
+    if not sources:
+        return np.empty(0, 'int32'), np.empty(0, 'int32'), np.empty(0)
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(distances)
+
+def csr(groups: np.ndarray, size: int, *values):
+    # Sorts values by group and returns the group offsets plus the sorted values
+    order = np.argsort(groups, kind='stable')
+    offsets = np.zeros(size + 1, dtype='int64')
+    np.cumsum(np.bincount(groups, minlength=size), out=offsets[1:])
+    return (offsets, *(value[order] for value in values))
+
+class Timetable:
+    # RAPTOR timetable: trips grouped into patterns (identical stop sequences),
+    # each pattern a block of trips x stops times sorted by departure, plus the
+    # stop -> pattern index, walking footpaths and the service-day bitmaps.
+    # Everything is a flat NumPy array so it can be saved and loaded as is.
+
+    def __init__(self, arrays: dict):
+        self.arrays = arrays
+        for name, value in arrays.items():
+            setattr(self, name, value)
+        self.stop_positions = {stop_id: i for i, stop_id in enumerate(self.stop_ids.tolist())}
+        self.start_ordinal = int(self.service_start[0]) if len(self.service_start) else 0
+        self.latest_departure = int(self.departures.max()) if len(self.departures) else -1
+
+    @classmethod
+    def build(cls, frames: dict) -> 'Timetable':
+        stops = frames['stops'].sort_values('stop_key', ignore_index=True)
+        stop_keys = stops['stop_key'].to_numpy()
+        trips = frames['trips'].sort_values('trip_key', ignore_index=True)
+        trip_keys = trips['trip_key'].to_numpy()
+
+        st = frames['stop_times']
+        stop_pos = np.searchsorted(stop_keys, st['stop_key'].to_numpy()).clip(0, max(len(stop_keys) - 1, 0))
+        trip_pos = np.searchsorted(trip_keys, st['trip_key'].to_numpy()).clip(0, max(len(trip_keys) - 1, 0))
+        known = (stop_keys[stop_pos] == st['stop_key'].to_numpy()) & (trip_keys[trip_pos] == st['trip_key'].to_numpy())
+        order = np.lexsort((st['stop_sequence'].to_numpy()[known], trip_pos[known]))
+        stop_pos, trip_pos = stop_pos[known][order], trip_pos[known][order]
+        arrivals = st['arrival_secs'].to_numpy()[known][order]
+        departures = st['departure_secs'].to_numpy()[known][order]
+
+        # Trips with the same stop sequence share a pattern
+        trip_starts = np.flatnonzero(np.r_[True, trip_pos[1:] != trip_pos[:-1]])
+        trip_ends = np.r_[trip_starts[1:], len(trip_pos)]
+        signatures = [stop_pos[s:e].tobytes() for s, e in zip(trip_starts, trip_ends)]
+        trip_pattern, _ = pd.factorize(pd.Series(signatures, dtype=object))
+        pattern_count = int(trip_pattern.max()) + 1 if len(trip_pattern) else 0
+
+        pattern_stop_offsets = np.zeros(pattern_count + 1, dtype='int64')
+        pattern_trip_offsets = np.zeros(pattern_count + 1, dtype='int64')
+        pattern_time_offsets = np.zeros(pattern_count + 1, dtype='int64')
+        pattern_stops, pattern_trips, times_arr, times_dep = [], [], [], []
+        by_pattern = pd.Series(np.arange(len(trip_starts))).groupby(trip_pattern).indices
+        for pattern in range(pattern_count):
+            members = by_pattern[pattern]
+            first = trip_starts[members]
+            members = members[np.argsort(departures[first], kind='stable')]
+            length = trip_ends[members[0]] - trip_starts[members[0]]
+            rows = trip_starts[members][:, None] + np.arange(length)
+            pattern_stops.append(stop_pos[trip_starts[members[0]]:trip_ends[members[0]]])
+            pattern_trips.append(trip_pos[trip_starts[members]])
+            times_arr.append(arrivals[rows].ravel())
+            times_dep.append(departures[rows].ravel())
+            pattern_stop_offsets[pattern + 1] = pattern_stop_offsets[pattern] + length
+            pattern_trip_offsets[pattern + 1] = pattern_trip_offsets[pattern] + len(members)
+            pattern_time_offsets[pattern + 1] = pattern_time_offsets[pattern] + len(members) * length
+
+        def flat(parts, dtype):
+            return np.concatenate(parts).astype(dtype) if parts else np.empty(0, dtype)
+
+        pattern_stops = flat(pattern_stops, 'int32')
+        stop_pattern_offsets, stop_patterns, stop_pattern_positions = csr(
+            pattern_stops, len(stops),
+            np.repeat(np.arange(pattern_count, dtype='int32'), np.diff(pattern_stop_offsets)),
+            (np.arange(len(pattern_stops)) - np.repeat(pattern_stop_offsets[:-1], np.diff(pattern_stop_offsets))).astype('int32')
+        )
+
+        # Footpaths: stops within walking distance, plus the connections in transfers.txt
+        lat, lon = stops['stop_lat'].to_numpy(), stops['stop_lon'].to_numpy()
+        sources, targets, distances = walking_pairs(lat, lon, JOURNEY_WALK_RADIUS_M)
+        walk_secs = np.ceil(distances / JOURNEY_WALK_SPEED_MPS).astype('int32')
+        stop_index = pd.Index(stops['stop_id'])
+        transfers = frames['transfers']
+        from_pos = stop_index.get_indexer(transfers['from_stop_id'])
+        to_pos = stop_index.get_indexer(transfers['to_stop_id'])
+        valid = (from_pos >= 0) & (to_pos >= 0) & (from_pos != to_pos)
+        from_pos, to_pos = from_pos[valid], to_pos[valid]
+        transfer_secs = np.maximum(
+            np.ceil(haversine_m(lat[from_pos], lon[from_pos], lat[to_pos], lon[to_pos]) / JOURNEY_WALK_SPEED_MPS),
+            TRANSFER_MIN_SECS
+        ).astype('int32')
+        paths = pd.DataFrame({
+            'source': np.r_[sources, from_pos].astype('int32'),
+            'target': np.r_[targets, to_pos].astype('int32'),
+            'secs': np.r_[walk_secs, transfer_secs].astype('int32'),
+        }).groupby(['source', 'target'], as_index=False)['secs'].min()
+        footpath_offsets, footpath_targets, footpath_secs = csr(
+            paths['source'].to_numpy(), len(stops), paths['target'].to_numpy(), paths['secs'].to_numpy()
+        )
+
+        # Service days: one row of bits per service, bit 0 at the feed's first day
+        bitmaps = frames['service_bitmaps']
+        service_codes = {service_id: code for code, service_id in enumerate(bitmaps['service_id'])}
+        day_count = len(bitmaps['active_days'].iloc[0]) if len(bitmaps) else 0
+        service_days = np.zeros((len(bitmaps) + 1, day_count), dtype=bool)
+        for code, active_days in enumerate(bitmaps['active_days']):
+            service_days[code] = np.frombuffer(active_days.encode(), dtype=np.uint8) == ord('1')
+        service_start = np.array(
+            [date.fromisoformat(bitmaps['start_date'].iloc[0]).toordinal()] if len(bitmaps) else [], dtype='int64'
+        )
+        # Trips without a known service point at the last, all-False row
+        trip_service = trips['service_id'].map(service_codes).fillna(len(bitmaps)).to_numpy(dtype='int32')
+
+        return cls({
+            'stop_ids': stops['stop_id'].to_numpy(dtype=str),
+            'stop_names': stops['stop_name'].to_numpy(dtype=str),
+            'pattern_stop_offsets': pattern_stop_offsets,
+            'pattern_stops': pattern_stops,
+            'pattern_trip_offsets': pattern_trip_offsets,
+            'pattern_trips': flat(pattern_trips, 'int32'),
+            'pattern_time_offsets': pattern_time_offsets,
+            'arrivals': flat(times_arr, 'int32'),
+            'departures': flat(times_dep, 'int32'),
+            'stop_pattern_offsets': stop_pattern_offsets,
+            'stop_patterns': stop_patterns,
+            'stop_pattern_positions': stop_pattern_positions,
+            'footpath_offsets': footpath_offsets,
+            'footpath_targets': footpath_targets,
+            'footpath_secs': footpath_secs,
+            'trip_ids': trips['trip_id'].to_numpy(dtype=str),
+            'trip_routes': trips['route_short_name'].to_numpy(dtype=str),
+            'trip_headsigns': trips['trip_headsign'].to_numpy(dtype=str),
+            'trip_service': trip_service,
+            'service_days': service_days,
+            'service_start': service_start,
+        })
+
+    def save(self, path: Path) -> None:
+        # Uncompressed, so loading is a straight read of each array
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **self.arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'Timetable':
+        with np.load(path, allow_pickle=False) as data:
+            return cls({name: data[name] for name in data.files})
+
+    def active_trips(self, service_date: date) -> np.ndarray:
+        day = service_date.toordinal() - self.start_ordinal
+        if not 0 <= day < self.service_days.shape[1]:
+            return np.zeros(len(self.trip_ids), dtype=bool)
+        return self.service_days[self.trip_service, day]
+
+    def pattern_block(self, pattern: int):
+        stops = self.pattern_stops[self.pattern_stop_offsets[pattern]:self.pattern_stop_offsets[pattern + 1]]
+        trips = self.pattern_trips[self.pattern_trip_offsets[pattern]:self.pattern_trip_offsets[pattern + 1]]
+        start, end = self.pattern_time_offsets[pattern], self.pattern_time_offsets[pattern + 1]
+        shape = (len(trips), len(stops))
+        return stops, trips, self.arrivals[start:end].reshape(shape), self.departures[start:end].reshape(shape)
+
+    def patterns_to_scan(self, marked: np.ndarray) -> list:
+        # Every pattern through a marked stop, scanned from the first marked stop on it
+        starts, ends = self.stop_pattern_offsets[marked], self.stop_pattern_offsets[marked + 1]
+        lengths = ends - starts
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        patterns, positions = self.stop_patterns[entries], self.stop_pattern_positions[entries]
+        order = np.lexsort((positions, patterns))
+        patterns, positions = patterns[order], positions[order]
+        first = np.ones(len(patterns), dtype=bool)
+        first[1:] = patterns[1:] != patterns[:-1]
+        return list(zip(patterns[first].tolist(), positions[first].tolist()))
+
+    def scan_pattern(self, pattern: int, first_position: int, previous: np.ndarray, slack: int, active: np.ndarray):
+        # One RAPTOR route scan as array operations. At every stop the earliest
+        # running trip that can still be caught is counted off the (FIFO) sorted
+        # departures; the trip ridden at a stop is the earliest caught at any
+        # stop before it, i.e. a running minimum
+        stops, trips, arrivals, departures = self.pattern_block(pattern)
+        running = np.flatnonzero(active[trips])
+        stops = stops[first_position:]
+        if not len(running) or len(stops) < 2:
+            return None
+        ready = previous[stops]
+        caught = (departures[running, first_position:] < (ready + slack)[None, :]).sum(axis=0)
+        caught[ready == np.iinfo('int32').max] = len(running)
+
+        boarded = np.minimum.accumulate(caught)
+        riding = np.empty_like(boarded)
+        riding[0], riding[1:] = len(running), boarded[:-1]
+        improves = np.ones(len(stops), dtype=bool)
+        improves[1:] = boarded[1:] < boarded[:-1]
+        boarding = np.zeros_like(boarded)
+        boarding[1:] = np.maximum.accumulate(np.where(improves, np.arange(len(stops)), 0))[:-1]
+
+        positions = np.flatnonzero(riding < len(running))
+        if not len(positions):
+            return None
+        rows = riding[positions]
+        return (
+            stops[positions], arrivals[running[rows], positions + first_position],
+            running[rows], boarding[positions] + first_position, positions + first_position
+        )
+
+    def plan(self, origin: str, destination: str, at: datetime, max_transfers: int = JOURNEY_MAX_TRANSFERS):
+        source = self.stop_positions.get(origin)
+        target = self.stop_positions.get(destination)
+        if source is None or target is None:
+            return None
+
+        now_secs = at.hour * 3600 + at.minute * 60 + at.second
+        found = None
+        # Trips of yesterday's service day still running after midnight are at t + 24h
+        for service_date, offset in ((at.date(), 0), (at.date() - timedelta(days=1), DAY_SECONDS)):
+            if now_secs + offset > self.latest_departure:
+                continue
+            search = self.search(source, target, now_secs + offset, service_date, max_transfers)
+            if search is not None and (found is None or search[0] - offset < found[0]):
+                found = (search[0] - offset, service_date, search[1], search[2])
+        if found is None:
+            return None
+        _, service_date, ride_legs, walk_legs = found
+        return self.journey(source, target, ride_legs, walk_legs, service_date)
+
+    def search(self, source: int, target: int, start_secs: int, service_date: date, max_transfers: int):
+        # RAPTOR rounds over one service day; returns the arrival at the target
+        # with the labels of every round, or None if the target is not reached
+        infinity = np.iinfo('int32').max
+        active = self.active_trips(service_date)
+
+        best = np.full(len(self.stop_ids), infinity, dtype='int64')
+        previous = np.full(len(self.stop_ids), infinity, dtype='int64')
+        previous[source] = best[source] = start_secs
+        ride_legs, walk_legs = [{}], [{}]
+
+        marked = {source}
+        for stop, secs in self.footpaths(source):
+            if start_secs + secs < best[stop]:
+                previous[stop] = best[stop] = start_secs + secs
+                walk_legs[0][stop] = (source, start_secs, start_secs + secs)
+                marked.add(stop)
+
+        # Round k reaches the stops that need k vehicles
+        for round_number in range(1, max_transfers + 2):
+            queue = self.patterns_to_scan(np.fromiter(marked, dtype='int64', count=len(marked)))
+            current = previous.copy()
+            rides = {}
+            slack = JOURNEY_TRANSFER_SLACK_SECS if round_number > 1 else 0
+            for pattern, first_position in queue:
+                scanned = self.scan_pattern(pattern, first_position, previous, slack, active)
+                if scanned is None:
+                    continue
+                stops, arrivals, trips, boarded_at, alighted_at = scanned
+                better = (arrivals < best[stops]) & (arrivals < best[target])
+                for i in np.flatnonzero(better).tolist():
+                    stop, arrival = int(stops[i]), int(arrivals[i])
+                    if arrival < best[stop]:
+                        current[stop] = best[stop] = arrival
+                        rides[stop] = (pattern, int(trips[i]), int(boarded_at[i]), int(alighted_at[i]), arrival)
+
+            walks = {}
+            for stop, ride in rides.items():
+                for other, secs in self.footpaths(stop):
+                    arrival = ride[4] + secs
+                    if arrival < best[other] and arrival < best[target]:
+                        current[other] = best[other] = arrival
+                        walks[other] = (stop, ride[4], arrival)
+
+            ride_legs.append(rides)
+            walk_legs.append(walks)
+            marked = set(rides) | set(walks)
+            if not marked:
+                break
+            previous = current
+
+        if best[target] == infinity:
+            return None
+        return int(best[target]), ride_legs, walk_legs
+
+    def footpaths(self, stop: int):
+        start, end = self.footpath_offsets[stop], self.footpath_offsets[stop + 1]
+        return zip(self.footpath_targets[start:end].tolist(), self.footpath_secs[start:end].tolist())
+
+    def journey(self, source: int, target: int, ride_legs: list, walk_legs: list, service_date: date):
+        # The round with the earliest arrival at the target; fewer vehicles win ties
+        arrivals = []
+        for round_number, (rides, walks) in enumerate(zip(ride_legs, walk_legs)):
+            if target in rides:
+                arrivals.append((rides[target][4], round_number))
+            if target in walks:
+                arrivals.append((walks[target][2], round_number))
+        if not arrivals:
+            return None
+        _, round_number = min(arrivals)
+
+        legs, stop = [], target
+        while stop != source:
+            # A stop's label may have been set in an earlier round than the one being walked back
+            while stop not in ride_legs[round_number] and stop not in walk_legs[round_number]:
+                round_number -= 1
+            walk = walk_legs[round_number].get(stop)
+            if walk is not None:
+                # Walks only improve on the rides of their round, so they come last
+                from_stop, departure, arrival = walk
+                legs.append({
+                    "tipo": "pe", "de": self.stop_label(from_stop), "para": self.stop_label(stop),
+                    "partida": gtfs_time(departure), "chegada": gtfs_time(arrival), "duracao_s": arrival - departure
+                })
+                stop = from_stop
+                if stop == source:
+                    break
+            pattern, trip, boarded_at, alighted_at, arrival = ride_legs[round_number][stop]
+            stops, trips, _, departures = self.pattern_block(pattern)
+            trip_index = int(trips[trip])
+            legs.append({
+                "tipo": "autocarro", "linha": str(self.trip_routes[trip_index]),
+                "destino": str(self.trip_headsigns[trip_index]), "trip_id": str(self.trip_ids[trip_index]),
+                "de": self.stop_label(int(stops[boarded_at])), "para": self.stop_label(stop),
+                "partida": gtfs_time(int(departures[trip, boarded_at])), "chegada": gtfs_time(arrival),
+                "paragens": alighted_at - boarded_at
+            })
+            stop = int(stops[boarded_at])
+            round_number -= 1
+
+        legs.reverse()
+        return {
+            "data": service_date.isoformat(),
+            "partida": legs[0]["partida"] if legs else None,
+            "chegada": legs[-1]["chegada"] if legs else None,
+            "transbordos": max(sum(leg["tipo"] == "autocarro" for leg in legs) - 1, 0),
+            "etapas": legs,
+        }
+
+    def stop_label(self, stop: int) -> dict:
+        return {"stop_id": str(self.stop_ids[stop]), "stop_name": str(self.stop_names[stop])}
+
+def timetable_snapshot_path(version: str) -> Path:
+    return Path(SNAPSHOT_DIR) / snapshot_key(version) / SNAPSHOT_FILE_NAME
+
+def write_timetable_snapshot(conn, snapshot_dir: Path) -> Path:
+    timetable = Timetable.build(read_query_frames(conn))
+    path = Path(snapshot_dir) / SNAPSHOT_FILE_NAME
+    timetable.save(path)
+    return path
+
+async def load_journey_planner(engine, version: str, timeout_ms: int) -> Timetable:
+    # The snapshot written by the ETL loads in well under a second; without it
+    # the timetable is rebuilt from the database
+    path = timetable_snapshot_path(version)
+    if path.exists():
+        return await asyncio.to_thread(Timetable.load, path)
+    async with engine.connect() as conn:
+        await conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+        frames = await read_query_frames_async(conn)
+    return await asyncio.to_thread(Timetable.build, frames)
@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
 
+import argparse
+import re
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Manager, get_context
 from pathlib import Path
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from prefect import flow, task, get_run_logger
 
-from config import DATABASE_URL, DATA_BASE_PATH, ZIP_FILE_NAME
-from download_gtfs import download_flow
+from config import DATA_BASE_PATH, ZIP_FILE_NAME, LOAD_MODE, ETL_PARALLEL, ETL_MAX_WORKERS, ETL_DB_CONNECTIONS
+from download_gtfs import download_flow, feed_already_processed, mark_feed_processed
+from gtfs_archive import GTFS_FILES
+from pipelines.loader import get_engine, set_connection_limit
+from pipelines.runner import PIPELINE_FLOWS, run_pipeline
+from journey_planner import write_timetable_snapshot
+from map_matching import write_shape_index_snapshot
+from snapshots import write_snapshots
 
 from pipelines.agency_pipeline import agency_etl_pipeline
 from pipelines.calendar_pipeline import calendar_etl_pipeline
@@ -18,8 +28,15 @@ from pipelines.stops_pipeline import stops_etl_pipeline
 from pipelines.transfers_pipeline import transfers_etl_pipeline
 from pipelines.trips_pipeline import trips_etl_pipeline
 
+LIVE_SCHEMAS = {'raw': 'raw', 'analytics': 'analytics'}
+STAGING_SCHEMAS = {'raw': 'raw_staging', 'analytics': 'analytics_staging'}
+
+def apply_schema_names(sql_script: str, schemas: dict) -> str:
+    # SQL files are written against raw/analytics; retarget schema-qualified names
+    return re.sub(r'\b(raw|analytics)\b(?=[.;])', lambda m: schemas[m.group(1)], sql_script)
+
 @task(name="Execute SQL File")
-def run_sql_file(sql_file_name: str):
+def run_sql_file(sql_file_name: str, schemas: dict = LIVE_SCHEMAS):
     logger = get_run_logger()
     current_dir = Path(__file__).parent
     sql_file_path = current_dir / 'sql' / sql_file_name
@@ -28,36 +45,142 @@ def run_sql_file(sql_file_name: str):
         logger.error(f"SQL file not found at: {sql_file_path}")
         raise FileNotFoundError(f"SQL file not found: {sql_file_path}")
 
-    logger.info(f"Connecting to database to run {sql_file_name}...")
-    engine = create_engine(DATABASE_URL)
+    logger.info(f"Connecting to database to run {sql_file_name} against {schemas['raw']}/{schemas['analytics']}...")
+    engine = get_engine()
     
     with open(sql_file_path, 'r', encoding='utf-8') as f:
-        sql_script = f.read()
+        sql_script = apply_schema_names(f.read(), schemas)
     
     with engine.connect() as conn:
         conn.execute(text(sql_script))
         conn.commit()
     logger.info(f"Successfully executed SQL script: {sql_file_name}")
 
-@task(name="Unzip GTFS Data")
-def unzip_gtfs_data(zip_file_name: str, extract_dir: Path) -> Path:
+@task(name="Prepare Staging Schemas")
+def prepare_staging_schemas():
+    logger = get_run_logger()
+    with get_engine().connect() as conn:
+        # Leftovers from a failed run are never exposed, just discarded here
+        for live, staging in STAGING_SCHEMAS.items():
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {staging} CASCADE"))
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {live}_previous CASCADE"))
+        conn.commit()
+    logger.info(f"Staging schemas reset: {', '.join(STAGING_SCHEMAS.values())}")
+
+@task(name="Analyze Schema Tables")
+def analyze_schema(schema: str):
+    logger = get_run_logger()
+    with get_engine().connect() as conn:
+        tables = conn.execute(
+            text("SELECT tablename FROM pg_tables WHERE schemaname = :schema"), {'schema': schema}
+        ).scalars().all()
+        for table in tables:
+            conn.execute(text(f"ANALYZE {schema}.{table}"))
+        conn.commit()
+    logger.info(f"Analyzed {len(tables)} tables in {schema}")
+
+@task(name="Swap Staging Schemas")
+def swap_staging_schemas():
+    logger = get_run_logger()
+    engine = get_engine()
+
+    # Renaming schemas only touches the catalog, so the swap is a single short
+    # transaction; queries resolve to either the old or the new data, never a mix
+    with engine.connect() as conn:
+        for live, staging in STAGING_SCHEMAS.items():
+            conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {live}"))
+            conn.execute(text(f"ALTER SCHEMA {live} RENAME TO {live}_previous"))
+            conn.execute(text(f"ALTER SCHEMA {staging} RENAME TO {live}"))
+        conn.commit()
+    logger.info("Staging schemas swapped in")
+
+    # Dropped separately so in-flight API queries on the old tables can finish
+    # without holding up the swap
+    with engine.connect() as conn:
+        for live in STAGING_SCHEMAS:
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {live}_previous CASCADE"))
+        conn.commit()
+    logger.info("Previous schemas dropped")
+
+@task(name="Inspect GTFS Archive")
+def inspect_gtfs_archive(zip_file_name: str) -> str:
     logger = get_run_logger()
     zip_path = Path(zip_file_name).resolve()
     
     if not zip_path.exists():
         logger.error(f"ZIP file not found at: {zip_path}")
         raise FileNotFoundError(f"ZIP file not found: {zip_path}")
-        
-    extract_dir.mkdir(parents=True, exist_ok=True)
-    
-    logger.info(f"Unzipping {zip_path} to {extract_dir}...")
+
+    # Pipelines stream their members straight out of the archive, nothing is extracted
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_dir)
-    logger.info(f"Successfully unzipped {len(zip_ref.namelist())} files.")
-    return extract_dir
+        members = set(zip_ref.namelist())
+    missing = [name for name in GTFS_FILES if name not in members]
+    if missing:
+        raise FileNotFoundError(f"GTFS archive {zip_path} is missing: {', '.join(missing)}")
+    logger.info(f"GTFS archive {zip_path} holds {len(members)} files.")
+    return str(zip_path)
+
+@task(name="Run GTFS Pipelines In Parallel")
+def run_pipelines_in_parallel(zip_path: str, target_schema: str) -> list:
+    logger = get_run_logger()
+    logger.info(f"Running {len(PIPELINE_FLOWS)} pipelines on {ETL_MAX_WORKERS} processes, "
+                f"at most {ETL_DB_CONNECTIONS} loading at once")
+
+    completed = []
+    with Manager() as manager:
+        db_slots = manager.BoundedSemaphore(ETL_DB_CONNECTIONS)
+        with ProcessPoolExecutor(
+            max_workers=ETL_MAX_WORKERS,
+            mp_context=get_context('spawn'),
+            initializer=set_connection_limit,
+            initargs=(db_slots,)
+        ) as pool:
+            futures = {pool.submit(run_pipeline, name, zip_path, target_schema): name for name in PIPELINE_FLOWS}
+            try:
+                for future in as_completed(futures):
+                    completed.append(future.result())
+                    logger.info(f"Pipeline finished: {futures[future]} ({len(completed)}/{len(futures)})")
+            except Exception:
+                logger.error(f"Pipeline failed: {futures[future]}")
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise
+    return completed
+
+def run_pipelines_sequentially(zip_path: str, target_schema: str, dependencies: list) -> list:
+    # Subflow calls block, so in this mode the pipelines run one after another
+    agency_run = agency_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    calendar_run = calendar_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    calendar_dates_run = calendar_dates_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    routes_run = routes_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    shapes_run = shapes_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    stop_times_run = stop_times_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    stops_run = stops_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    transfers_run = transfers_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    trips_run = trips_etl_pipeline(zip_path=zip_path, target_schema=target_schema, wait_for=dependencies)
+    
+    return [
+        agency_run, calendar_run, calendar_dates_run, routes_run, 
+        shapes_run, stop_times_run, stops_run, transfers_run, trips_run
+    ]
+
+@task(name="Publish API Snapshots")
+def publish_api_snapshots():
+    logger = get_run_logger()
+    with get_engine().connect() as conn:
+        version = conn.execute(text("SELECT data_atualizacao FROM analytics.kpi_summary LIMIT 1")).scalar()
+        if version is None:
+            logger.warning("No dataset version available, skipping API snapshots")
+            return None
+        snapshot_dir = write_snapshots(conn, version.isoformat())
+        timetable_path = write_timetable_snapshot(conn, snapshot_dir)
+        shape_index_path = write_shape_index_snapshot(conn, snapshot_dir)
+    logger.info(f"API snapshots written to {snapshot_dir}")
+    logger.info(f"Journey planner timetable written to {timetable_path}")
+    logger.info(f"Shape segment index written to {shape_index_path}")
+    return str(snapshot_dir)
 
 @flow(name="Master STCP ETL Flow")
-def master_etl_flow():
+def master_etl_flow(gtfs_url: str = None, force: bool = False):
     logger = get_run_logger()
     logger.info("--- Starting Master ETL Flow ---")
 
@@ -66,32 +189,53 @@ def master_etl_flow():
     data_path.mkdir(parents=True, exist_ok=True)
     zip_path = data_path / ZIP_FILE_NAME
 
-    downloaded_zip_path = download_flow(save_path=str(zip_path))
-    unzipped_path = unzip_gtfs_data(zip_file_name=downloaded_zip_path, extract_dir=data_path)
-    sql_setup_complete = run_sql_file(sql_file_name="create_tables.sql")
+    downloaded_zip_path = download_flow(save_path=str(zip_path), url=gtfs_url)
+    if not force and feed_already_processed(downloaded_zip_path):
+        logger.info("--- Archive unchanged since the last load, skipping ETL ---")
+        return
+    feed_path = inspect_gtfs_archive(zip_file_name=downloaded_zip_path)
+
+    # In shadow mode everything is built in staging schemas and swapped in at the end
+    shadow_load = LOAD_MODE == 'shadow'
+    schemas = STAGING_SCHEMAS if shadow_load else LIVE_SCHEMAS
+    if shadow_load:
+        prepare_staging_schemas()
+    sql_setup_complete = run_sql_file(sql_file_name="create_tables.sql", schemas=schemas)
+    target_schema = schemas['raw']
+
+    processing_dependencies = [sql_setup_complete, feed_path]
+
+    if ETL_PARALLEL:
+        logger.info(f"--- Running all GTFS pipelines in parallel (loading into {target_schema}) ---")
+        all_pipelines_complete = [
+            run_pipelines_in_parallel(feed_path, target_schema, wait_for=processing_dependencies)
+        ]
+    else:
+        logger.info(f"--- Running all GTFS pipelines one after another (loading into {target_schema}) ---")
+        all_pipelines_complete = run_pipelines_sequentially(feed_path, target_schema, processing_dependencies)
+
+    analyzed = analyze_schema(target_schema, wait_for=all_pipelines_complete)
 
-    logger.info("--- Submitting all GTFS pipelines to run in parallel ---")
-    
-    processing_dependencies = [sql_setup_complete, unzipped_path]
-    
-    agency_run = agency_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    calendar_run = calendar_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    calendar_dates_run = calendar_dates_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    routes_run = routes_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    shapes_run = shapes_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    stop_times_run = stop_times_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    stops_run = stops_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    transfers_run = transfers_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    trips_run = trips_etl_pipeline(data_path=str(unzipped_path), wait_for=processing_dependencies)
-    
-    all_pipelines_complete = [
-        agency_run, calendar_run, calendar_dates_run, routes_run, 
-        shapes_run, stop_times_run, stops_run, transfers_run, trips_run
-    ]
     logger.info("--- Submitting final SQL view creation ---")
-    run_sql_file(sql_file_name="dashboard_views.sql", wait_for=all_pipelines_complete)
+    views_complete = run_sql_file(sql_file_name="dashboard_views.sql", schemas=schemas, wait_for=[analyzed])
+
+    if shadow_load:
+        # Materialized views in the fresh staging schema are populated on creation
+        logger.info("--- Swapping staging schemas into place ---")
+        analytics_live = swap_staging_schemas(wait_for=[views_complete])
+    else:
+        logger.info("--- Refreshing materialized analytics views ---")
+        analytics_live = run_sql_file(sql_file_name="refresh_views.sql", wait_for=[views_complete])
+
+    logger.info("--- Publishing pre-rendered API snapshots ---")
+    snapshots_published = publish_api_snapshots(wait_for=[analytics_live])
+    mark_feed_processed(downloaded_zip_path, wait_for=[snapshots_published])
 
     logger.info("--- Master ETL Flow Submitted Successfully ---")
 
 if __name__ == "__main__":
-    master_etl_flow()
+    parser = argparse.ArgumentParser(description="Download the STCP GTFS feed and load it into the warehouse")
+    parser.add_argument('--url', help="GTFS archive URL, skips scraping the portal")
+    parser.add_argument('--force', action='store_true', help="Reload even if this archive was already processed")
+    args = parser.parse_args()
+    master_etl_flow(gtfs_url=args.url, force=args.force)
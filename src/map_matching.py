@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from config import SNAPSHOT_DIR, MAP_MATCH_GRID_CELL_M, MAP_MATCH_MAX_DISTANCE_M
+from journey_planner import EARTH_RADIUS_M, read_query_frames, read_query_frames_async
+from snapshots import snapshot_key
+
+SNAPSHOT_FILE_NAME = 'shape_index.npz'
+METRES_PER_DEGREE = EARTH_RADIUS_M * np.pi / 180
+# Grid cells are packed into one int64 key per (shape, cell)
+CELL_BITS = 20
+CELL_BIAS = 1 << (CELL_BITS - 1)
+NEIGHBOUR_DX, NEIGHBOUR_DY = (offset.ravel() for offset in np.meshgrid([-1, 0, 1], [-1, 0, 1]))
+
+SHAPE_QUERIES = {
+    'shapes': (
+        "SELECT shape_id, shape_pt_lat::float8, shape_pt_lon::float8 FROM raw.shapes "
+        "ORDER BY shape_id, shape_pt_sequence",
+        {'shape_id': str, 'lat': 'float64', 'lon': 'float64'}
+    ),
+    'route_shapes': (
+        # Vehicles report the public line number, which may be the route_id or its short name
+        "SELECT DISTINCT t.route_id, COALESCE(r.route_short_name, t.route_id), t.direction_id, t.shape_id "
+        "FROM raw.trips t LEFT JOIN raw.routes r ON t.route_id = r.route_id "
+        "WHERE t.shape_id IS NOT NULL AND t.shape_id <> ''",
+        {'route_id': str, 'route_short_name': str, 'direction_id': str, 'shape_id': str}
+    ),
+}
+
+def cell_keys(shapes: np.ndarray, cx: np.ndarray, cy: np.ndarray) -> np.ndarray:
+    return (shapes.astype('int64') << (2 * CELL_BITS)) | ((cx + CELL_BIAS) << CELL_BITS) | (cy + CELL_BIAS)
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # Concatenation of arange(start, start + count) for every range
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+class ShapeIndex:
+    # Every shape as straight segments in a local metric projection, with a
+    # per-shape uniform grid (sorted (shape, cell) keys -> segments) so a
+    # vehicle is only compared with the segments of its route near it.
+
+    def __init__(self, arrays: dict):
+        self.arrays = arrays
+        for name, value in arrays.items():
+            setattr(self, name, value)
+        self.origin_lat, self.origin_lon, self.cell_size = (float(value) for value in self.grid)
+        self.x_scale = METRES_PER_DEGREE * np.cos(np.radians(self.origin_lat))
+        self.route_positions = {key: i for i, key in enumerate(self.route_keys.tolist())}
+
+    @classmethod
+    def build(cls, frames: dict) -> 'ShapeIndex':
+        points = frames['shapes']
+        # Codes follow the query order, so each shape's points (and segments) are contiguous and ascending
+        shape_codes, shape_ids = pd.factorize(points['shape_id'])
+        lat, lon = points['lat'].to_numpy(), points['lon'].to_numpy()
+        origin_lat = float(lat.mean()) if len(lat) else 0.0
+        origin_lon = float(lon.mean()) if len(lon) else 0.0
+        cell_size = max(MAP_MATCH_GRID_CELL_M, MAP_MATCH_MAX_DISTANCE_M)
+        x = (lon - origin_lon) * METRES_PER_DEGREE * np.cos(np.radians(origin_lat))
+        y = (lat - origin_lat) * METRES_PER_DEGREE
+
+        # Consecutive points of the same shape form a segment
+        same = shape_codes[1:] == shape_codes[:-1]
+        seg_shape = shape_codes[:-1][same].astype('int32')
+        ax, ay, bx, by = x[:-1][same], y[:-1][same], x[1:][same], y[1:][same]
+        length = np.hypot(bx - ax, by - ay)
+        before = np.cumsum(length) - length
+        first_segment = np.searchsorted(seg_shape, np.arange(len(shape_ids)))
+        seg_start = before - before[first_segment[seg_shape]] if len(seg_shape) else before
+
+        # Each segment goes into every cell its bounding box touches
+        cx0, cx1 = np.floor(np.minimum(ax, bx) / cell_size).astype('int64'), np.floor(np.maximum(ax, bx) / cell_size).astype('int64')
+        cy0, cy1 = np.floor(np.minimum(ay, by) / cell_size).astype('int64'), np.floor(np.maximum(ay, by) / cell_size).astype('int64')
+        nx, ny = cx1 - cx0 + 1, cy1 - cy0 + 1
+        cells = expand_ranges(np.zeros(len(nx), dtype='int64'), nx * ny)
+        segments = np.repeat(np.arange(len(nx)), nx * ny)
+        keys = cell_keys(seg_shape[segments], cx0[segments] + cells % nx[segments], cy0[segments] + cells // nx[segments])
+        order = np.argsort(keys, kind='stable')
+
+        # A route with an unknown direction ("302|") matches the shapes of both directions
+        routes = frames['route_shapes']
+        shape_positions = {shape_id: i for i, shape_id in enumerate(shape_ids)}
+        route_shapes = {}
+        for route_id, short_name, direction_id, shape_id in routes.itertuples(index=False):
+            if shape_id not in shape_positions:
+                continue
+            for route in {route_id, short_name}:
+                for key in (f"{route}|{direction_id}", f"{route}|"):
+                    route_shapes.setdefault(key, set()).add(shape_positions[shape_id])
+        route_keys = sorted(route_shapes)
+        route_offsets = np.zeros(len(route_keys) + 1, dtype='int64')
+        np.cumsum([len(route_shapes[key]) for key in route_keys], out=route_offsets[1:])
+        route_shape_codes = np.array([code for key in route_keys for code in sorted(route_shapes[key])], dtype='int32')
+
+        return cls({
+            'grid': np.array([origin_lat, origin_lon, cell_size]),
+            'shape_ids': np.asarray(shape_ids, dtype=str),
+            'shape_lengths': np.bincount(seg_shape, weights=length, minlength=len(shape_ids)),
+            'seg_shape': seg_shape,
+            'seg_ax': ax, 'seg_ay': ay, 'seg_bx': bx, 'seg_by': by,
+            'seg_start': seg_start,
+            'entry_keys': keys[order],
+            'entry_segments': segments[order].astype('int32'),
+            'route_keys': np.array(route_keys, dtype=str),
+            'route_offsets': route_offsets,
+            'route_shapes': route_shape_codes,
+        })
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **self.arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'ShapeIndex':
+        with np.load(path, allow_pickle=False) as data:
+            return cls({name: data[name] for name in data.files})
+
+    def snap(self, routes: list, lat: np.ndarray, lon: np.ndarray, bearing: np.ndarray):
+        # Projects a whole poll in one pass: every (vehicle, candidate shape)
+        # pair looks up the 3x3 cells around the vehicle, every segment found
+        # is projected onto, and each vehicle keeps its best segment.
+        # Returns per vehicle: shape position (-1 if unmatched), distance along
+        # the shape, snapped lat/lon and distance from the reported position.
+        n = len(routes)
+        px = (lon - self.origin_lon) * self.x_scale
+        py = (lat - self.origin_lat) * METRES_PER_DEGREE
+        shape = np.full(n, -1, dtype='int32')
+        along, offset = np.full(n, np.nan), np.full(n, np.nan)
+
+        rows = np.array([self.route_positions.get(route, -1) for route in routes], dtype='int64')
+        known = np.flatnonzero(rows >= 0)
+        counts = self.route_offsets[rows[known] + 1] - self.route_offsets[rows[known]]
+        vehicles = np.repeat(known, counts)
+        shapes = self.route_shapes[expand_ranges(self.route_offsets[rows[known]], counts)]
+
+        cx = np.floor(px[vehicles] / self.cell_size).astype('int64')
+        cy = np.floor(py[vehicles] / self.cell_size).astype('int64')
+        keys = cell_keys(
+            np.repeat(shapes, len(NEIGHBOUR_DX)),
+            (cx[:, None] + NEIGHBOUR_DX).ravel(), (cy[:, None] + NEIGHBOUR_DY).ravel()
+        )
+        lo = np.searchsorted(self.entry_keys, keys, side='left')
+        hits = np.searchsorted(self.entry_keys, keys, side='right') - lo
+        candidates = np.repeat(np.repeat(vehicles, len(NEIGHBOUR_DX)), hits)
+        segments = self.entry_segments[expand_ranges(lo, hits)]
+        if len(segments) == 0:
+            return shape, along, np.full(n, np.nan), np.full(n, np.nan), offset
+
+        ax, ay = self.seg_ax[segments], self.seg_ay[segments]
+        dx, dy = self.seg_bx[segments] - ax, self.seg_by[segments] - ay
+        length2 = dx * dx + dy * dy
+        qx, qy = px[candidates] - ax, py[candidates] - ay
+        t = np.clip(np.divide(qx * dx + qy * dy, length2, out=np.zeros_like(length2), where=length2 > 0), 0, 1)
+        distance = np.hypot(qx - t * dx, qy - t * dy)
+
+        # Where a road is used in both directions, a segment heading against the
+        # vehicle's bearing only wins if nothing else is within reach
+        heading = np.degrees(np.arctan2(dx, dy)) % 360
+        turn = np.abs((heading - bearing[candidates] + 180) % 360 - 180)
+        score = distance + np.where(turn > 90, MAP_MATCH_MAX_DISTANCE_M, 0)
+
+        within = np.flatnonzero(distance <= MAP_MATCH_MAX_DISTANCE_M)
+        order = within[np.lexsort((score[within], candidates[within]))]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = candidates[order][1:] != candidates[order][:-1]
+        best = order[first]
+        matched = candidates[best]
+
+        shape[matched] = self.seg_shape[segments[best]]
+        along[matched] = self.seg_start[segments[best]] + t[best] * np.sqrt(length2[best])
+        offset[matched] = distance[best]
+        snapped_x = np.full(n, np.nan)
+        snapped_y = np.full(n, np.nan)
+        snapped_x[matched] = ax[best] + t[best] * dx[best]
+        snapped_y[matched] = ay[best] + t[best] * dy[best]
+        return (
+            shape, along, snapped_y / METRES_PER_DEGREE + self.origin_lat,
+            snapped_x / self.x_scale + self.origin_lon, offset
+        )
+
+    def snap_vehicles(self, vehicles: list) -> None:
+        # Adds the matched shape and distance along it to each vehicle row
+        routes = [f"{vehicle['route_id']}|{vehicle['sentido'] or ''}" for vehicle in vehicles]
+        lat = np.array([vehicle['lat'] for vehicle in vehicles], dtype='float64')
+        lon = np.array([vehicle['lon'] for vehicle in vehicles], dtype='float64')
+        bearing = np.array([
+            vehicle['bearing'] if isinstance(vehicle['bearing'], (int, float)) else np.nan for vehicle in vehicles
+        ], dtype='float64')
+        shape, along, snapped_lat, snapped_lon, offset = self.snap(routes, lat, lon, bearing)
+
+        for i, vehicle in enumerate(vehicles):
+            matched = shape[i] >= 0
+            vehicle.update({
+                "shape_id": str(self.shape_ids[shape[i]]) if matched else None,
+                "shape_dist_m": round(float(along[i]), 1) if matched else None,
+                "shape_length_m": round(float(self.shape_lengths[shape[i]]), 1) if matched else None,
+                "snapped_lat": round(float(snapped_lat[i]), 7) if matched else None,
+                "snapped_lon": round(float(snapped_lon[i]), 7) if matched else None,
+                "snap_offset_m": round(float(offset[i]), 1) if matched else None,
+            })
+
+def shape_index_snapshot_path(version: str) -> Path:
+    return Path(SNAPSHOT_DIR) / snapshot_key(version) / SNAPSHOT_FILE_NAME
+
+def write_shape_index_snapshot(conn, snapshot_dir: Path) -> Path:
+    index = ShapeIndex.build(read_query_frames(conn, SHAPE_QUERIES))
+    path = Path(snapshot_dir) / SNAPSHOT_FILE_NAME
+    index.save(path)
+    return path
+
+async def load_shape_index(engine, version: str, timeout_ms: int) -> ShapeIndex:
+    path = shape_index_snapshot_path(version)
+    if path.exists():
+        return await asyncio.to_thread(ShapeIndex.load, path)
+    async with engine.connect() as conn:
+        await conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+        frames = await read_query_frames_async(conn, SHAPE_QUERIES)
+    return await asyncio.to_thread(ShapeIndex.build, frames)
@@ -1,19 +1,61 @@
 #!/usr/bin/env python3
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
 from prefect import flow, task
 from prefect.logging import get_run_logger
-import os
-from config import DATABASE_URL
+from pipelines.loader import copy_to_postgres
+from pipelines.feed_cache import read_gtfs_frame
+from pipelines.schema import drop_invalid_rows
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+SERVICE_DATES_INDEXES = {
+    'service_dates_date_idx': "CREATE INDEX {name} ON {table} (date, service_id)",
+}
+
+def expand_service_days(calendar: pd.DataFrame, calendar_dates: pd.DataFrame):
+    # One row per service and feed day: weekday flags within the service's
+    # date range, then the calendar_dates additions (1) and removals (2)
+    service_ids = pd.Index(pd.unique(pd.concat([
+        calendar['service_id'].astype(str), calendar_dates['service_id'].astype(str)
+    ], ignore_index=True)))
+    bounds = pd.concat([calendar['start_date'], calendar['end_date'], calendar_dates['date']])
+    if service_ids.empty or bounds.isna().all():
+        return pd.DataFrame(columns=['service_id', 'date']), pd.DataFrame(columns=['service_id', 'start_date', 'day_count', 'active_days'])
+    days = pd.date_range(bounds.min(), bounds.max(), freq='D')
+
+    active = np.zeros((len(service_ids), len(days)), dtype=bool)
+    rows = service_ids.get_indexer(calendar['service_id'].astype(str))
+    flags = calendar[WEEKDAYS].to_numpy(dtype='int8') == 1
+    day_values = days.to_numpy()
+    in_range = (
+        (day_values >= calendar['start_date'].to_numpy()[:, None]) &
+        (day_values <= calendar['end_date'].to_numpy()[:, None])
+    )
+    active[rows] = in_range & flags[:, days.weekday]
+
+    exception_rows = service_ids.get_indexer(calendar_dates['service_id'].astype(str))
+    exception_days = days.get_indexer(calendar_dates['date'])
+    active[exception_rows, exception_days] = calendar_dates['exception_type'].to_numpy() == 1
+
+    service_rows, day_positions = np.nonzero(active)
+    service_dates = pd.DataFrame({'service_id': service_ids[service_rows], 'date': days[day_positions]})
+    # Bit i of active_days is day start_date + i, the same origin for every service
+    bits = np.where(active, '1', '0')
+    bitmaps = pd.DataFrame({
+        'service_id': service_ids,
+        'start_date': days[0],
+        'day_count': len(days),
+        'active_days': [''.join(row) for row in bits],
+    })
+    return service_dates, bitmaps
 
 @task
-def extract_calendar_data(data_path: str) -> pd.DataFrame:
+def extract_calendar_data(zip_path: str) -> pd.DataFrame:
     logger = get_run_logger()
-    file_path = os.path.join(data_path, 'calendar.txt')
     
-    logger.info(f"Reading file: {file_path}")
-    df = pd.read_csv(file_path)
+    df = read_gtfs_frame(zip_path, 'calendar')
     logger.info(f"File read successfully: {len(df)} records")
     return df
 
@@ -21,53 +63,50 @@ def extract_calendar_data(data_path: str) -> pd.DataFrame:
 def transform_calendar_data(df: pd.DataFrame) -> pd.DataFrame:
     logger = get_run_logger()
     
-    df_clean = df.copy()
+    df_clean = drop_invalid_rows(df, 'calendar')
 
-    for col in df_clean.select_dtypes(include=['object']).columns:
-        df_clean[col] = df_clean[col].astype(str).str.strip()
+    if len(df_clean) < len(df):
+        logger.warning(f"Removed {len(df) - len(df_clean)} invalid records.")
 
-    df_clean = df_clean[df_clean['service_id'].notna()]
-    df_clean = df_clean[df_clean['service_id'] != '']
-    
-    days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
-    for day in days:
-        df_clean[day] = pd.to_numeric(df_clean[day], errors='coerce').fillna(0).astype(int)
-    
-    df_clean['start_date'] = pd.to_datetime(df_clean['start_date'], format='%Y%m%d', errors='coerce')
-    df_clean['end_date'] = pd.to_datetime(df_clean['end_date'], format='%Y%m%d', errors='coerce')
-    df_clean.dropna(subset=['start_date', 'end_date'], inplace=True)
-    
     logger.info(f"Transformations completed: {len(df_clean)} valid records")
     return df_clean
 
 @task
-def load_calendar_to_postgres(df: pd.DataFrame) -> int:
+def load_calendar_to_postgres(df: pd.DataFrame, schema: str = 'raw') -> int:
     logger = get_run_logger()
-    engine = create_engine(DATABASE_URL)
-    
-    with engine.connect() as conn:
-        conn.execute(text("DELETE FROM raw.calendar"))
-        conn.commit()
-
-    df.to_sql(
-        name='calendar',
-        con=engine,
-        schema='raw',
-        if_exists='append',
-        index=False
-    )
-    
-    logger.info(f"Inserted {len(df)} records into raw.calendar table")
-    return len(df)
+    record_count = copy_to_postgres(df, 'calendar', schema)
+    logger.info(f"Inserted {record_count} records into {schema}.calendar table")
+    return record_count
+
+@task
+def expand_service_calendar(df: pd.DataFrame, zip_path: str):
+    logger = get_run_logger()
+    # calendar_dates is read here too (from the Parquet cache when warm), since
+    # the exceptions belong in the same per-day expansion
+    calendar_dates = drop_invalid_rows(read_gtfs_frame(zip_path, 'calendar_dates'), 'calendar_dates')
+    service_dates, bitmaps = expand_service_days(df, calendar_dates)
+    logger.info(f"Expanded {len(bitmaps)} services into {len(service_dates)} active service days")
+    return service_dates, bitmaps
+
+@task
+def load_service_calendar_to_postgres(service_dates: pd.DataFrame, bitmaps: pd.DataFrame, schema: str = 'raw') -> int:
+    logger = get_run_logger()
+    record_count = copy_to_postgres(service_dates, 'service_dates', schema, indexes=SERVICE_DATES_INDEXES)
+    logger.info(f"Inserted {record_count} records into {schema}.service_dates table")
+    bitmap_count = copy_to_postgres(bitmaps, 'service_bitmaps', schema)
+    logger.info(f"Inserted {bitmap_count} records into {schema}.service_bitmaps table")
+    return record_count
 
 @flow(name="STCP GTFS Calendar Pipeline")
-def calendar_etl_pipeline(data_path: str):
+def calendar_etl_pipeline(zip_path: str, target_schema: str = 'raw'):
     logger = get_run_logger()
     logger.info("Starting Calendar Pipeline")
     
-    df = extract_calendar_data(data_path)
+    df = extract_calendar_data(zip_path)
     df_transformed = transform_calendar_data(df)
-    record_count = load_calendar_to_postgres(df_transformed)
+    record_count = load_calendar_to_postgres(df_transformed, target_schema)
+    service_dates, bitmaps = expand_service_calendar(df_transformed, zip_path)
+    load_service_calendar_to_postgres(service_dates, bitmaps, target_schema)
     
     logger.info(f"Calendar Pipeline completed successfully: {record_count} records processed")
 
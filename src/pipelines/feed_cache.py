@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from prefect.logging import get_run_logger
+
+from config import PARQUET_CACHE, PARQUET_CACHE_DIR, PARQUET_CACHE_MAX_BYTES
+from gtfs_archive import feed_version, open_gtfs_member
+from pipelines.schema import GTFS_SCHEMAS, STRING_DTYPE, coerce_schema, read_dtypes
+
+# Parquet column type for each schema kind; categories are stored as plain
+# strings (dictionary-encoded by Parquet) and read back as categoricals
+ARROW_TYPES = {
+    'string': pa.string(),
+    'category': pa.string(),
+    'int': pa.int32(),
+    'float': pa.float64(),
+    'date': pa.timestamp('us'),
+}
+
+PANDAS_TYPES = {
+    pa.string(): STRING_DTYPE,
+    pa.large_string(): STRING_DTYPE,
+    pa.int32(): pd.Int32Dtype(),
+}
+
+def schema_digest(table_name: str) -> str:
+    # Changing a table's rules changes its typed output, so it gets a new file
+    return hashlib.sha256(repr(GTFS_SCHEMAS[table_name]).encode()).hexdigest()[:12]
+
+def cache_file(zip_path: str, table_name: str) -> Path:
+    return Path(PARQUET_CACHE_DIR) / feed_version(zip_path) / f"{table_name}-{schema_digest(table_name)}.parquet"
+
+def schema_columns(table_name: str) -> list:
+    return list(GTFS_SCHEMAS[table_name])
+
+def category_columns(table_name: str) -> list:
+    return [name for name, column in GTFS_SCHEMAS[table_name].items() if column.kind == 'category']
+
+def arrow_schema(df: pd.DataFrame, table_name: str) -> pa.Schema:
+    schema = GTFS_SCHEMAS[table_name]
+    return pa.schema([(name, ARROW_TYPES[schema[name].kind]) for name in df.columns])
+
+def to_frame(data) -> pd.DataFrame:
+    return data.to_pandas(types_mapper=PANDAS_TYPES.get)
+
+def file_size(path: Path) -> int:
+    # Other pipeline workers rename or evict files while the cache is scanned
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+def evict_old_versions(current_version: str) -> None:
+    # Least recently used feed versions go first; the one in use is never removed
+    logger = get_run_logger()
+    cache_root = Path(PARQUET_CACHE_DIR)
+    versions = []
+    for version_dir in cache_root.iterdir():
+        if not version_dir.is_dir():
+            continue
+        try:
+            # Files still being written by a worker are not part of the cache yet
+            size = sum(file_size(path) for path in version_dir.iterdir() if path.is_file() and path.suffix != '.tmp')
+            versions.append((version_dir.stat().st_mtime, version_dir, size))
+        except FileNotFoundError:
+            continue
+
+    total = sum(size for _, _, size in versions)
+    for _, version_dir, size in sorted(versions, key=lambda version: version[0]):
+        if total <= PARQUET_CACHE_MAX_BYTES:
+            break
+        if version_dir.name == current_version:
+            continue
+        shutil.rmtree(version_dir, ignore_errors=True)
+        total -= size
+        logger.info(f"Evicted Parquet cache for feed {version_dir.name} ({size} bytes)")
+
+class CacheWriter:
+    # Streams typed frames into a temporary Parquet file that only replaces
+    # the cache entry once every chunk has been written
+
+    def __init__(self, zip_path: str, table_name: str):
+        self.table_name = table_name
+        self.path = cache_file(zip_path, table_name)
+        self.tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        self.writer = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.schema = arrow_schema(df, self.table_name)
+            self.writer = pq.ParquetWriter(self.tmp_path, self.schema)
+        table = pa.Table.from_pandas(df, preserve_index=False).select(self.schema.names)
+        self.writer.write_table(table.cast(self.schema))
+
+    def commit(self) -> None:
+        if self.writer is None:
+            return
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+        evict_old_versions(self.path.parent.name)
+
+    def abort(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+def cached_file(zip_path: str, table_name: str):
+    if not PARQUET_CACHE:
+        return None
+    path = cache_file(zip_path, table_name)
+    if not path.exists():
+        return None
+    # Marks the feed version as recently used for eviction
+    os.utime(path.parent)
+    return path
+
+def read_cached_columns(path: Path, table_name: str) -> list:
+    names = pq.read_schema(path).names
+    return [name for name in schema_columns(table_name) if name in names]
+
+def read_gtfs_frame(zip_path: str, table_name: str) -> pd.DataFrame:
+    logger = get_run_logger()
+    path = cached_file(zip_path, table_name)
+    if path is not None:
+        logger.info(f"Reading {table_name} from Parquet cache {path}")
+        table = pq.read_table(
+            path, columns=read_cached_columns(path, table_name), read_dictionary=category_columns(table_name)
+        )
+        return to_frame(table)
+
+    member = f"{table_name}.txt"
+    logger.info(f"Reading {member} from {zip_path}")
+    with open_gtfs_member(zip_path, member) as f:
+        df = pd.read_csv(f, dtype=read_dtypes(table_name), usecols=lambda name: name in GTFS_SCHEMAS[table_name])
+    coerce_schema(df, table_name)
+
+    if PARQUET_CACHE:
+        writer = CacheWriter(zip_path, table_name)
+        try:
+            writer.write(df)
+            writer.commit()
+        except Exception:
+            writer.abort()
+            raise
+    return df
+
+def iter_gtfs_frames(zip_path: str, table_name: str, chunk_size: int):
+    logger = get_run_logger()
+    path = cached_file(zip_path, table_name)
+    if path is not None:
+        logger.info(f"Reading {table_name} from Parquet cache {path}")
+        parquet_file = pq.ParquetFile(path, read_dictionary=category_columns(table_name))
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=read_cached_columns(path, table_name)):
+            yield to_frame(batch)
+        return
+
+    member = f"{table_name}.txt"
+    writer = CacheWriter(zip_path, table_name) if PARQUET_CACHE else None
+    completed = False
+    try:
+        with open_gtfs_member(zip_path, member) as f, \
+                pd.read_csv(f, dtype=read_dtypes(table_name), usecols=lambda name: name in GTFS_SCHEMAS[table_name],
+                            chunksize=chunk_size) as reader:
+            for chunk in reader:
+                coerce_schema(chunk, table_name)
+                if writer:
+                    writer.write(chunk)
+                yield chunk
+        completed = True
+    finally:
+        # A partly consumed or failed read must not leave a truncated cache entry
+        if writer:
+            if completed:
+                writer.commit()
+            else:
+                writer.abort()
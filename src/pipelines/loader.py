@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import io
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from prefect.logging import get_run_logger
+
+from config import DATABASE_URL, COPY_BUFFER_ROWS, LOAD_MODE
+
+# GTFS natural key of every raw table, used to match rows between loads
+NATURAL_KEYS = {
+    'agency': ['agency_id'],
+    'calendar': ['service_id'],
+    'calendar_dates': ['service_id', 'date'],
+    'routes': ['route_id'],
+    'service_bitmaps': ['service_id'],
+    'service_dates': ['service_id', 'date'],
+    'shapes': ['shape_id', 'shape_pt_sequence'],
+    'shape_metrics': ['shape_id'],
+    'stop_times': ['trip_key', 'stop_sequence'],
+    'stop_keys': ['stop_id'],
+    'stops': ['stop_id'],
+    'transfers': ['from_stop_id', 'to_stop_id'],
+    'trip_keys': ['trip_id'],
+    'trips': ['trip_id'],
+}
+
+# Marks missing values in COPY input, so empty strings stay empty strings
+COPY_NULL = '\\N'
+
+# Shared across worker processes when pipelines run in parallel, bounding
+# how many bulk loads hit the database at once
+_connection_slots = None
+
+@lru_cache(maxsize=1)
+def get_engine():
+    return create_engine(DATABASE_URL)
+
+def set_connection_limit(slots) -> None:
+    global _connection_slots
+    _connection_slots = slots
+
+@contextmanager
+def connection_slot():
+    if _connection_slots is None:
+        yield
+        return
+    with _connection_slots:
+        yield
+
+class SurrogateKeys:
+    # Maps GTFS string ids to compact integer keys, reusing the keys stored by
+    # the previous load so they stay stable across differential loads
+
+    def __init__(self, table_name: str, id_column: str, key_column: str, schema: str = 'raw'):
+        self.table_name = table_name
+        self.id_column = id_column
+        self.key_column = key_column
+        existing = pd.read_sql(
+            f"SELECT {id_column}, {key_column} FROM {schema}.{table_name} ORDER BY {key_column}",
+            get_engine()
+        )
+        self.ids = pd.Index(existing[id_column].astype(str))
+        self.keys = existing[key_column].to_numpy(dtype='int32')
+        self.used = np.zeros(len(self.ids), dtype=bool)
+
+    def encode(self, values: pd.Series) -> np.ndarray:
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Only the distinct ids are looked up; rows map onto them through the codes
+            values = values.cat.remove_unused_categories()
+            return self.encode(pd.Series(values.cat.categories))[values.cat.codes.to_numpy()]
+        positions = self.ids.get_indexer(values)
+        missing = positions == -1
+        if missing.any():
+            new_ids = pd.unique(values[missing])
+            next_key = int(self.keys.max()) + 1 if len(self.keys) else 1
+            self.ids = self.ids.append(pd.Index(new_ids))
+            self.keys = np.concatenate([self.keys, np.arange(next_key, next_key + len(new_ids), dtype='int32')])
+            self.used = np.concatenate([self.used, np.zeros(len(new_ids), dtype=bool)])
+            positions[missing] = self.ids.get_indexer(values[missing])
+        self.used[positions] = True
+        return self.keys[positions]
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            self.key_column: self.keys[self.used],
+            self.id_column: self.ids[self.used],
+        })
+
+def _quote_columns(columns) -> str:
+    return ', '.join(f'"{col}"' for col in columns)
+
+def _row_hashes(df: pd.DataFrame) -> pd.Series:
+    return pd.Series(
+        pd.util.hash_pandas_object(df, index=False).to_numpy().view('int64'),
+        index=df.index
+    )
+
+def _copy_frame(cursor, df: pd.DataFrame, target: str, buffer: io.StringIO) -> None:
+    # One COPY per slice keeps the CSV buffer small. Missing values are written
+    # as \N, because COPY csv would otherwise also read the '' defaults filled
+    # in by the schema as NULL
+    columns = list(df.columns) + ['row_hash']
+    copy_sql = f"COPY {target} ({_quote_columns(columns)}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')"
+    for start in range(0, len(df), COPY_BUFFER_ROWS):
+        part = df.iloc[start:start + COPY_BUFFER_ROWS]
+        buffer.seek(0)
+        buffer.truncate(0)
+        part.assign(row_hash=_row_hashes(part)).to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+
+def _copy_chunks(cursor, chunks, target: str) -> tuple[int, list]:
+    buffer = io.StringIO()
+    total_records = 0
+    columns = []
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        _copy_frame(cursor, chunk, target, buffer)
+        total_records += len(chunk)
+        columns = list(chunk.columns)
+    return total_records, columns
+
+def _merge_staged_rows(cursor, stage: str, target: str, keys: list, columns: list) -> dict:
+    key_match = ' AND '.join(f't."{key}" = s."{key}"' for key in keys)
+    value_columns = [col for col in columns if col not in keys] + ['row_hash']
+    assignments = ', '.join(f'"{col}" = s."{col}"' for col in value_columns)
+    insert_columns = _quote_columns(columns + ['row_hash'])
+
+    cursor.execute(f"DELETE FROM {target} t WHERE NOT EXISTS (SELECT 1 FROM {stage} s WHERE {key_match})")
+    deleted = cursor.rowcount
+    cursor.execute(
+        f"UPDATE {target} t SET {assignments}, created_at = CURRENT_TIMESTAMP FROM {stage} s "
+        f"WHERE {key_match} AND t.row_hash IS DISTINCT FROM s.row_hash"
+    )
+    updated = cursor.rowcount
+    cursor.execute(
+        f"INSERT INTO {target} ({insert_columns}) SELECT {insert_columns} FROM {stage} s "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {target} t WHERE {key_match})"
+    )
+    inserted = cursor.rowcount
+    return {'inserted': inserted, 'updated': updated, 'deleted': deleted}
+
+def _index_exists(cursor, schema: str, index_name: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s)", (f"{schema}.{index_name}",))
+    return cursor.fetchone()[0] is not None
+
+def copy_to_postgres(data, table_name: str, schema: str = 'raw', mode: str = None, indexes: dict = None) -> int:
+    logger = get_run_logger()
+    mode = mode or LOAD_MODE
+    target = f"{schema}.{table_name}"
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+    # Secondary indexes are built after the bulk load instead of maintained row by row
+    indexes = indexes or {}
+
+    with connection_slot():
+        started = time.perf_counter()
+        total_records = _load_chunks(chunks, table_name, schema, target, mode, indexes)
+
+    elapsed = time.perf_counter() - started
+    rate = total_records / elapsed if elapsed > 0 else 0
+    logger.info(f"Copied {total_records} records into {target} in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+    return total_records
+
+def _load_chunks(chunks, table_name: str, schema: str, target: str, mode: str, indexes: dict) -> int:
+    logger = get_run_logger()
+    conn = get_engine().raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            if mode == 'diff':
+                # Stage the new feed next to the previous load and only apply
+                # the rows whose content hash changed
+                stage = f"{table_name}_stage"
+                for index_name, index_sql in indexes.items():
+                    if not _index_exists(cursor, schema, index_name):
+                        cursor.execute(index_sql.format(name=index_name, table=target))
+                cursor.execute(f"CREATE TEMP TABLE {stage} (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP")
+                total_records, columns = _copy_chunks(cursor, chunks, stage)
+                changes = _merge_staged_rows(cursor, stage, target, NATURAL_KEYS[table_name], columns)
+                unchanged = total_records - changes['inserted'] - changes['updated']
+                logger.info(
+                    f"Diff load of {target}: {changes['inserted']} inserted, {changes['updated']} updated, "
+                    f"{changes['deleted']} deleted, {unchanged} unchanged"
+                )
+            else:
+                for index_name in indexes:
+                    cursor.execute(f"DROP INDEX IF EXISTS {schema}.{index_name}")
+                cursor.execute(f"DELETE FROM {target}")
+                total_records, _ = _copy_chunks(cursor, chunks, target)
+                for index_name, index_sql in indexes.items():
+                    cursor.execute(index_sql.format(name=index_name, table=target))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return total_records
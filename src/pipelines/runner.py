@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+import importlib
+
+# Longest pipelines first so the slowest one starts straight away
+PIPELINE_FLOWS = {
+    'stop_times': ('pipelines.stop_times_pipeline', 'stop_times_etl_pipeline'),
+    'shapes': ('pipelines.shapes_pipeline', 'shapes_etl_pipeline'),
+    'trips': ('pipelines.trips_pipeline', 'trips_etl_pipeline'),
+    'stops': ('pipelines.stops_pipeline', 'stops_etl_pipeline'),
+    'calendar_dates': ('pipelines.calendar_dates_pipeline', 'calendar_dates_etl_pipeline'),
+    'transfers': ('pipelines.transfers_pipeline', 'transfers_etl_pipeline'),
+    'routes': ('pipelines.routes_pipeline', 'routes_etl_pipeline'),
+    'calendar': ('pipelines.calendar_pipeline', 'calendar_etl_pipeline'),
+    'agency': ('pipelines.agency_pipeline', 'agency_etl_pipeline'),
+}
+
+def run_pipeline(name: str, zip_path: str, target_schema: str) -> str:
+    # Entry point for worker processes: each pipeline runs as its own flow run
+    module_name, flow_name = PIPELINE_FLOWS[name]
+    pipeline_flow = getattr(importlib.import_module(module_name), flow_name)
+    pipeline_flow(zip_path=zip_path, target_schema=target_schema)
+    return name
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+# Arrow-backed strings keep ids and names out of per-row Python objects
+STRING_DTYPE = pd.StringDtype('pyarrow')
+
+class Column(NamedTuple):
+    # kind is 'string', 'category' (few distinct values), 'int', 'float' or 'date' (GTFS YYYYMMDD)
+    kind: str
+    required: bool = False
+    default: object = None
+    valid_range: tuple = None
+
+DAY_FLAG = Column('int', default=0)
+
+# Declarative cleaning rules for every GTFS file, keyed by raw table name.
+# Text is trimmed and empty strings count as missing; required columns drop
+# the row when missing or out of range, defaults fill the remaining gaps
+GTFS_SCHEMAS = {
+    'agency': {
+        'agency_id': Column('string', required=True),
+        'agency_name': Column('string'),
+        'agency_url': Column('string', default=''),
+        'agency_timezone': Column('category', default=''),
+        'agency_lang': Column('category', default=''),
+    },
+    'calendar': {
+        'service_id': Column('string', required=True),
+        'monday': DAY_FLAG, 'tuesday': DAY_FLAG, 'wednesday': DAY_FLAG, 'thursday': DAY_FLAG,
+        'friday': DAY_FLAG, 'saturday': DAY_FLAG, 'sunday': DAY_FLAG,
+        'start_date': Column('date', required=True),
+        'end_date': Column('date', required=True),
+    },
+    'calendar_dates': {
+        'service_id': Column('category', required=True),
+        'date': Column('date', required=True),
+        'exception_type': Column('int', default=1),
+    },
+    'routes': {
+        'route_id': Column('string', required=True),
+        'route_short_name': Column('string'),
+        'route_long_name': Column('string'),
+        'route_desc': Column('string', default=''),
+        'route_type': Column('int', required=True),
+        'route_url': Column('string', default=''),
+        'route_color': Column('category', default=''),
+        'route_text_color': Column('category', default=''),
+    },
+    'shapes': {
+        'shape_id': Column('category', required=True),
+        'shape_pt_lat': Column('float', required=True, valid_range=(-90, 90)),
+        'shape_pt_lon': Column('float', required=True, valid_range=(-180, 180)),
+        'shape_pt_sequence': Column('int', required=True),
+    },
+    'stop_times': {
+        'trip_id': Column('category', required=True),
+        'arrival_time': Column('string'),
+        'departure_time': Column('string'),
+        'stop_id': Column('category', required=True),
+        'stop_sequence': Column('int', required=True, valid_range=(0, None)),
+        'stop_headsign': Column('string'),
+    },
+    'stops': {
+        'stop_id': Column('string', required=True),
+        'stop_code': Column('string'),
+        'stop_name': Column('string'),
+        'stop_lat': Column('float', required=True, valid_range=(-90, 90)),
+        'stop_lon': Column('float', required=True, valid_range=(-180, 180)),
+        'zone_id': Column('category'),
+        'stop_url': Column('string'),
+    },
+    'transfers': {
+        'from_stop_id': Column('string', required=True),
+        'to_stop_id': Column('string', required=True),
+        'transfer_type': Column('int', default=0),
+    },
+    'trips': {
+        'route_id': Column('category', required=True),
+        'direction_id': Column('int', required=True),
+        'service_id': Column('category', required=True),
+        'trip_id': Column('string', required=True),
+        'trip_headsign': Column('string', default=''),
+        'wheelchair_accessible': Column('int', default=0),
+        'block_id': Column('string', default=''),
+        'shape_id': Column('category', default=''),
+    },
+}
+
+def read_dtypes(table_name: str) -> dict:
+    # Text is parsed straight into its final dtype; numbers are left to the C
+    # parser and only coerced when a field did not parse
+    dtypes = {}
+    for name, column in GTFS_SCHEMAS[table_name].items():
+        if column.kind in ('string', 'date'):
+            dtypes[name] = STRING_DTYPE
+        elif column.kind == 'category':
+            dtypes[name] = 'category'
+    return dtypes
+
+def _clean_strings(values: pd.Series) -> pd.Series:
+    if values.dtype != STRING_DTYPE:
+        values = values.astype(STRING_DTYPE)
+    values = values.str.strip()
+    return values.mask((values == '').fillna(False))
+
+def _clean_categories(values: pd.Series) -> pd.Series:
+    # Trimming is done once per distinct value and the row codes are remapped,
+    # so ' X ' and 'X' collapse into one category without touching every row
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    stripped = values.cat.categories.astype(str).str.strip()
+    category_codes, categories = pd.factorize(stripped.where(stripped != ''))
+    row_codes = values.cat.codes.to_numpy()
+    codes = np.full(len(row_codes), -1, dtype=category_codes.dtype)
+    present = row_codes >= 0
+    codes[present] = category_codes[row_codes[present]]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=values.index, name=values.name)
+
+def _coerce(values: pd.Series, kind: str) -> pd.Series:
+    if kind == 'string':
+        return _clean_strings(values)
+    if kind == 'category':
+        return _clean_categories(values)
+    if kind == 'date':
+        return pd.to_datetime(values, format='%Y%m%d', errors='coerce')
+    numbers = pd.to_numeric(values, errors='coerce')
+    if kind == 'int':
+        return numbers.where(numbers % 1 == 0).astype('Int32')
+    return numbers.astype('float64')
+
+def _fill_default(values: pd.Series, default) -> pd.Series:
+    if isinstance(values.dtype, pd.CategoricalDtype) and default not in values.cat.categories:
+        values = values.cat.add_categories([default])
+    return values.fillna(default)
+
+def _in_range(values: pd.Series, valid_range: tuple) -> np.ndarray:
+    low, high = valid_range
+    inside = values.notna()
+    if low is not None:
+        inside &= values >= low
+    if high is not None:
+        inside &= values <= high
+    return inside.fillna(False).to_numpy(dtype=bool)
+
+def coerce_schema(df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    # Types, trims and fills the columns of the frame it is given, in place
+    for name, column in GTFS_SCHEMAS[table_name].items():
+        if name not in df.columns:
+            if column.required:
+                raise ValueError(f"Required column {name} is missing from {table_name}")
+            continue
+        values = _coerce(df[name], column.kind)
+        if column.default is not None:
+            values = _fill_default(values, column.default)
+        df[name] = values
+    return df
+
+def drop_invalid_rows(df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    # One validity mask over every rule, so the filtered frame is the only copy made
+    valid = np.ones(len(df), dtype=bool)
+    for name, column in GTFS_SCHEMAS[table_name].items():
+        if not column.required:
+            continue
+        valid &= df[name].notna().to_numpy(dtype=bool)
+        if column.valid_range is not None:
+            valid &= _in_range(df[name], column.valid_range)
+    return df if valid.all() else df[valid]
+
+def apply_schema(df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    return drop_invalid_rows(coerce_schema(df, table_name), table_name)
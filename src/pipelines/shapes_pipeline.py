@@ -1,19 +1,63 @@
 #!/usr/bin/env python3
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
 from prefect import flow, task
 from prefect.logging import get_run_logger
-import os
-from config import DATABASE_URL
+from pipelines.loader import copy_to_postgres
+from pipelines.feed_cache import read_gtfs_frame
+from pipelines.schema import drop_invalid_rows
+
+# geom is generated from shape_pt_lat/shape_pt_lon during the load
+SHAPES_INDEXES = {
+    'shapes_geom_idx': "CREATE INDEX {name} ON {table} USING GIST (geom)",
+}
+
+# Mean Earth radius (IUGG), in kilometres
+EARTH_RADIUS_KM = 6371.0088
+
+def shape_metrics(df: pd.DataFrame) -> pd.DataFrame:
+    # Polyline length, point count and bounding box of every shape, computed
+    # over the points sorted by shape and sequence without a per-shape loop
+    if df.empty:
+        return pd.DataFrame({
+            'shape_id': pd.Series(dtype=str),
+            'point_count': pd.Series(dtype='int32'),
+            **{name: pd.Series(dtype='float64') for name in ('length_km', 'min_lat', 'min_lon', 'max_lat', 'max_lon')},
+        })
+    shape_ids = df['shape_id'].astype('category')
+    codes = shape_ids.cat.codes.to_numpy()
+    order = np.lexsort((df['shape_pt_sequence'].to_numpy(dtype='int64'), codes))
+    codes = codes[order]
+    lat = df['shape_pt_lat'].to_numpy(dtype='float64')[order]
+    lon = df['shape_pt_lon'].to_numpy(dtype='float64')[order]
+
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    lat_rad, lon_rad = np.radians(lat), np.radians(lon)
+    a = (
+        np.sin(np.diff(lat_rad) / 2) ** 2 +
+        np.cos(lat_rad[:-1]) * np.cos(lat_rad[1:]) * np.sin(np.diff(lon_rad) / 2) ** 2
+    )
+    segments = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    # Segment i joins point i to i + 1; the ones crossing into the next shape don't count
+    segments[starts[1:] - 1] = 0
+    lengths = np.add.reduceat(np.r_[segments, 0], starts)
+
+    return pd.DataFrame({
+        'shape_id': shape_ids.cat.categories[codes[starts]],
+        'point_count': np.diff(np.r_[starts, len(codes)]).astype('int32'),
+        'length_km': lengths.round(3),
+        'min_lat': np.minimum.reduceat(lat, starts),
+        'min_lon': np.minimum.reduceat(lon, starts),
+        'max_lat': np.maximum.reduceat(lat, starts),
+        'max_lon': np.maximum.reduceat(lon, starts),
+    })
 
 @task
-def extract_shapes_data(data_path: str) -> pd.DataFrame:
+def extract_shapes_data(zip_path: str) -> pd.DataFrame:
     logger = get_run_logger()
-    file_path = os.path.join(data_path, 'shapes.txt')
     
-    logger.info(f"Reading file: {file_path}")
-    df = pd.read_csv(file_path)
+    df = read_gtfs_frame(zip_path, 'shapes')
     logger.info(f"File read successfully: {len(df)} records")
     return df
 
@@ -21,52 +65,45 @@ def extract_shapes_data(data_path: str) -> pd.DataFrame:
 def transform_shapes_data(df: pd.DataFrame) -> pd.DataFrame:
     logger = get_run_logger()
     
-    df_clean = df.copy()
-
-    for col in df_clean.select_dtypes(include=['object']).columns:
-        df_clean[col] = df_clean[col].astype(str).str.strip()
+    df_clean = drop_invalid_rows(df, 'shapes')
 
-    df_clean = df_clean[df_clean['shape_id'].notna()]
-    df_clean = df_clean[df_clean['shape_id'] != '']
+    if len(df_clean) < len(df):
+        logger.warning(f"Removed {len(df) - len(df_clean)} invalid records.")
 
-    df_clean.dropna(subset=['shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'], inplace=True)
-
-    df_clean['shape_pt_lat'] = pd.to_numeric(df_clean['shape_pt_lat'], errors='coerce')
-    df_clean['shape_pt_lon'] = pd.to_numeric(df_clean['shape_pt_lon'], errors='coerce')
-    df_clean['shape_pt_sequence'] = pd.to_numeric(df_clean['shape_pt_sequence'], errors='coerce').astype(int)
-    
     logger.info(f"Transformations completed: {len(df_clean)} valid records")
     return df_clean
 
 @task
-def load_shapes_to_postgres(df: pd.DataFrame) -> int:
+def load_shapes_to_postgres(df: pd.DataFrame, schema: str = 'raw') -> int:
     logger = get_run_logger()
-    engine = create_engine(DATABASE_URL)
-    
-    with engine.connect() as conn:
-        conn.execute(text("DELETE FROM raw.shapes"))
-        conn.commit()
+    record_count = copy_to_postgres(df, 'shapes', schema, indexes=SHAPES_INDEXES)
+    logger.info(f"Inserted {record_count} records into {schema}.shapes table")
+    return record_count
 
-    df.to_sql(
-        name='shapes',
-        con=engine,
-        schema='raw',
-        if_exists='append',
-        index=False,
-        method='multi'
-    )
-    
-    logger.info(f"Inserted {len(df)} records into raw.shapes table")
-    return len(df)
+@task
+def compute_shape_metrics(df: pd.DataFrame) -> pd.DataFrame:
+    logger = get_run_logger()
+    metrics = shape_metrics(df)
+    logger.info(f"Computed metrics for {len(metrics)} shapes ({metrics['length_km'].sum():,.1f} km in total)")
+    return metrics
+
+@task
+def load_shape_metrics_to_postgres(df: pd.DataFrame, schema: str = 'raw') -> int:
+    logger = get_run_logger()
+    record_count = copy_to_postgres(df, 'shape_metrics', schema)
+    logger.info(f"Inserted {record_count} records into {schema}.shape_metrics table")
+    return record_count
 
 @flow(name="STCP GTFS Shapes Pipeline")
-def shapes_etl_pipeline(data_path: str):
+def shapes_etl_pipeline(zip_path: str, target_schema: str = 'raw'):
     logger = get_run_logger()
     logger.info("Starting Shapes Pipeline")
     
-    df = extract_shapes_data(data_path)
+    df = extract_shapes_data(zip_path)
     df_transformed = transform_shapes_data(df)
-    record_count = load_shapes_to_postgres(df_transformed)
+    record_count = load_shapes_to_postgres(df_transformed, target_schema)
+    metrics = compute_shape_metrics(df_transformed)
+    load_shape_metrics_to_postgres(metrics, target_schema)
     
     logger.info(f"Shapes Pipeline completed successfully: {record_count} records processed")
 
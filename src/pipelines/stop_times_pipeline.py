@@ -1,23 +1,55 @@
 #!/usr/bin/env python3
 
 import pandas as pd
-import psycopg2
-from sqlalchemy import create_engine, text
 from prefect import flow, task
 from prefect.logging import get_run_logger
-import os
-from config import DATABASE_URL
+from config import STOP_TIMES_STREAMING, STOP_TIMES_CHUNK_SIZE
+from pipelines.loader import copy_to_postgres, SurrogateKeys
+from pipelines.feed_cache import iter_gtfs_frames, read_gtfs_frame
+from pipelines.schema import drop_invalid_rows
+
+# Built once the table is loaded rather than maintained during COPY
+STOP_TIMES_INDEXES = {
+    'stop_times_trip_sequence_idx': "CREATE UNIQUE INDEX {name} ON {table} (trip_key, stop_sequence)",
+    'stop_times_stop_departure_idx': "CREATE INDEX {name} ON {table} (stop_key, departure_secs)",
+}
+
+def gtfs_time_to_seconds(values: pd.Series) -> pd.Series:
+    # GTFS times may exceed 24:00:00 for trips that run past midnight
+    parts = values.str.extract(r'^(\d{1,3}):(\d{2}):(\d{2})$')
+    hours, minutes, seconds = (pd.to_numeric(parts[i], errors='coerce') for i in range(3))
+    return (hours * 3600 + minutes * 60 + seconds).astype('Int32')
+
+def encode_stop_times(df: pd.DataFrame, trip_keys: SurrogateKeys, stop_keys: SurrogateKeys) -> pd.DataFrame:
+    encoded = pd.DataFrame({
+        'trip_key': trip_keys.encode(df['trip_id']),
+        'stop_sequence': df['stop_sequence'].to_numpy(dtype='int32'),
+        'stop_key': stop_keys.encode(df['stop_id']),
+        'arrival_secs': gtfs_time_to_seconds(df['arrival_time']).array,
+        'departure_secs': gtfs_time_to_seconds(df['departure_time']).array,
+    })
+    if 'stop_headsign' in df.columns:
+        encoded['stop_headsign'] = df['stop_headsign'].array
+    return encoded
+
+def copy_encoded_stop_times(chunks, schema: str) -> int:
+    logger = get_run_logger()
+    trip_keys = SurrogateKeys('trip_keys', 'trip_id', 'trip_key', schema)
+    stop_keys = SurrogateKeys('stop_keys', 'stop_id', 'stop_key', schema)
+
+    encoded_chunks = (encode_stop_times(chunk, trip_keys, stop_keys) for chunk in chunks)
+    record_count = copy_to_postgres(encoded_chunks, 'stop_times', schema, indexes=STOP_TIMES_INDEXES)
+
+    trip_count = copy_to_postgres(trip_keys.to_frame(), 'trip_keys', schema)
+    stop_count = copy_to_postgres(stop_keys.to_frame(), 'stop_keys', schema)
+    logger.info(f"Stored surrogate keys for {trip_count} trips and {stop_count} stops")
+    return record_count
 
 @task
-def extract_stop_times_data(data_path: str) -> pd.DataFrame:
+def extract_stop_times_data(zip_path: str) -> pd.DataFrame:
     logger = get_run_logger()
-    file_path = os.path.join(data_path, 'stop_times.txt')
     
-    logger.info(f"Reading file: {file_path}")
-    df = pd.read_csv(
-        file_path,
-        dtype={'arrival_time': str, 'departure_time': str}
-    )
+    df = read_gtfs_frame(zip_path, 'stop_times')
     logger.info(f"File read successfully: {len(df)} records")
     return df
 
@@ -25,57 +57,44 @@ def extract_stop_times_data(data_path: str) -> pd.DataFrame:
 def transform_stop_times_data(df: pd.DataFrame) -> pd.DataFrame:
     logger = get_run_logger()
     
-    df_clean = df.copy()
-
-    for col in df_clean.select_dtypes(include=['object']).columns:
-        df_clean[col] = df_clean[col].astype(str).str.strip()
-
-    df_clean.dropna(subset=['stop_id', 'trip_id', 'stop_sequence'], inplace=True)
-    df_clean = df_clean[df_clean['stop_id'] != '']
-    df_clean = df_clean[df_clean['trip_id'] != '']
-    
-    df_clean['stop_sequence'] = pd.to_numeric(df_clean['stop_sequence'], errors='coerce').astype(int)
-    df_clean = df_clean[df_clean['stop_sequence'] >= 0]
+    df_clean = drop_invalid_rows(df, 'stop_times')
     
     logger.info(f"Transformations completed: {len(df_clean)} valid records")
     return df_clean
 
 @task
-def load_stop_times_to_postgres(df: pd.DataFrame) -> int:
+def load_stop_times_to_postgres(df: pd.DataFrame, schema: str = 'raw') -> int:
     logger = get_run_logger()
-    engine = create_engine(DATABASE_URL)
+    record_count = copy_encoded_stop_times([df], schema)
+    logger.info(f"Inserted {record_count} records into {schema}.stop_times table")
+    return record_count
 
-    with engine.connect() as conn:
-        conn.execute(text("DELETE FROM raw.stop_times"))
-        conn.commit()
-
-    # Insert in batches to avoid memory issues with large datasets
-    batch_size = 50000
-    total_records = len(df)
+@task
+def stream_stop_times_to_postgres(zip_path: str, chunk_size: int, schema: str = 'raw') -> int:
+    logger = get_run_logger()
+    logger.info(f"Streaming stop_times.txt from {zip_path} in chunks of {chunk_size} rows")
 
-    for i in range(0, total_records, batch_size):
-        batch = df.iloc[i:i+batch_size]
-        batch.to_sql(
-            name='stop_times',
-            con=engine,
-            schema='raw',
-            if_exists='append',
-            index=False,
-            method='multi'
-        )
-        logger.info(f"Inserted batch {i//batch_size + 1}: {len(batch)} records ({i+len(batch)}/{total_records})")
+    def cleaned_chunks():
+        for chunk_number, chunk in enumerate(iter_gtfs_frames(zip_path, 'stop_times', chunk_size), start=1):
+            df_clean = drop_invalid_rows(chunk, 'stop_times')
+            logger.info(f"Chunk {chunk_number}: {len(df_clean)}/{len(chunk)} valid records")
+            yield df_clean
 
-    logger.info(f"Inserted {total_records} records into raw.stop_times table")
-    return total_records
+    record_count = copy_encoded_stop_times(cleaned_chunks(), schema)
+    logger.info(f"Inserted {record_count} records into {schema}.stop_times table")
+    return record_count
 
 @flow(name="STCP GTFS Stop Times Pipeline")
-def stop_times_etl_pipeline(data_path: str):
+def stop_times_etl_pipeline(zip_path: str, target_schema: str = 'raw', streaming: bool = STOP_TIMES_STREAMING, chunk_size: int = STOP_TIMES_CHUNK_SIZE):
     logger = get_run_logger()
     logger.info("Starting Stop Times Pipeline")
     
-    df = extract_stop_times_data(data_path)
-    df_transformed = transform_stop_times_data(df)
-    record_count = load_stop_times_to_postgres(df_transformed)
+    if streaming:
+        record_count = stream_stop_times_to_postgres(zip_path, chunk_size, target_schema)
+    else:
+        df = extract_stop_times_data(zip_path)
+        df_transformed = transform_stop_times_data(df)
+        record_count = load_stop_times_to_postgres(df_transformed, target_schema)
     
     logger.info(f"Stop Times Pipeline completed successfully: {record_count} records processed")
 
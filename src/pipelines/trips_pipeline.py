@@ -1,19 +1,17 @@
 #!/usr/bin/env python3
 
 import pandas as pd
-from sqlalchemy import create_engine, text
 from prefect import flow, task
 from prefect.logging import get_run_logger
-import os
-from config import DATABASE_URL
+from pipelines.loader import copy_to_postgres
+from pipelines.feed_cache import read_gtfs_frame
+from pipelines.schema import drop_invalid_rows
 
 @task
-def extract_trips_data(data_path: str) -> pd.DataFrame:
+def extract_trips_data(zip_path: str) -> pd.DataFrame:
     logger = get_run_logger()
-    file_path = os.path.join(data_path, 'trips.txt')
     
-    logger.info(f"Reading file: {file_path}")
-    df = pd.read_csv(file_path)
+    df = read_gtfs_frame(zip_path, 'trips')
     logger.info(f"File read successfully: {len(df)} records")
     return df
 
@@ -21,55 +19,29 @@ def extract_trips_data(data_path: str) -> pd.DataFrame:
 def transform_trips_data(df: pd.DataFrame) -> pd.DataFrame:
     logger = get_run_logger()
     
-    df_clean = df.copy()
+    df_clean = drop_invalid_rows(df, 'trips')
 
-    for col in df_clean.select_dtypes(include=['object']).columns:
-        df_clean[col] = df_clean[col].astype(str).str.strip()
+    if len(df_clean) < len(df):
+        logger.warning(f"Removed {len(df) - len(df_clean)} invalid records.")
 
-    df_clean.dropna(subset=['route_id', 'trip_id', 'service_id', 'direction_id'], inplace=True)
-    df_clean = df_clean[df_clean['route_id'] != '']
-    df_clean = df_clean[df_clean['trip_id'] != '']
-    df_clean = df_clean[df_clean['service_id'] != '']
-
-    df_clean['direction_id'] = pd.to_numeric(df_clean['direction_id'], errors='coerce').astype(int)
-    df_clean['wheelchair_accessible'] = pd.to_numeric(df_clean['wheelchair_accessible'], errors='coerce').fillna(0).astype(int)
-    
-    df_clean['block_id'] = df_clean['block_id'].fillna('')
-    df_clean['shape_id'] = df_clean['shape_id'].fillna('')
-    df_clean['trip_headsign'] = df_clean['trip_headsign'].fillna('')
-    
     logger.info(f"Transformations completed: {len(df_clean)} valid records")
     return df_clean
 
 @task
-def load_trips_to_postgres(df: pd.DataFrame) -> int:
+def load_trips_to_postgres(df: pd.DataFrame, schema: str = 'raw') -> int:
     logger = get_run_logger()
-    engine = create_engine(DATABASE_URL)
-    
-    with engine.connect() as conn:
-        conn.execute(text("DELETE FROM raw.trips"))
-        conn.commit()
-
-    df.to_sql(
-        name='trips',
-        con=engine,
-        schema='raw',
-        if_exists='append',
-        index=False,
-        method='multi'
-    )
-    
-    logger.info(f"Inserted {len(df)} records into raw.trips table")
-    return len(df)
+    record_count = copy_to_postgres(df, 'trips', schema)
+    logger.info(f"Inserted {record_count} records into {schema}.trips table")
+    return record_count
 
 @flow(name="STCP GTFS Trips Pipeline")
-def trips_etl_pipeline(data_path: str):
+def trips_etl_pipeline(zip_path: str, target_schema: str = 'raw'):
     logger = get_run_logger()
     logger.info("Starting Trips Pipeline")
     
-    df = extract_trips_data(data_path)
+    df = extract_trips_data(zip_path)
     df_transformed = transform_trips_data(df)
-    record_count = load_trips_to_postgres(df_transformed)
+    record_count = load_trips_to_postgres(df_transformed, target_schema)
     
     logger.info(f"Trips Pipeline completed successfully: {record_count} records processed")
 
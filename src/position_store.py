@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from config import POSITION_FLUSH_SECONDS, POSITION_BUFFER_MAX_ROWS, POSITION_RETENTION_DAYS
+
+SCHEMA_NAME = 'realtime'
+TABLE_NAME = 'vehicle_positions'
+PARTITION_PREFIX = f"{TABLE_NAME}_p"
+COLUMNS = [
+    'observed_at', 'vehicle_id', 'route_id', 'sentido', 'viagem', 'lat', 'lon', 'bearing', 'speed', 'received_at'
+]
+SQL_FILE = Path(__file__).parent / 'sql' / 'create_realtime_tables.sql'
+
+def parse_observed_at(value):
+    try:
+        observed_at = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    # Stored and partitioned in UTC
+    return observed_at.astimezone(timezone.utc) if observed_at.tzinfo else observed_at.replace(tzinfo=timezone.utc)
+
+def number_or_none(value):
+    return float(value) if isinstance(value, (int, float)) else None
+
+def partition_name(day) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+class PositionStore:
+    # Buffers polled vehicle positions in memory and writes them with one COPY
+    # per flush into daily partitions of realtime.vehicle_positions
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.buffer = []
+        # Last observation stored per vehicle: the broker repeats a position
+        # with the same timestamp until the vehicle reports again
+        self.last_observed = {}
+        self.tables_created = False
+        self.partitions = set()
+        self.retention_checked = None
+
+    def add(self, vehicles: list, received_at: datetime) -> int:
+        added = 0
+        for vehicle in vehicles:
+            vehicle_id = vehicle['id']
+            observed_at = parse_observed_at(vehicle['observed_at'])
+            if vehicle_id is None or observed_at is None or self.last_observed.get(vehicle_id) == observed_at:
+                continue
+            self.last_observed[vehicle_id] = observed_at
+            sentido = vehicle['sentido']
+            self.buffer.append((
+                observed_at, vehicle_id, vehicle['route_id'], int(sentido) if sentido and sentido.isdigit() else None,
+                vehicle['viagem'], float(vehicle['lat']), float(vehicle['lon']),
+                number_or_none(vehicle['bearing']), number_or_none(vehicle['speed']), received_at
+            ))
+            added += 1
+
+        # A database outage must not grow the buffer without bound; the oldest rows go first
+        overflow = len(self.buffer) - POSITION_BUFFER_MAX_ROWS
+        if overflow > 0:
+            del self.buffer[:overflow]
+            print(f"Position buffer full, dropped {overflow} oldest rows")
+        return added
+
+    async def create_tables(self, conn) -> None:
+        await conn.execute(SQL_FILE.read_text())
+        self.tables_created = True
+
+    async def ensure_partitions(self, conn, days: set) -> None:
+        for day in sorted(days - self.partitions):
+            start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {SCHEMA_NAME}.{partition_name(day)} "
+                f"PARTITION OF {SCHEMA_NAME}.{TABLE_NAME} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{(start + timedelta(days=1)).isoformat()}')"
+            )
+            self.partitions.add(day)
+
+    async def drop_expired_partitions(self, conn, today) -> None:
+        # Retention drops whole partitions: no DELETE, no vacuum of dead rows
+        cutoff = today - timedelta(days=POSITION_RETENTION_DAYS)
+        names = await conn.fetch(
+            """
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            JOIN pg_namespace n ON n.oid = p.relnamespace
+            WHERE n.nspname = $1 AND p.relname = $2
+            """,
+            SCHEMA_NAME, TABLE_NAME
+        )
+        for (name,) in names:
+            try:
+                day = datetime.strptime(name.removeprefix(PARTITION_PREFIX), '%Y%m%d').date()
+            except ValueError:
+                continue
+            if day < cutoff:
+                await conn.execute(f"DROP TABLE IF EXISTS {SCHEMA_NAME}.{name}")
+                self.partitions.discard(day)
+                print(f"Dropped expired position partition {name}")
+        self.retention_checked = today
+
+    async def flush(self) -> int:
+        # Rows added while the COPY is running go to a fresh buffer for the next flush
+        pending, self.buffer = self.buffer, []
+        today = datetime.now(timezone.utc).date()
+        cutoff = today - timedelta(days=POSITION_RETENTION_DAYS)
+        rows = [row for row in pending if row[0].date() >= cutoff]
+        if not rows and self.retention_checked == today:
+            return 0
+
+        try:
+            async with self.engine.connect() as sa_conn:
+                raw_connection = await sa_conn.get_raw_connection()
+                conn = raw_connection.driver_connection
+                if not self.tables_created:
+                    await self.create_tables(conn)
+                if self.retention_checked != today:
+                    await self.drop_expired_partitions(conn, today)
+                if rows:
+                    await self.ensure_partitions(conn, {row[0].date() for row in rows})
+                    await conn.copy_records_to_table(TABLE_NAME, schema_name=SCHEMA_NAME, columns=COLUMNS, records=rows)
+        except Exception:
+            self.buffer[:0] = rows
+            raise
+        return len(rows)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(POSITION_FLUSH_SECONDS)
+            try:
+                written = await self.flush()
+            except Exception as e:
+                print(f"Position flush failed, keeping {len(self.buffer)} buffered rows: {e}")
+                continue
+            if written:
+                print(f"Stored {written} vehicle positions")
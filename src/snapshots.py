@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import re
+import shutil
+from pathlib import Path
+
+import brotli
+import orjson
+from sqlalchemy import text
+
+from config import SNAPSHOT_DIR, SNAPSHOT_KEEP_VERSIONS
+
+def paragem_row(row) -> dict:
+    return {
+        "stop_id": row[0], "stop_name": row[1], "stop_lat": float(row[2]),
+        "stop_lon": float(row[3]), "area_geografica": row[4]
+    }
+
+def linha_row(row) -> dict:
+    return {
+        "route_id": row[0], "route_short_name": row[1], "route_long_name": row[2],
+        "route_desc": row[3], "route_color": row[4], "route_text_color": row[5],
+        "tipo_transporte": row[6]
+    }
+
+def quilometragem_row(row) -> dict:
+    return {
+        "route_id": row[0], "route_short_name": row[1], "route_long_name": row[2],
+        "total_shapes": row[3], "km_medio": float(row[4]) if row[4] else 0,
+        "km_total": float(row[5]) if row[5] else 0
+    }
+
+def frequencia_row(row) -> dict:
+    return {
+        "route_id": row[0], "route_short_name": row[1], "route_long_name": row[2],
+        "hora": row[3], "total_viagens": row[4], "total_passagens": row[5]
+    }
+
+# Endpoints whose payload only changes with the feed, pre-rendered at the end of each load
+SNAPSHOT_QUERIES = {
+    'paragens': (
+        "SELECT stop_id, stop_name, stop_lat, stop_lon, area_geografica FROM analytics.paragens_mapa WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL ORDER BY stop_name",
+        paragem_row
+    ),
+    'linhas': (
+        "SELECT route_id, route_short_name, route_long_name, route_desc, route_color, route_text_color, tipo_transporte FROM analytics.linhas_dashboard ORDER BY route_short_name",
+        linha_row
+    ),
+    'quilometragem-linhas': (
+        "SELECT route_id, route_short_name, route_long_name, total_shapes, km_medio, km_total FROM analytics.quilometragem_linhas ORDER BY km_total DESC",
+        quilometragem_row
+    ),
+    'frequencia-servico': (
+        "SELECT route_id, route_short_name, route_long_name, hora, total_viagens, total_passagens FROM analytics.frequencia_servico ORDER BY route_short_name, hora",
+        frequencia_row
+    ),
+}
+
+# Pre-compressed variants, most preferred first: (file suffix, Content-Encoding)
+SNAPSHOT_ENCODINGS = [('.br', 'br'), ('.gz', 'gzip')]
+
+def snapshot_key(version: str) -> str:
+    return re.sub(r'[^0-9A-Za-z]', '', version)
+
+def snapshot_path(version: str, name: str) -> Path:
+    return Path(SNAPSHOT_DIR) / snapshot_key(version) / f"{name}.json"
+
+def write_snapshots(conn, version: str) -> Path:
+    snapshot_root = Path(SNAPSHOT_DIR)
+    key = snapshot_key(version)
+    target_dir = snapshot_root / key
+    build_dir = snapshot_root / f"{key}.tmp"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    build_dir.mkdir(parents=True)
+
+    for name, (sql, to_dict) in SNAPSHOT_QUERIES.items():
+        body = orjson.dumps([to_dict(row) for row in conn.execute(text(sql))])
+        (build_dir / f"{name}.json").write_bytes(body)
+        (build_dir / f"{name}.json.gz").write_bytes(gzip.compress(body, compresslevel=9))
+        (build_dir / f"{name}.json.br").write_bytes(brotli.compress(body, quality=11))
+
+    shutil.rmtree(target_dir, ignore_errors=True)
+    build_dir.rename(target_dir)
+
+    # nginx serves snapshots/current/*; repoint it in one rename
+    current_link = snapshot_root / 'current'
+    next_link = snapshot_root / 'current.tmp'
+    if next_link.is_symlink():
+        next_link.unlink()
+    next_link.symlink_to(key, target_is_directory=True)
+    os.replace(next_link, current_link)
+
+    versions = sorted(
+        (path for path in snapshot_root.iterdir() if path.is_dir() and not path.is_symlink() and not path.name.endswith('.tmp')),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True
+    )
+    for old_dir in versions[SNAPSHOT_KEEP_VERSIONS:]:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return target_dir
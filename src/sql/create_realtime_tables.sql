@@ -0,0 +1,22 @@
+-- Polled vehicle positions, kept outside raw/analytics so feed loads and
+-- schema swaps never touch them. One partition per UTC day, created and
+-- dropped by the API's position store.
+
+CREATE SCHEMA IF NOT EXISTS realtime;
+
+CREATE TABLE IF NOT EXISTS realtime.vehicle_positions (
+    observed_at TIMESTAMPTZ NOT NULL,
+    vehicle_id TEXT NOT NULL,
+    route_id TEXT,
+    sentido SMALLINT,
+    viagem TEXT,
+    lat DOUBLE PRECISION NOT NULL,
+    lon DOUBLE PRECISION NOT NULL,
+    bearing REAL,
+    speed REAL,
+    received_at TIMESTAMPTZ NOT NULL
+) PARTITION BY RANGE (observed_at);
+
+-- Rows arrive in time order, so BRIN stays tiny and still prunes well
+CREATE INDEX IF NOT EXISTS idx_vehicle_positions_observed_at
+    ON realtime.vehicle_positions USING BRIN (observed_at) WITH (pages_per_range = 32);
@@ -3,12 +3,15 @@
 CREATE SCHEMA IF NOT EXISTS raw;
 CREATE SCHEMA IF NOT EXISTS analytics;
 
+CREATE EXTENSION IF NOT EXISTS postgis;
+
 CREATE TABLE IF NOT EXISTS raw.agency (
     agency_id VARCHAR(255) PRIMARY KEY,
     agency_name VARCHAR(255),
     agency_url TEXT,
     agency_timezone VARCHAR(100),
     agency_lang VARCHAR(10),
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -23,6 +26,7 @@ CREATE TABLE IF NOT EXISTS raw.calendar (
     sunday INTEGER DEFAULT 0,
     start_date DATE NOT NULL,
     end_date DATE NOT NULL,
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -30,10 +34,31 @@ CREATE TABLE IF NOT EXISTS raw.calendar_dates (
     service_id VARCHAR(255) NOT NULL,
     date DATE NOT NULL,
     exception_type INTEGER DEFAULT 1,
+    row_hash BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (service_id, date)
+);
+
+-- calendar and calendar_dates expanded by the calendar pipeline: one row per
+-- service and day it runs, and the same days as a bitmap over the feed range
+CREATE TABLE IF NOT EXISTS raw.service_dates (
+    service_id VARCHAR(255) NOT NULL,
+    date DATE NOT NULL,
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (service_id, date)
 );
 
+CREATE TABLE IF NOT EXISTS raw.service_bitmaps (
+    service_id VARCHAR(255) PRIMARY KEY,
+    start_date DATE NOT NULL,
+    day_count INTEGER NOT NULL,
+    -- Bit i is start_date + i
+    active_days VARBIT NOT NULL,
+    row_hash BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE IF NOT EXISTS raw.routes (
     route_id VARCHAR(255) PRIMARY KEY,
     route_short_name VARCHAR(255),
@@ -43,6 +68,7 @@ CREATE TABLE IF NOT EXISTS raw.routes (
     route_url TEXT,
     route_color VARCHAR(10),
     route_text_color VARCHAR(10),
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -51,17 +77,61 @@ CREATE TABLE IF NOT EXISTS raw.shapes (
     shape_pt_lat NUMERIC(10,8) NOT NULL,
     shape_pt_lon NUMERIC(11,8) NOT NULL,
     shape_pt_sequence INTEGER NOT NULL,
+    geom geometry(Point, 4326) GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(shape_pt_lon::float8, shape_pt_lat::float8), 4326)) STORED,
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (shape_id, shape_pt_sequence)
 );
 
+-- Per-shape geometry computed by the shapes pipeline (polyline length, bounding box)
+CREATE TABLE IF NOT EXISTS raw.shape_metrics (
+    shape_id VARCHAR(255) PRIMARY KEY,
+    point_count INTEGER NOT NULL,
+    length_km NUMERIC(10,3) NOT NULL,
+    min_lat NUMERIC(10,8),
+    min_lon NUMERIC(11,8),
+    max_lat NUMERIC(10,8),
+    max_lon NUMERIC(11,8),
+    row_hash BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- stop_times used to keep GTFS ids and times as text; the compact layout replaces it
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = to_regclass('raw.stop_times') AND attname = 'arrival_time' AND NOT attisdropped
+    ) THEN
+        DROP TABLE raw.stop_times CASCADE;
+    END IF;
+END $$;
+
+-- Integer surrogate keys for the ids repeated on every stop_times row
+CREATE TABLE IF NOT EXISTS raw.trip_keys (
+    trip_key INTEGER PRIMARY KEY,
+    trip_id VARCHAR(255) NOT NULL UNIQUE,
+    row_hash BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS raw.stop_keys (
+    stop_key INTEGER PRIMARY KEY,
+    stop_id VARCHAR(255) NOT NULL UNIQUE,
+    row_hash BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Times are seconds since the start of the service day, so trips running
+-- past midnight (24:00:00 and later) keep their order
 CREATE TABLE IF NOT EXISTS raw.stop_times (
-    trip_id VARCHAR(255) NOT NULL,
-    arrival_time TEXT,
-    departure_time TEXT,
-    stop_id VARCHAR(255) NOT NULL,
+    trip_key INTEGER NOT NULL,
     stop_sequence INTEGER NOT NULL,
+    stop_key INTEGER NOT NULL,
+    arrival_secs INTEGER,
+    departure_secs INTEGER,
     stop_headsign TEXT,
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -73,6 +143,8 @@ CREATE TABLE IF NOT EXISTS raw.stops (
     stop_lon NUMERIC(11,8),
     zone_id VARCHAR(255),
     stop_url TEXT,
+    geom geometry(Point, 4326) GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(stop_lon::float8, stop_lat::float8), 4326)) STORED,
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -80,6 +152,7 @@ CREATE TABLE IF NOT EXISTS raw.transfers (
     from_stop_id VARCHAR(255) NOT NULL,
     to_stop_id VARCHAR(255) NOT NULL,
     transfer_type INTEGER DEFAULT 0,
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (from_stop_id, to_stop_id)
 );
@@ -93,5 +166,23 @@ CREATE TABLE IF NOT EXISTS raw.trips (
     wheelchair_accessible INTEGER DEFAULT 0,
     block_id VARCHAR(255),
     shape_id VARCHAR(255),
+    row_hash BIGINT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+
+-- Row hashes used by differential loads (added to tables created before they existed)
+ALTER TABLE raw.agency ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE raw.calendar ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE raw.calendar_dates ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE raw.routes ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE raw.shapes ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE raw.stop_times ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE raw.stops ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE raw.transfers ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE raw.trips ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+
+-- Point geometries derived from the GTFS coordinates on every load
+ALTER TABLE raw.shapes ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326)
+    GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(shape_pt_lon::float8, shape_pt_lat::float8), 4326)) STORED;
+ALTER TABLE raw.stops ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326)
+    GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(stop_lon::float8, stop_lat::float8), 4326)) STORED;
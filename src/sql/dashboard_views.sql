@@ -1,86 +1,136 @@
+-- Heavy aggregations are materialized views refreshed once per feed load.
+-- Older deployments created them as plain views, which have to go first.
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('analytics.frequencia_servico')) = 'v' THEN
+        DROP VIEW analytics.frequencia_servico;
+    END IF;
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('analytics.hubs_transferencia')) = 'v' THEN
+        DROP VIEW analytics.hubs_transferencia;
+    END IF;
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('analytics.quilometragem_linhas')) = 'v' THEN
+        DROP VIEW analytics.quilometragem_linhas;
+    END IF;
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('analytics.top_paragens_horarios')) = 'v' THEN
+        DROP VIEW analytics.top_paragens_horarios;
+    END IF;
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('analytics.kpi_summary')) = 'v' THEN
+        DROP VIEW analytics.kpi_summary;
+    END IF;
+END $$;
+
 -- Service frequency by route and hour
-CREATE OR REPLACE VIEW analytics.frequencia_servico AS
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics.frequencia_servico AS
 SELECT 
     t.route_id,
     r.route_short_name,
     r.route_long_name,
-    EXTRACT(HOUR FROM st.departure_time::TIME) as hora,
-    COUNT(DISTINCT t.trip_id) as total_viagens,
-    COUNT(st.trip_id) as total_passagens
-FROM raw.trips t
+    -- Departures after midnight (>= 24:00:00) count towards the early hours
+    (st.departure_secs / 3600) % 24 as hora,
+    COUNT(DISTINCT st.trip_key) as total_viagens,
+    COUNT(*) as total_passagens
+FROM raw.stop_times st
+JOIN raw.trip_keys tk ON st.trip_key = tk.trip_key
+JOIN raw.trips t ON tk.trip_id = t.trip_id
 JOIN raw.routes r ON t.route_id = r.route_id
-JOIN raw.stop_times st ON t.trip_id = st.trip_id
--- Safely filter out invalid time formats before casting
-WHERE st.departure_time ~ '^\d{2}:\d{2}:\d{2}$' AND SUBSTRING(st.departure_time, 1, 2)::int < 24
-GROUP BY t.route_id, r.route_short_name, r.route_long_name, EXTRACT(HOUR FROM st.departure_time::TIME)
+WHERE st.departure_secs IS NOT NULL
+GROUP BY t.route_id, r.route_short_name, r.route_long_name, (st.departure_secs / 3600) % 24
 ORDER BY t.route_id, hora;
 
+CREATE UNIQUE INDEX IF NOT EXISTS frequencia_servico_route_hora_idx ON analytics.frequencia_servico (route_id, hora);
+CREATE INDEX IF NOT EXISTS frequencia_servico_short_name_hora_idx ON analytics.frequencia_servico (route_short_name, hora);
+
 -- Transfer hubs (stops with multiple routes)
-CREATE OR REPLACE VIEW analytics.hubs_transferencia AS
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics.hubs_transferencia AS
 SELECT 
     s.stop_id,
     s.stop_name,
     s.stop_lat,
     s.stop_lon,
     COUNT(DISTINCT t.route_id) as total_linhas,
-    COUNT(DISTINCT t.trip_id) as total_viagens,
+    COUNT(DISTINCT st.trip_key) as total_viagens,
     ARRAY_AGG(DISTINCT r.route_short_name ORDER BY r.route_short_name) as linhas
 FROM raw.stops s
-JOIN raw.stop_times st ON s.stop_id = st.stop_id
-JOIN raw.trips t ON st.trip_id = t.trip_id
+JOIN raw.stop_keys sk ON s.stop_id = sk.stop_id
+JOIN raw.stop_times st ON sk.stop_key = st.stop_key
+JOIN raw.trip_keys tk ON st.trip_key = tk.trip_key
+JOIN raw.trips t ON tk.trip_id = t.trip_id
 JOIN raw.routes r ON t.route_id = r.route_id
 GROUP BY s.stop_id, s.stop_name, s.stop_lat, s.stop_lon
 HAVING COUNT(DISTINCT t.route_id) >= 3
 ORDER BY total_linhas DESC;
 
--- Route distances (approximated via shapes)
-CREATE OR REPLACE VIEW analytics.quilometragem_linhas AS
-WITH shape_distances AS (
-    SELECT 
-        shape_id,
-        COUNT(*) as total_pontos,
-        ROUND(
-            (111.045 * SQRT(
-                POWER(MAX(shape_pt_lat) - MIN(shape_pt_lat), 2) + 
-                POWER(MAX(shape_pt_lon) - MIN(shape_pt_lon), 2)
-            ))::numeric, 2
-        ) as distancia_km
-    FROM raw.shapes
-    GROUP BY shape_id
-)
+CREATE UNIQUE INDEX IF NOT EXISTS hubs_transferencia_stop_idx ON analytics.hubs_transferencia (stop_id);
+CREATE INDEX IF NOT EXISTS hubs_transferencia_total_linhas_idx ON analytics.hubs_transferencia (total_linhas DESC);
+
+-- Route distances from the polyline length of each trip's shape.
+-- Earlier versions estimated it from the bounding-box diagonal of raw.shapes.
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('analytics.quilometragem_linhas')) = 'm'
+        AND pg_get_viewdef(to_regclass('analytics.quilometragem_linhas')) NOT LIKE '%shape_metrics%' THEN
+        DROP MATERIALIZED VIEW analytics.quilometragem_linhas;
+    END IF;
+END $$;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics.quilometragem_linhas AS
 SELECT 
     r.route_id,
     r.route_short_name,
     r.route_long_name,
     COUNT(DISTINCT t.shape_id) as total_shapes,
-    AVG(sd.distancia_km) as km_medio,
-    SUM(sd.distancia_km) as km_total
+    AVG(sm.length_km) as km_medio,
+    SUM(sm.length_km) as km_total
 FROM raw.routes r
 JOIN raw.trips t ON r.route_id = t.route_id
-JOIN shape_distances sd ON t.shape_id = sd.shape_id
+JOIN raw.shape_metrics sm ON t.shape_id = sm.shape_id
 WHERE t.shape_id != ''
 GROUP BY r.route_id, r.route_short_name, r.route_long_name
 ORDER BY km_total DESC;
 
--- Service patterns analysis
+CREATE UNIQUE INDEX IF NOT EXISTS quilometragem_linhas_route_idx ON analytics.quilometragem_linhas (route_id);
+CREATE INDEX IF NOT EXISTS quilometragem_linhas_km_total_idx ON analytics.quilometragem_linhas (km_total DESC);
+
+-- Service patterns analysis; dates come from the expanded calendar, so
+-- calendar_dates additions and removals are counted
 CREATE OR REPLACE VIEW analytics.padroes_servico AS
 SELECT 
-    c.service_id,
+    sd.service_id,
     CASE 
         WHEN c.monday = 1 AND c.tuesday = 1 AND c.wednesday = 1 AND c.thursday = 1 AND c.friday = 1 AND c.saturday = 0 AND c.sunday = 0 THEN 'Dias Uteis'
         WHEN c.saturday = 1 AND c.sunday = 0 THEN 'Sabados'
         WHEN c.sunday = 1 THEN 'Domingos'
         ELSE 'Outro'
     END as tipo_servico,
-    c.start_date,
-    c.end_date,
-    COUNT(DISTINCT t.trip_id) as total_viagens,
-    COUNT(DISTINCT t.route_id) as total_linhas
-FROM raw.calendar c
-JOIN raw.trips t ON c.service_id = t.service_id
-GROUP BY c.service_id, tipo_servico, c.start_date, c.end_date
+    MIN(sd.date) as start_date,
+    MAX(sd.date) as end_date,
+    t.total_viagens,
+    t.total_linhas,
+    COUNT(*) as dias_ativos
+FROM raw.service_dates sd
+JOIN (
+    SELECT service_id, COUNT(DISTINCT trip_id) as total_viagens, COUNT(DISTINCT route_id) as total_linhas
+    FROM raw.trips
+    GROUP BY service_id
+) t ON sd.service_id = t.service_id
+LEFT JOIN raw.calendar c ON sd.service_id = c.service_id
+GROUP BY sd.service_id, tipo_servico, t.total_viagens, t.total_linhas
 ORDER BY total_viagens DESC;
 
+-- Trips scheduled on each service day
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics.viagens_por_data AS
+SELECT
+    sd.date as data,
+    COUNT(*) as total_viagens,
+    COUNT(DISTINCT t.route_id) as total_linhas,
+    COUNT(DISTINCT sd.service_id) as total_servicos
+FROM raw.service_dates sd
+JOIN raw.trips t ON sd.service_id = t.service_id
+GROUP BY sd.date
+ORDER BY sd.date;
+
+CREATE UNIQUE INDEX IF NOT EXISTS viagens_por_data_data_idx ON analytics.viagens_por_data (data);
+
 -- Stops for map display
 CREATE OR REPLACE VIEW analytics.paragens_mapa AS
 SELECT 
@@ -94,10 +144,33 @@ SELECT
         WHEN s.stop_lat < 41.15 AND s.stop_lon <= -8.6 THEN 'Sul'
         WHEN s.stop_lon > -8.6 THEN 'Este'
         ELSE 'Outras'
-    END as area_geografica
+    END as area_geografica,
+    s.geom
 FROM raw.stops s
 WHERE s.stop_lat IS NOT NULL AND s.stop_lon IS NOT NULL;
 
+-- Route shapes as Web Mercator lines for the map's vector tiles
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics.shape_lines AS
+SELECT
+    sh.shape_id,
+    r.route_id,
+    r.route_short_name,
+    r.route_color,
+    ST_Transform(ST_MakeLine(sh.geom ORDER BY sh.shape_pt_sequence), 3857) as geom
+FROM raw.shapes sh
+LEFT JOIN (
+    SELECT DISTINCT ON (shape_id) shape_id, route_id
+    FROM raw.trips
+    WHERE shape_id <> ''
+    ORDER BY shape_id, route_id
+) t ON sh.shape_id = t.shape_id
+LEFT JOIN raw.routes r ON t.route_id = r.route_id
+GROUP BY sh.shape_id, r.route_id, r.route_short_name, r.route_color
+HAVING COUNT(*) >= 2;
+
+CREATE UNIQUE INDEX IF NOT EXISTS shape_lines_shape_idx ON analytics.shape_lines (shape_id);
+CREATE INDEX IF NOT EXISTS shape_lines_geom_idx ON analytics.shape_lines USING GIST (geom);
+
 -- Routes for dashboard
 CREATE OR REPLACE VIEW analytics.linhas_dashboard AS
 SELECT 
@@ -115,19 +188,22 @@ SELECT
 FROM raw.routes r;
 
 -- Top stops by schedule count
-CREATE OR REPLACE VIEW analytics.top_paragens_horarios AS
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics.top_paragens_horarios AS
 SELECT 
     s.stop_id,
     s.stop_name,
     s.stop_lat,
     s.stop_lon,
-    COUNT(st.trip_id) as total_horarios
+    COUNT(*) as total_horarios
 FROM raw.stops s
-JOIN raw.stop_times st ON s.stop_id = st.stop_id
+JOIN raw.stop_keys sk ON s.stop_id = sk.stop_id
+JOIN raw.stop_times st ON sk.stop_key = st.stop_key
 GROUP BY s.stop_id, s.stop_name, s.stop_lat, s.stop_lon
 ORDER BY total_horarios DESC
 LIMIT 10;
 
+CREATE UNIQUE INDEX IF NOT EXISTS top_paragens_horarios_stop_idx ON analytics.top_paragens_horarios (stop_id);
+
 -- Geographic distribution
 CREATE OR REPLACE VIEW analytics.distribuicao_geografica AS
 SELECT 
@@ -140,10 +216,14 @@ GROUP BY area_geografica
 ORDER BY total_paragens DESC;
 
 -- KPI Summary
-CREATE OR REPLACE VIEW analytics.kpi_summary AS
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics.kpi_summary AS
 SELECT 
+    1 as kpi_id,
     (SELECT COUNT(*) FROM raw.stops) as total_paragens,
     (SELECT COUNT(*) FROM raw.routes) as total_linhas,
     (SELECT COUNT(*) FROM raw.stop_times) as total_horarios,
     (SELECT agency_name FROM raw.agency LIMIT 1) as operadora,
-    (SELECT MAX(created_at) FROM raw.stops) as data_atualizacao;
+    -- Refreshed once per feed load, so this is the load time; the API uses it as the dataset version
+    LOCALTIMESTAMP as data_atualizacao;
+
+CREATE UNIQUE INDEX IF NOT EXISTS kpi_summary_id_idx ON analytics.kpi_summary (kpi_id);
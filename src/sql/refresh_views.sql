@@ -0,0 +1,9 @@
+-- Refreshes the materialized analytics layer after a feed load.
+-- CONCURRENTLY keeps the views readable by the API while they are rebuilt.
+REFRESH MATERIALIZED VIEW CONCURRENTLY analytics.frequencia_servico;
+REFRESH MATERIALIZED VIEW CONCURRENTLY analytics.hubs_transferencia;
+REFRESH MATERIALIZED VIEW CONCURRENTLY analytics.quilometragem_linhas;
+REFRESH MATERIALIZED VIEW CONCURRENTLY analytics.shape_lines;
+REFRESH MATERIALIZED VIEW CONCURRENTLY analytics.top_paragens_horarios;
+REFRESH MATERIALIZED VIEW CONCURRENTLY analytics.viagens_por_data;
+REFRESH MATERIALIZED VIEW CONCURRENTLY analytics.kpi_summary;
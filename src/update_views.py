@@ -7,7 +7,8 @@ from main_pipeline import run_sql_file
 def update_views_flow():
     logger = get_run_logger()
     logger.info("--- Updating Analytics Views ---")
-    run_sql_file(sql_file_name="dashboard_views.sql")
+    views_created = run_sql_file(sql_file_name="dashboard_views.sql")
+    run_sql_file(sql_file_name="refresh_views.sql", wait_for=[views_created])
     logger.info("--- Views updated successfully! ---")
 
 if __name__ == "__main__":
@@ -0,0 +1,7 @@
+import os
+import sys
+from pathlib import Path
+
+# Modules import config, which requires a database password even when no database is used
+os.environ.setdefault('DB_PASSWORD', 'test')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
@@ -0,0 +1,90 @@
+from datetime import date, datetime
+
+import pandas as pd
+import pytest
+
+from departures import DepartureIndex, ServiceCalendar, gtfs_time
+from pipelines.calendar_pipeline import expand_service_days
+
+# Week of Monday 2025-03-03. WK runs on weekdays but is removed on Wednesday
+# 03-05, when the HOL service is added instead.
+CALENDAR = pd.DataFrame({
+    'service_id': ['WK'],
+    'monday': [1], 'tuesday': [1], 'wednesday': [1], 'thursday': [1], 'friday': [1], 'saturday': [0], 'sunday': [0],
+    'start_date': pd.to_datetime(['2025-03-03']),
+    'end_date': pd.to_datetime(['2025-03-09']),
+})
+CALENDAR_DATES = pd.DataFrame({
+    'service_id': ['WK', 'HOL'],
+    'date': pd.to_datetime(['2025-03-05', '2025-03-05']),
+    'exception_type': [2, 1],
+})
+
+STOP_KEYS = pd.DataFrame({'stop_key': [1, 2, 3], 'stop_id': ['A', 'B', 'EMPTY']})
+TRIP_INFO = pd.DataFrame({
+    'trip_key': [10, 11, 12],
+    'trip_id': ['day', 'holiday', 'night'],
+    'route_id': ['200', '201', '5M'],
+    'route_short_name': ['200', '201', '5M'],
+    'service_id': ['WK', 'HOL', 'WK'],
+    'trip_headsign': ['Bolhao', 'Bolhao', 'Aliados'],
+})
+# The night trip leaves A at 25:10, i.e. 01:10 on the day after its service day
+STOP_TIMES = pd.DataFrame({
+    'stop_key': [1, 2, 1, 1],
+    'departure_secs': [8 * 3600, 8 * 3600 + 600, 8 * 3600 + 1800, 25 * 3600 + 600],
+    'trip_key': [10, 10, 11, 12],
+})
+
+@pytest.fixture(scope='module')
+def index():
+    _, bitmaps = expand_service_days(CALENDAR, CALENDAR_DATES)
+    rows = [
+        (row.service_id, row.start_date.date(), row.active_days)
+        for row in bitmaps.sort_values('service_id').itertuples(index=False)
+    ]
+    return DepartureIndex.build(STOP_KEYS, TRIP_INFO, STOP_TIMES, ServiceCalendar.from_bitmaps(rows))
+
+def trips(departures):
+    return [(departure['trip_id'], departure['service_date']) for departure in departures]
+
+def test_gtfs_time_keeps_hours_past_midnight():
+    assert gtfs_time(25 * 3600 + 600) == '25:10:00'
+
+def test_regular_day_lists_day_and_night_trips(index):
+    departures = index.next_departures('A', datetime(2025, 3, 4, 7, 0), 10)
+
+    assert trips(departures) == [('day', '2025-03-04'), ('night', '2025-03-04')]
+    assert departures[0]['minutes'] == 60
+    assert departures[1]['departure_time'] == '25:10:00'
+    assert departures[1]['departure_at'] == '2025-03-05T01:10:00'
+
+def test_previous_service_day_trip_after_midnight(index):
+    # Tuesday's 25:10 trip is still ahead at 00:30 on Wednesday, while
+    # Wednesday's own WK trips are removed and HOL runs instead
+    departures = index.next_departures('A', datetime(2025, 3, 5, 0, 30), 10)
+
+    assert trips(departures) == [('night', '2025-03-04'), ('holiday', '2025-03-05')]
+    assert departures[0]['minutes'] == 40
+
+def test_removed_service_has_no_trips_past_midnight(index):
+    # WK is removed on Wednesday, so there is no 25:10 trip early on Thursday
+    departures = index.next_departures('A', datetime(2025, 3, 6, 1, 0), 10)
+
+    assert trips(departures) == [('day', '2025-03-06'), ('night', '2025-03-06')]
+
+def test_service_outside_its_weekdays(index):
+    assert index.next_departures('B', datetime(2025, 3, 8, 7, 0), 10) == []
+    assert trips(index.next_departures('B', datetime(2025, 3, 7, 7, 0), 10)) == [('day', '2025-03-07')]
+
+def test_limit_and_departures_already_gone(index):
+    assert trips(index.next_departures('A', datetime(2025, 3, 4, 7, 0), 1)) == [('day', '2025-03-04')]
+    assert trips(index.next_departures('A', datetime(2025, 3, 4, 9, 0), 10)) == [('night', '2025-03-04')]
+
+def test_unknown_stop_and_stop_without_departures(index):
+    assert index.next_departures('NOPE', datetime(2025, 3, 4, 7, 0), 10) is None
+    assert index.next_departures('EMPTY', datetime(2025, 3, 4, 7, 0), 10) == []
+
+def test_dates_outside_the_feed_have_no_service(index):
+    assert index.calendar.active(date(2025, 4, 1)).sum() == 0
+    assert index.next_departures('A', datetime(2025, 4, 1, 7, 0), 10) == []
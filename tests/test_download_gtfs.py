@@ -0,0 +1,180 @@
+import hashlib
+import io
+import logging
+import os
+import socket
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_gtfs
+from download_gtfs import (
+    download_gtfs_file, feed_already_processed, load_feed_state, mark_feed_processed, save_feed_state
+)
+
+def gtfs_zip(payload_bytes: int = 256 * 1024) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('agency.txt', 'agency_id,agency_name\nSTCP,STCP\n')
+        archive.writestr('stops.txt', os.urandom(payload_bytes))
+    return buffer.getvalue()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Serves one file with an ETag, honouring If-None-Match, Range and If-Range
+    # like the portal's file server; the flags on the server inject failures
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body = server.body
+
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        range_header = self.headers.get('Range')
+        if range_header and server.reject_range:
+            server.reject_range = False
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{len(body)}")
+            self.end_headers()
+            return
+
+        if range_header and self.headers.get('If-Range') == server.etag:
+            start = int(range_header.removeprefix('bytes=').rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+            payload = body[start:]
+        else:
+            self.send_response(200)
+            payload = body
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+
+        if server.truncate_next:
+            # Drops the connection half way through, as a flaky network would
+            server.truncate_next = False
+            self.wfile.write(payload[:len(payload) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        self.wfile.write(payload)
+
+@pytest.fixture
+def portal():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.body = gtfs_zip()
+    server.etag = '"v1"'
+    server.requests = []
+    server.reject_range = False
+    server.truncate_next = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/gtfs.zip"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(autouse=True)
+def plain_logger(monkeypatch):
+    # The tasks are called through .fn, outside a Prefect run
+    monkeypatch.setattr(download_gtfs, 'get_run_logger', lambda: logging.getLogger('test_download_gtfs'))
+
+@pytest.fixture
+def save_path(tmp_path):
+    return str(tmp_path / 'gtfs.zip')
+
+def read_bytes(path) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_download_stores_archive_and_checksum(portal, save_path):
+    assert download_gtfs_file.fn(portal.url, save_path) == save_path
+
+    assert read_bytes(save_path) == portal.body
+    state = load_feed_state(save_path)
+    assert state['sha256'] == hashlib.sha256(portal.body).hexdigest()
+    assert state['etag'] == portal.etag
+    assert 'partial' not in state
+    assert not os.path.exists(f"{save_path}.part")
+
+def test_not_modified_keeps_local_copy(portal, save_path):
+    download_gtfs_file.fn(portal.url, save_path)
+    mtime = os.stat(save_path).st_mtime_ns
+
+    download_gtfs_file.fn(portal.url, save_path)
+
+    assert portal.requests[-1]['If-None-Match'] == portal.etag
+    assert os.stat(save_path).st_mtime_ns == mtime
+    assert read_bytes(save_path) == portal.body
+
+def test_interrupted_download_resumes_with_if_range(portal, save_path, monkeypatch):
+    # Chunks smaller than the file, so part of it reaches disk before the drop
+    monkeypatch.setattr(download_gtfs, 'DOWNLOAD_CHUNK_BYTES', 16 * 1024)
+    portal.truncate_next = True
+
+    download_gtfs_file.fn(portal.url, save_path)
+
+    assert len(portal.requests) == 2
+    resumed = portal.requests[1]
+    offset = int(resumed['Range'].removeprefix('bytes=').rstrip('-'))
+    assert 0 < offset <= len(portal.body) // 2
+    assert resumed['If-Range'] == portal.etag
+    assert read_bytes(save_path) == portal.body
+    assert load_feed_state(save_path)['sha256'] == hashlib.sha256(portal.body).hexdigest()
+
+def test_changed_file_restarts_instead_of_resuming(portal, save_path):
+    # A partial download of an older file: If-Range no longer matches, so the
+    # server sends the whole new file and the stale bytes must not be kept
+    with open(f"{save_path}.part", 'wb') as f:
+        f.write(b'stale bytes of the previous archive')
+    save_feed_state(save_path, {'partial': {'url': portal.url, 'etag': '"v0"', 'last_modified': None}})
+
+    download_gtfs_file.fn(portal.url, save_path)
+
+    assert portal.requests[0]['If-Range'] == '"v0"'
+    assert read_bytes(save_path) == portal.body
+    assert load_feed_state(save_path)['sha256'] == hashlib.sha256(portal.body).hexdigest()
+
+def test_unsatisfiable_range_starts_over(portal, save_path):
+    with open(f"{save_path}.part", 'wb') as f:
+        f.write(portal.body[:1000])
+    save_feed_state(save_path, {'partial': {'url': portal.url, 'etag': portal.etag, 'last_modified': None}})
+    portal.reject_range = True
+
+    download_gtfs_file.fn(portal.url, save_path)
+
+    assert 'Range' in portal.requests[0]
+    assert 'Range' not in portal.requests[1]
+    assert read_bytes(save_path) == portal.body
+
+def test_invalid_archive_is_rejected(portal, save_path):
+    portal.body = b'<html>maintenance</html>'
+
+    with pytest.raises(ValueError):
+        download_gtfs_file.fn(portal.url, save_path)
+
+    assert not os.path.exists(save_path)
+    assert not os.path.exists(f"{save_path}.part")
+    assert 'partial' not in load_feed_state(save_path)
+
+def test_feed_is_reprocessed_when_checksum_changes(portal, save_path):
+    download_gtfs_file.fn(portal.url, save_path)
+    assert not feed_already_processed.fn(save_path)
+
+    mark_feed_processed.fn(save_path)
+    assert feed_already_processed.fn(save_path)
+
+    # A new archive under a new ETag is downloaded and no longer matches
+    portal.body = gtfs_zip()
+    portal.etag = '"v2"'
+    download_gtfs_file.fn(portal.url, save_path)
+    assert portal.requests[-1]['If-None-Match'] == '"v1"'
+    assert read_bytes(save_path) == portal.body
+    assert not feed_already_processed.fn(save_path)
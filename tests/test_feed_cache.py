@@ -0,0 +1,61 @@
+import logging
+import os
+from pathlib import Path
+
+import pytest
+
+from pipelines import feed_cache
+from pipelines.feed_cache import evict_old_versions
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(feed_cache, 'PARQUET_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(feed_cache, 'PARQUET_CACHE_MAX_BYTES', 1500)
+    monkeypatch.setattr(feed_cache, 'get_run_logger', lambda: logging.getLogger('test_feed_cache'))
+    return tmp_path
+
+def add_version(cache_dir: Path, version: str, mtime: int, files: dict) -> Path:
+    version_dir = cache_dir / version
+    version_dir.mkdir()
+    for name, size in files.items():
+        (version_dir / name).write_bytes(b'x' * size)
+    os.utime(version_dir, (mtime, mtime))
+    return version_dir
+
+def test_least_recently_used_versions_are_evicted(cache_dir):
+    oldest = add_version(cache_dir, 'v1', 1000, {'stops-abc.parquet': 1000})
+    older = add_version(cache_dir, 'v2', 2000, {'stops-abc.parquet': 1000})
+    current = add_version(cache_dir, 'v3', 3000, {'stops-abc.parquet': 1000})
+
+    evict_old_versions('v3')
+
+    assert not oldest.exists() and not older.exists()
+    assert current.exists()
+
+def test_files_being_written_do_not_count(cache_dir):
+    # A worker's half-written .tmp file may be renamed mid-scan, so it is skipped
+    previous = add_version(cache_dir, 'v1', 1000, {'stops-abc.parquet': 500})
+    add_version(cache_dir, 'v2', 2000, {'stops-abc.parquet': 500, 'trips-abc.parquet.123.tmp': 5000})
+
+    evict_old_versions('v2')
+
+    assert previous.exists()
+
+def test_files_vanishing_during_the_scan_are_ignored(cache_dir, monkeypatch):
+    # Another worker renames the file between the listing and its size being read
+    add_version(cache_dir, 'v1', 1000, {'stops-abc.parquet': 5000})
+    add_version(cache_dir, 'v2', 2000, {'stops-abc.parquet': 500})
+    stat = Path.stat
+    seen = []
+
+    def racing_stat(path, *args, **kwargs):
+        if path.parent.name == 'v1' and path in seen:
+            raise FileNotFoundError(path)
+        seen.append(path)
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(Path, 'stat', racing_stat)
+
+    evict_old_versions('v2')
+
+    assert (cache_dir / 'v1').exists()
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import httpx
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+import api_server
+import fleet_poller
+from fleet_poller import FleetPoller, FleetSnapshot
+
+# Entities as returned by the Porto Digital broker, the last one without coordinates
+RECORDED_ENTITIES = json.loads((Path(__file__).parent / 'data' / 'fiware_entities.json').read_text())
+
+class RecordedBroker:
+    # Replays the recorded entities page by page, like Orion does for
+    # limit/offset queries with options=count
+
+    def __init__(self, entities=RECORDED_ENTITIES):
+        self.entities = entities
+        self.requests = []
+        self.failures = 0
+        self.release = None
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if self.release is not None:
+            await self.release.wait()
+        if self.failures:
+            self.failures -= 1
+            return httpx.Response(503, json={'error': 'ServiceUnavailable'})
+        offset = int(request.url.params['offset'])
+        limit = int(request.url.params['limit'])
+        return httpx.Response(
+            200,
+            json=self.entities[offset:offset + limit],
+            headers={'Fiware-Total-Count': str(len(self.entities))},
+        )
+
+def open_poller(broker, **hooks) -> FleetPoller:
+    poller = FleetPoller(**hooks)
+    poller.client = httpx.AsyncClient(base_url='http://broker.test', transport=httpx.MockTransport(broker))
+    return poller
+
+def test_fetch_pages_until_total_count(monkeypatch):
+    monkeypatch.setattr(fleet_poller, 'FLEET_PAGE_LIMIT', 2)
+    broker = RecordedBroker()
+    poller = open_poller(broker)
+
+    snapshot = asyncio.run(poller.refresh())
+
+    assert [int(request.url.params['offset']) for request in broker.requests] == [0, 2, 4]
+    assert all(request.url.params['options'] == 'count' for request in broker.requests)
+    body = orjson.loads(snapshot.body)
+    assert [vehicle['id'].rsplit(':', 1)[1] for vehicle in body['autocarros']] == ['3373', '3374', '2150', '1811']
+    assert body['autocarros'][0] == {
+        'id': 'urn:ngsi-ld:Vehicle:porto:stcp:bus:3373',
+        'route_id': '302',
+        'sentido': '0',
+        'viagem': '302_0_3|161|D2|T1|N12',
+        'lat': 41.157554626,
+        'lon': -8.601851463,
+        'bearing': 198,
+        'speed': 34,
+        'observed_at': '2025-10-25T12:28:58.00Z',
+    }
+    assert body['resumo']['total_autocarros'] == 4
+    assert body['resumo']['em_movimento'] == 2
+    assert body['resumo']['autocarros_por_linha'][0] == {'route_id': '302', 'total': 2}
+    assert poller.snapshot is snapshot and poller.last_error is None
+
+def test_error_object_instead_of_entities():
+    async def broker(request):
+        return httpx.Response(200, json={'error': 'BadRequest', 'description': 'invalid query'})
+    poller = open_poller(broker)
+
+    with pytest.raises(ValueError):
+        asyncio.run(poller.refresh())
+
+    assert poller.snapshot is None
+    assert 'invalid query' in poller.last_error
+
+def test_snapshot_is_published_when_matching_fails():
+    def match(vehicles):
+        raise IndexError('shape index out of date')
+    poller = open_poller(RecordedBroker(), match=match)
+
+    snapshot = asyncio.run(poller.refresh())
+
+    vehicles = orjson.loads(snapshot.body)['autocarros']
+    assert len(vehicles) == 4
+    assert all('shape_id' not in vehicle for vehicle in vehicles)
+    assert poller.last_error is None
+
+def test_concurrent_refreshes_share_one_fetch():
+    broker = RecordedBroker()
+    poller = open_poller(broker)
+
+    async def scenario():
+        broker.release = asyncio.Event()
+        waiters = [asyncio.create_task(poller.refresh()) for _ in range(3)]
+        await asyncio.sleep(0)
+        # A request that goes away must not cancel the fetch the others wait on
+        waiters[0].cancel()
+        broker.release.set()
+        return await asyncio.gather(*waiters, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+
+    assert len(broker.requests) == 1
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1] is results[2] is poller.snapshot
+    assert poller.inflight is None
+
+def run_poll_loop(monkeypatch, poller, polls):
+    # Runs the loop for a number of polls, recording each delay with the error seen before it
+    monkeypatch.setattr(fleet_poller.random, 'uniform', lambda low, high: high)
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append((delay, poller.last_error))
+        if len(sleeps) == polls:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(fleet_poller.asyncio, 'sleep', fake_sleep)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(poller.run())
+    return sleeps
+
+def test_backoff_doubles_while_the_broker_fails(monkeypatch):
+    monkeypatch.setattr(fleet_poller, 'FLEET_POLL_SECONDS', 10)
+    monkeypatch.setattr(fleet_poller, 'FLEET_BACKOFF_MAX_SECONDS', 60)
+    broker = RecordedBroker()
+    broker.failures = 3
+    poller = open_poller(broker)
+
+    sleeps = run_poll_loop(monkeypatch, poller, 5)
+
+    assert [delay for delay, _ in sleeps] == [20, 40, 60, 10, 10]
+    assert all('503' in error for _, error in sleeps[:3])
+    assert [error for _, error in sleeps[3:]] == [None, None]
+    assert poller.client.is_closed
+
+def test_any_error_keeps_the_loop_running(monkeypatch):
+    monkeypatch.setattr(fleet_poller, 'FLEET_POLL_SECONDS', 10)
+    calls = []
+
+    def on_snapshot(vehicles, received_at):
+        calls.append(received_at)
+        if len(calls) == 1:
+            raise RuntimeError('position store is gone')
+
+    poller = open_poller(RecordedBroker(), on_snapshot=on_snapshot)
+
+    sleeps = run_poll_loop(monkeypatch, poller, 2)
+
+    assert sleeps == [(20, 'position store is gone'), (10, None)]
+    assert len(calls) == 2
+
+@pytest.fixture
+def broker():
+    return RecordedBroker()
+
+@pytest.fixture
+def api_poller(broker, monkeypatch):
+    # Without the lifespan, the app does not connect to the database or start its loops
+    poller = open_poller(broker)
+    monkeypatch.setattr(api_server, 'fleet_poller', poller)
+    return poller
+
+def test_fleet_status_unavailable_while_backing_off(api_poller, broker):
+    broker.failures = 1
+    client = TestClient(api_server.app)
+
+    first = client.get('/api/fleet-status')
+    second = client.get('/api/fleet-status')
+
+    assert first.status_code == 503
+    assert second.status_code == 503
+    assert '503' in second.json()['detail']
+    # The second request answers from last_error instead of calling the broker again
+    assert len(broker.requests) == 1
+
+def test_fleet_status_cold_start_waits_for_the_first_poll(api_poller):
+    response = TestClient(api_server.app).get('/api/fleet-status')
+
+    assert response.status_code == 200
+    assert response.json()['resumo']['total_autocarros'] == 4
+    assert response.headers['X-Fleet-Stale'] == 'false'
+    assert response.headers['ETag'] == api_poller.snapshot.etag
+
+def test_fleet_status_flags_stale_snapshots(api_poller, broker):
+    api_poller.snapshot = FleetSnapshot([], time.time() - 120)
+    client = TestClient(api_server.app)
+
+    response = client.get('/api/fleet-status')
+
+    assert response.status_code == 200
+    assert response.headers['X-Fleet-Stale'] == 'true'
+    assert int(response.headers['Age']) >= 120
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert broker.requests == []
+
+    not_modified = client.get('/api/fleet-status', headers={'If-None-Match': response.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert not_modified.headers['X-Fleet-Stale'] == 'true'
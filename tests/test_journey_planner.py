@@ -0,0 +1,142 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from journey_planner import Timetable
+
+# A hand-built network around Porto:
+#   line 1   A -> B -> C             (08:00 and 09:00)
+#   line 2   B -> E                  (08:12, change at B)
+#   line 3   D -> G                  (08:16, D is a ~250 m walk from B)
+#   line 4   F -> H                  (08:40, F is reached from C through transfers.txt)
+#   line 5   A -> X                  (Saturdays only)
+#   line N   A -> B at 24:40         (night trip of the weekday service)
+STOPS = pd.DataFrame({
+    'stop_key': [1, 2, 3, 4, 5, 6, 7, 8, 9],
+    'stop_id': ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'X'],
+    'stop_name': ['Alfa', 'Bravo', 'Charlie', 'Delta', 'Echo', 'Foxtrot', 'Golf', 'Hotel', 'Xray'],
+    'stop_lat': [41.1500, 41.1600, 41.1700, 41.1600, 41.1800, 41.1754, 41.1650, 41.1850, 41.2000],
+    'stop_lon': [-8.6000, -8.6000, -8.6000, -8.6030, -8.6100, -8.6000, -8.6200, -8.5900, -8.7000],
+})
+TRIPS = pd.DataFrame({
+    'trip_key': [1, 2, 3, 4, 5, 6, 7],
+    'trip_id': ['l1_0800', 'l1_0900', 'l2_0812', 'l3_0816', 'l4_0840', 'l5_1000', 'n_2440'],
+    'route_short_name': ['1', '1', '2', '3', '4', '5', 'N'],
+    'service_id': ['WK', 'WK', 'WK', 'WK', 'WK', 'SAT', 'WK'],
+    'trip_headsign': ['Charlie', 'Charlie', 'Echo', 'Golf', 'Hotel', 'Xray', 'Bravo'],
+})
+
+def hms(value: str) -> int:
+    hours, minutes = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60
+
+STOP_TIMES = pd.DataFrame([
+    (trip_key, sequence, stop_key, hms(time), hms(time))
+    for trip_key, calls in {
+        1: [(1, '08:00'), (2, '08:10'), (3, '08:20')],
+        2: [(1, '09:00'), (2, '09:10'), (3, '09:20')],
+        3: [(2, '08:12'), (5, '08:30')],
+        4: [(4, '08:16'), (7, '08:35')],
+        5: [(6, '08:40'), (8, '08:50')],
+        6: [(1, '10:00'), (9, '10:30')],
+        7: [(1, '24:40'), (2, '24:55')],
+    }.items()
+    for sequence, (stop_key, time) in enumerate(calls, start=1)
+], columns=['trip_key', 'stop_sequence', 'stop_key', 'arrival_secs', 'departure_secs'])
+
+# The feed runs from Monday 2025-03-03 to Sunday 2025-03-09
+SERVICE_BITMAPS = pd.DataFrame({
+    'service_id': ['SAT', 'WK'],
+    'start_date': ['2025-03-03', '2025-03-03'],
+    'active_days': ['0000010', '1111100'],
+})
+
+@pytest.fixture(scope='module')
+def timetable():
+    return Timetable.build({
+        'stops': STOPS,
+        'trips': TRIPS,
+        'stop_times': STOP_TIMES,
+        'transfers': pd.DataFrame({'from_stop_id': ['C'], 'to_stop_id': ['F']}),
+        'service_bitmaps': SERVICE_BITMAPS,
+    })
+
+def leg_summary(journey):
+    return [
+        (leg['tipo'], leg.get('linha'), leg['de']['stop_id'], leg['para']['stop_id'])
+        for leg in journey['etapas']
+    ]
+
+def test_direct_trip_takes_the_next_departure(timetable):
+    journey = timetable.plan('A', 'C', datetime(2025, 3, 4, 8, 30))
+
+    assert leg_summary(journey) == [('autocarro', '1', 'A', 'C')]
+    assert journey['etapas'][0]['trip_id'] == 'l1_0900'
+    assert (journey['partida'], journey['chegada'], journey['transbordos']) == ('09:00:00', '09:20:00', 0)
+
+def test_one_transfer(timetable):
+    journey = timetable.plan('A', 'E', datetime(2025, 3, 4, 7, 55))
+
+    assert leg_summary(journey) == [('autocarro', '1', 'A', 'B'), ('autocarro', '2', 'B', 'E')]
+    assert journey['transbordos'] == 1
+    assert journey['chegada'] == '08:30:00'
+
+def test_walk_between_nearby_stops(timetable):
+    journey = timetable.plan('A', 'G', datetime(2025, 3, 4, 7, 55))
+
+    assert leg_summary(journey) == [
+        ('autocarro', '1', 'A', 'B'), ('pe', None, 'B', 'D'), ('autocarro', '3', 'D', 'G')
+    ]
+    walk = journey['etapas'][1]
+    assert 150 < walk['duracao_s'] < 300
+    assert journey['chegada'] == '08:35:00'
+
+def test_transfer_from_transfers_txt(timetable):
+    # C and F are too far apart to count as a walk, but transfers.txt links them
+    journey = timetable.plan('A', 'H', datetime(2025, 3, 4, 7, 55))
+
+    assert leg_summary(journey) == [
+        ('autocarro', '1', 'A', 'C'), ('pe', None, 'C', 'F'), ('autocarro', '4', 'F', 'H')
+    ]
+    assert journey['chegada'] == '08:50:00'
+
+def test_no_journey_without_service(timetable):
+    assert timetable.plan('A', 'X', datetime(2025, 3, 4, 9, 0)) is None
+    assert timetable.plan('A', 'C', datetime(2025, 3, 8, 7, 0)) is None
+
+    journey = timetable.plan('A', 'X', datetime(2025, 3, 8, 9, 0))
+    assert (journey['data'], journey['chegada']) == ('2025-03-08', '10:30:00')
+
+def test_trip_past_midnight_on_its_service_day(timetable):
+    journey = timetable.plan('A', 'B', datetime(2025, 3, 4, 23, 0))
+
+    assert journey['etapas'][0]['trip_id'] == 'n_2440'
+    assert (journey['data'], journey['partida'], journey['chegada']) == ('2025-03-04', '24:40:00', '24:55:00')
+
+def test_previous_service_day_trip_after_midnight(timetable):
+    # At 00:30 on Wednesday, Tuesday's 24:40 trip beats Wednesday's 08:00
+    journey = timetable.plan('A', 'B', datetime(2025, 3, 5, 0, 30))
+
+    assert journey['etapas'][0]['trip_id'] == 'n_2440'
+    assert (journey['data'], journey['partida']) == ('2025-03-04', '24:40:00')
+
+    # Saturday has no weekday service, so nothing is left early on Sunday
+    assert timetable.plan('A', 'B', datetime(2025, 3, 9, 0, 30)) is None
+
+def test_unknown_stops(timetable):
+    assert timetable.plan('A', 'NOPE', datetime(2025, 3, 4, 8, 0)) is None
+    assert timetable.plan('NOPE', 'A', datetime(2025, 3, 4, 8, 0)) is None
+
+def test_save_and_load_round_trip(timetable, tmp_path):
+    path = tmp_path / 'journey_planner.npz'
+    timetable.save(path)
+
+    loaded = Timetable.load(path)
+
+    assert set(loaded.arrays) == set(timetable.arrays)
+    for name, value in timetable.arrays.items():
+        np.testing.assert_array_equal(loaded.arrays[name], value)
+    at = datetime(2025, 3, 4, 7, 55)
+    assert loaded.plan('A', 'H', at) == timetable.plan('A', 'H', at)
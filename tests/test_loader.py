@@ -0,0 +1,35 @@
+import csv
+import io
+
+import pandas as pd
+
+from pipelines.loader import COPY_NULL, _copy_frame
+from pipelines.schema import coerce_schema
+
+class RecordingCursor:
+    def __init__(self):
+        self.copies = []
+
+    def copy_expert(self, sql, buffer):
+        self.copies.append((sql, buffer.getvalue()))
+
+def test_copy_keeps_empty_defaults_apart_from_nulls():
+    trips = coerce_schema(pd.DataFrame({
+        'route_id': ['200', '201'],
+        'service_id': ['WK', 'WK'],
+        'trip_id': ['t1', 't2'],
+        'trip_headsign': ['Bolhao', None],
+        'direction_id': ['0', None],
+        'shape_id': ['s1', None],
+    }), 'trips')
+    cursor = RecordingCursor()
+
+    _copy_frame(cursor, trips, 'raw.trips', io.StringIO())
+
+    [(sql, payload)] = cursor.copies
+    assert f"NULL '{COPY_NULL}'" in sql
+    rows = [dict(zip(list(trips.columns) + ['row_hash'], row)) for row in csv.reader(io.StringIO(payload))]
+    # The '' defaults from the schema must not turn into NULL in Postgres
+    assert rows[1]['trip_headsign'] == ''
+    assert rows[1]['shape_id'] == ''
+    assert rows[1]['direction_id'] == COPY_NULL
@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from pipelines.shapes_pipeline import shape_metrics
+
+COLUMNS = ['shape_id', 'point_count', 'length_km', 'min_lat', 'min_lon', 'max_lat', 'max_lon']
+
+def test_metrics_per_shape_ignore_row_order():
+    df = pd.DataFrame({
+        'shape_id': ['B', 'A', 'A', 'B', 'A'],
+        'shape_pt_sequence': [2, 3, 1, 1, 2],
+        'shape_pt_lat': [41.01, 41.02, 41.00, 41.00, 41.01],
+        'shape_pt_lon': [-8.60, -8.60, -8.60, -8.60, -8.60],
+    })
+
+    metrics = shape_metrics(df).set_index('shape_id')
+
+    assert metrics.loc['A', 'point_count'] == 3
+    assert metrics.loc['B', 'point_count'] == 2
+    # 0.01 degrees of latitude is about 1.112 km
+    assert metrics.loc['A', 'length_km'] == pytest.approx(2.224, abs=0.002)
+    assert metrics.loc['B', 'length_km'] == pytest.approx(1.112, abs=0.002)
+    assert metrics.loc['A', 'max_lat'] == 41.02
+
+def test_empty_shapes_give_empty_metrics():
+    df = pd.DataFrame({'shape_id': [], 'shape_pt_sequence': [], 'shape_pt_lat': [], 'shape_pt_lon': []})
+
+    metrics = shape_metrics(df)
+
+    assert metrics.empty
+    assert list(metrics.columns) == COLUMNS